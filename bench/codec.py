@@ -0,0 +1,96 @@
+from argparse import ArgumentParser
+from typing import Any, Callable, Dict, List
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from commons import FrameDecoder, OverseerCommands, RPCPacket
+
+import commons
+
+"""
+Microbenchmarks for the wire codec: RPCPacket.parse, make_sendable_stream and
+FrameDecoder, over both wire formats and a spread of payload sizes. Prints a
+JSON document on stdout so runs can be compared over time:
+
+    python bench/codec.py > codec-before.json
+"""
+
+# (argument count, bytes of opaque data). v1 cannot carry data.
+V1_PAYLOADS = ((0, 0), (3, 0), (16, 0), (64, 0))
+V2_PAYLOADS = ((0, 0), (3, 0), (16, 0), (64, 0), (3, 1024), (3, 65536))
+# Frames decoded per FrameDecoder run, mimicking one busy read.
+DECODER_BATCH = 256 # type: int
+
+def make_packet(argc: int, data_size: int) -> RPCPacket:
+    # Stay clear of the v1 framing bytes, which cannot appear in arguments.
+    args = [(i % 200) + 32 for i in range(argc)]
+    return RPCPacket(7, OverseerCommands.REQUEST_VOTE, args, data=b"\x5a" * data_size)
+
+def measure(func: Callable[[], Any], min_time: float) -> Dict[str, float]:
+    """
+    Run func enough times to last at least min_time seconds, best of three.
+    """
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    if elapsed < min_time:
+        number = int(number * min_time / elapsed) + 1
+    best = min(timer.repeat(repeat=3, number=number))
+    return {"ops_per_sec": number / best, "ns_per_op": best / number * 1e9}
+
+def bench_codec(version: int, argc: int, data_size: int, min_time: float) -> List[Dict[str, Any]]:
+    packet = make_packet(argc, data_size)
+    frame = packet.make_sendable_stream(version)
+    batch = frame * DECODER_BATCH
+
+    def decode_batch() -> None:
+        decoder = FrameDecoder()
+        decoder.feed(batch)
+        for _ in decoder.frames():
+            pass
+
+    results = []
+    for name, func, per_op in (
+        ("encode", lambda: packet.make_sendable_stream(version), 1),
+        ("parse", lambda: RPCPacket.parse(frame), 1),
+        ("decode_frames", decode_batch, DECODER_BATCH),
+    ):
+        result = measure(func, min_time)
+        result["ops_per_sec"] *= per_op
+        result["ns_per_op"] /= per_op
+        result.update({
+            "benchmark": name, "version": version, "argc": argc,
+            "data_bytes": data_size, "frame_bytes": len(frame)
+        })
+        results.append(result)
+    return results
+
+def main() -> None:
+    parser = ArgumentParser(description="Microbenchmarks for the raftel wire codec.")
+    parser.add_argument(
+        "--min-time", required=False, type=float, default=0.2,
+        help="Minimum seconds spent on each timing run."
+    )
+    args = parser.parse_args()
+
+    results = [] # type: List[Dict[str, Any]]
+    for argc, data_size in V1_PAYLOADS:
+        results.extend(bench_codec(commons.PROTOCOL_V1, argc, data_size, args.min_time))
+    # v3 only adds the group id, so it shares v2's payloads.
+    for version in (commons.PROTOCOL_V2, commons.PROTOCOL_V3):
+        for argc, data_size in V2_PAYLOADS:
+            results.extend(bench_codec(version, argc, data_size, args.min_time))
+
+    json.dump({
+        "suite": "codec",
+        "python": sys.version.split()[0],
+        "results": results
+    }, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+if __name__ == "__main__":
+    main()
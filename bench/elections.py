@@ -0,0 +1,180 @@
+from argparse import ArgumentParser
+from typing import Any, Dict, List, Optional
+
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+from nodecore import NodeStates
+from simulation import SimulatedNetwork, SimulatedNode, SimulatedOverseer, VirtualClock
+
+"""
+Election convergence at scale, on the simulated network. For every cluster
+size and seed, connects that many nodes to one simulated overseer at once and
+runs until they all follow the same leader, then stops that leader and runs
+until the rest agree on another. Reports how long each took in simulated
+time, how many terms it took, and the frames exchanged by command, as JSON on
+stdout:
+
+    python bench/elections.py --sizes 5 50 500 --seeds 5 > elections.json
+
+Runs are deterministic: the same sizes, seeds and settings always give the
+same results, however fast the machine.
+"""
+
+def converged(nodes: List[SimulatedNode]) -> Optional[SimulatedNode]:
+    """
+    The leader every node follows in the same term, if there is one.
+    """
+    leader = None # type: Optional[SimulatedNode]
+    for node in nodes:
+        if node.core.state == NodeStates.LEADER:
+            if leader is not None:
+                return None
+            leader = node
+    if leader is None:
+        return None
+    term = leader.core.current_term
+    for node in nodes:
+        if node is not leader and (
+            node.core.leader_id != leader.raft_id or node.core.current_term != term
+        ):
+            return None
+    return leader
+
+def phase(
+    clock: VirtualClock,
+    network: SimulatedNetwork,
+    nodes: List[SimulatedNode],
+    args: Any
+) -> Dict[str, Any]:
+    """
+    Run until nodes converge on a leader, measuring from now.
+    """
+    network.reset_counts()
+    started = clock.now
+    first_term = max(node.core.current_term for node in nodes)
+    settled = clock.run_until(lambda: converged(nodes) is not None, args.timeout, args.check_every)
+    terms = max(node.core.current_term for node in nodes) - first_term
+    return {
+        "converged": settled,
+        "ms": clock.now - started,
+        "terms": terms,
+        "frames": network.frames,
+        "frames_per_node": network.frames / len(nodes),
+        "commands": network.message_counts()
+    }
+
+def run_cluster(size: int, seed: int, args: Any) -> Dict[str, Any]:
+    clock = VirtualClock()
+    network = SimulatedNetwork(
+        clock, seed, (args.latency[0], args.latency[1]), args.loss, args.retransmit
+    )
+    overseer = SimulatedOverseer(network, client_timeout=args.client_timeout)
+    nodes = [
+        SimulatedNode(
+            network, args.election_timeout, args.wait_sleep,
+            heartbeat_interval=args.heartbeat_interval, direct=args.direct
+        )
+        for _ in range(size)
+    ]
+    started = time.perf_counter()
+    for node in nodes:
+        node.connect(overseer)
+    run = {"seed": seed, "election": phase(clock, network, nodes, args)} # type: Dict[str, Any]
+
+    leader = converged(nodes)
+    if leader is not None and size > 1:
+        leader.close()
+        survivors = [node for node in nodes if node is not leader]
+        run["failover"] = phase(clock, network, survivors, args)
+    run["wall_s"] = time.perf_counter() - started
+    run["simulated_ms"] = clock.now
+    return run
+
+def summarize(runs: List[Dict[str, Any]], name: str) -> Dict[str, Any]:
+    phases = [run[name] for run in runs if name in run]
+    settled = [phase for phase in phases if phase["converged"]]
+    summary = {"runs": len(phases), "converged": len(settled)} # type: Dict[str, Any]
+    if settled:
+        times = sorted(phase["ms"] for phase in settled)
+        summary["ms_p50"] = statistics.median(times)
+        summary["ms_max"] = times[-1]
+        summary["terms_mean"] = statistics.mean(phase["terms"] for phase in settled)
+        summary["frames_mean"] = statistics.mean(phase["frames"] for phase in settled)
+        summary["frames_per_node_mean"] = statistics.mean(
+            phase["frames_per_node"] for phase in settled
+        )
+    return summary
+
+def main() -> None:
+    parser = ArgumentParser(description="Simulated election convergence for raftel clusters.")
+    parser.add_argument("--sizes", required=False, type=int, nargs="+", default=[5, 25, 100, 500])
+    parser.add_argument(
+        "--seeds", required=False, type=int, default=5, help="Runs per size, seeded 0 to N-1."
+    )
+    parser.add_argument("--election-timeout", "-e", required=False, type=int, default=300)
+    parser.add_argument("--heartbeat-interval", required=False, type=int, default=None)
+    parser.add_argument("--wait-sleep", "-w", required=False, type=int, default=100)
+    parser.add_argument("--client-timeout", required=False, type=int, default=5000)
+    parser.add_argument(
+        "--latency", required=False, type=float, nargs=2, default=[0.5, 2.0],
+        metavar=("MIN_MS", "MAX_MS"), help="One-way latency range, drawn uniformly."
+    )
+    parser.add_argument("--loss", required=False, type=float, default=0.0)
+    parser.add_argument(
+        "--retransmit", required=False, type=float, default=200,
+        help="Milliseconds a lost frame is held back for."
+    )
+    parser.add_argument(
+        "--direct", required=False, action="store_true",
+        help="Have nodes exchange Raft traffic directly."
+    )
+    parser.add_argument(
+        "--timeout", required=False, type=float, default=60000,
+        help="Simulated milliseconds to wait for each phase to converge."
+    )
+    parser.add_argument(
+        "--check-every", required=False, type=float, default=5,
+        help="Simulated milliseconds between convergence checks; the resolution of the times."
+    )
+    args = parser.parse_args()
+    # Stopping leaders is the point; nodes need not complain about it.
+    logging.getLogger("raftel-node").disabled = True
+
+    sizes = {} # type: Dict[str, Any]
+    for size in args.sizes:
+        runs = [run_cluster(size, seed, args) for seed in range(args.seeds)]
+        sizes[str(size)] = {
+            "election": summarize(runs, "election"),
+            "failover": summarize(runs, "failover"),
+            "wall_s": sum(run["wall_s"] for run in runs),
+            "runs": runs
+        }
+
+    report = {
+        "suite": "elections",
+        "python": sys.version.split()[0],
+        "settings": {
+            "election_timeout": args.election_timeout,
+            "heartbeat_interval": args.heartbeat_interval,
+            "wait_sleep": args.wait_sleep,
+            "latency_ms": args.latency,
+            "loss": args.loss,
+            "retransmit_ms": args.retransmit,
+            "direct": args.direct,
+            "seeds": args.seeds
+        },
+        "sizes": sizes
+    }
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+if __name__ == "__main__":
+    main()
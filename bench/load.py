@@ -0,0 +1,300 @@
+from argparse import ArgumentParser
+from typing import Any, Dict, List, Optional
+
+import asyncio
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+from commons import FrameDecoder, OverseerCommands, RPCPacket
+
+import commons
+
+"""
+End-to-end load generator. Simulates N clients speaking the node protocol to
+an overseer: each logs in, then keeps a window of KEEP_ALIVEs in flight,
+mixing in a REQUEST_VOTE (which the overseer relays to every other client)
+every so often. Reports per-command throughput and p50/p99/p999 latency as
+JSON on stdout:
+
+    python bench/load.py --clients 100 --duration 10 > load-before.json
+
+By default an overseer is started for the run (--backend picks which); pass
+--no-spawn to load one that is already listening on --port instead. With
+--batch, clients send whatever fits in their window as one BATCH frame.
+
+All clients share this one process and event loop, so with many clients the
+generator itself may be the bottleneck; compare runs made on the same machine
+with the same settings.
+"""
+
+# Commands the load clients time, in report order.
+TIMED_COMMANDS = (
+    OverseerCommands.LOGIN, OverseerCommands.KEEP_ALIVE, OverseerCommands.REQUEST_VOTE
+)
+READ_SIZE = 65536 # type: int
+# Seconds past the end of the run a client waits for a response.
+STALL_TIMEOUT = 5.0 # type: float
+
+def percentile(sorted_samples: List[float], fraction: float) -> float:
+    # Nearest rank.
+    rank = max(0, math.ceil(fraction * len(sorted_samples)) - 1)
+    return sorted_samples[rank]
+
+class LatencyStats(object):
+    """
+    Every latency observed for one command, in seconds.
+    """
+
+    def __init__(self) -> None:
+        self.samples = [] # type: List[float]
+        self.nacks = 0 # type: int
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        report = {
+            "count": len(self.samples),
+            "nacks": self.nacks,
+            "ops_per_sec": len(self.samples) / elapsed if elapsed else 0.0
+        } # type: Dict[str, Any]
+        if self.samples:
+            ordered = sorted(self.samples)
+            for name, fraction in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999)):
+                report[name + "_ms"] = percentile(ordered, fraction) * 1000
+            report["max_ms"] = ordered[-1] * 1000
+        return report
+
+class LoadClient(object):
+
+    def __init__(
+        self,
+        stats: Dict[OverseerCommands, LatencyStats],
+        window_size: int,
+        vote_every: int,
+        batch: bool = False
+    ) -> None:
+        self.stats = stats
+        self.window_size = window_size # type: int
+        self.vote_every = vote_every # type: int
+        self.batch = batch # type: bool
+        self.protocol_version = commons.PROTOCOL_V1 # type: int
+        self.decoder = FrameDecoder() # type: FrameDecoder
+        self.next_packet_number = 1 # type: int
+        # packet number -> (command, time sent)
+        self.in_flight = {} # type: Dict[int, Any]
+        self.window_open = asyncio.Event() # type: asyncio.Event
+        self.relayed = 0 # type: int
+        self.term = 0 # type: int
+
+    async def __read_frames(self, reader: asyncio.StreamReader) -> List[RPCPacket]:
+        while True:
+            packets = [RPCPacket.parse(frame) for frame in self.decoder.frames()]
+            if packets:
+                return packets
+            data = await reader.read(READ_SIZE)
+            if not data:
+                raise ConnectionError("Overseer closed the connection.")
+            self.decoder.feed(data)
+
+    async def __login(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # v1 cannot frame packet numbers that collide with STX/ETX/RS, which a
+        # busy client soon reaches, so always negotiate the current format.
+        login = RPCPacket(0, OverseerCommands.LOGIN, [commons.PROTOCOL_VERSION])
+        sent_at = time.perf_counter()
+        # Offering v3 or later takes a v2 frame; see the overseer's docs.
+        writer.write(login.make_sendable_stream(commons.PROTOCOL_V2))
+        packets = await self.__read_frames(reader)
+        self.stats[OverseerCommands.LOGIN].samples.append(time.perf_counter() - sent_at)
+        ack = packets[0]
+        if ack.command != OverseerCommands.ACK:
+            raise ConnectionError("LOGIN refused: %s" % ack)
+        if len(ack.additional_info) > 1:
+            self.protocol_version = ack.additional_info[1]
+        # Anything after the ACK arrived in the same read.
+        for packet in packets[1:]:
+            self.__handle(packet)
+
+    def __handle(self, packet: RPCPacket) -> None:
+        if packet.command == OverseerCommands.BATCH:
+            for packet_number in packet.additional_info:
+                self.__handle(RPCPacket(packet_number, OverseerCommands.ACK))
+            for frame in commons.split_frames(packet.data):
+                self.__handle(RPCPacket.parse(frame))
+            return
+        if packet.command not in (OverseerCommands.ACK, OverseerCommands.NACK):
+            self.relayed += 1
+            return
+
+        sent = self.in_flight.pop(packet.packet_number, None)
+        if sent is None:
+            return
+        command, sent_at = sent
+        stats = self.stats[command]
+        if packet.command == OverseerCommands.NACK:
+            stats.nacks += 1
+        else:
+            stats.samples.append(time.perf_counter() - sent_at)
+        self.window_open.set()
+
+    async def __receive_forever(self, reader: asyncio.StreamReader) -> None:
+        while True:
+            for packet in await self.__read_frames(reader):
+                self.__handle(packet)
+
+    def __next_packet(self, sent: int) -> RPCPacket:
+        packet_number = self.next_packet_number
+        self.next_packet_number = (self.next_packet_number + 1) % 256
+        if self.vote_every and sent % self.vote_every == self.vote_every - 1:
+            self.term += 1
+            return RPCPacket(packet_number, OverseerCommands.REQUEST_VOTE, [self.term, 0, 0])
+        return RPCPacket(packet_number, OverseerCommands.KEEP_ALIVE)
+
+    def __queue_packet(self, sent: int) -> bytes:
+        packet = self.__next_packet(sent)
+        self.in_flight[packet.packet_number] = (packet.command, time.perf_counter())
+        return packet.make_sendable_stream(self.protocol_version)
+
+    async def run(self, host: str, port: int, deadline: float) -> None:
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            await self.__login(reader, writer)
+            receiver = asyncio.ensure_future(self.__receive_forever(reader))
+            sent = 0
+            while time.monotonic() < deadline and not receiver.done():
+                while len(self.in_flight) >= self.window_size:
+                    self.window_open.clear()
+                    # Responses that never come should not hang the run.
+                    await asyncio.wait_for(
+                        self.window_open.wait(), deadline - time.monotonic() + STALL_TIMEOUT
+                    )
+                if self.batch:
+                    frames = [] # type: List[bytes]
+                    while len(self.in_flight) < self.window_size:
+                        frames.append(self.__queue_packet(sent))
+                        sent += 1
+                    writer.write(commons.batch_frame(frames, self.protocol_version))
+                    await writer.drain()
+                    continue
+                writer.write(self.__queue_packet(sent))
+                sent += 1
+                if sent % self.window_size == 0:
+                    await writer.drain()
+            receiver.cancel()
+        finally:
+            writer.close()
+
+async def wait_for_port(host: str, port: int, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+def spawn_overseer(args: Any, log_dir: str) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.setdefault("raftel_log_level", "30")
+    command = [
+        sys.executable, os.path.join(SRC_DIR, "overseer.py"),
+        "--port", str(args.port), "--backend", args.backend,
+        "--workers", str(args.workers),
+        # The load clients stay busy; only a stuck run should time out.
+        "--client-timeout", str(int(args.duration * 1000) + 60000)
+    ]
+    if args.uvloop:
+        command.append("--uvloop")
+    # The overseer logs to a file in its working directory.
+    return subprocess.Popen(command, cwd=log_dir, env=env)
+
+async def run_load(args: Any) -> Dict[str, Any]:
+    stats = {command: LatencyStats() for command in TIMED_COMMANDS}
+    clients = [
+        LoadClient(stats, args.window, args.vote_every, args.batch)
+        for _ in range(args.clients)
+    ]
+    await wait_for_port(args.host, args.port, 10)
+    started = time.monotonic()
+    results = await asyncio.gather(
+        *(client.run(args.host, args.port, started + args.duration) for client in clients),
+        return_exceptions=True
+    )
+    elapsed = time.monotonic() - started
+    errors = [repr(result) for result in results if isinstance(result, BaseException)]
+
+    return {
+        "suite": "load",
+        "python": sys.version.split()[0],
+        "settings": {
+            "backend": args.backend if args.spawn else None,
+            "workers": args.workers if args.spawn else None,
+            "uvloop": args.uvloop,
+            "clients": args.clients,
+            "duration_s": args.duration,
+            "window": args.window,
+            "vote_every": args.vote_every,
+            "batch": args.batch
+        },
+        "elapsed_s": elapsed,
+        "commands": {command.name: stats[command].report(elapsed) for command in TIMED_COMMANDS},
+        "relayed_received": sum(client.relayed for client in clients),
+        "errors": errors[:10],
+        "error_count": len(errors)
+    }
+
+def main() -> None:
+    parser = ArgumentParser(description="Load generator for the raftel overseer.")
+    parser.add_argument("--clients", "-c", required=False, type=int, default=50)
+    parser.add_argument(
+        "--duration", "-d", required=False, type=float, default=10,
+        help="Seconds to keep the load up, after every client's LOGIN is sent."
+    )
+    parser.add_argument(
+        "--window", "-w", required=False, type=int, default=16,
+        help="Packets each client keeps in flight; at most the overseer's window."
+    )
+    parser.add_argument(
+        "--vote-every", required=False, type=int, default=50,
+        help="Send a REQUEST_VOTE instead of every this many-th KEEP_ALIVE (0 for never)."
+    )
+    parser.add_argument(
+        "--batch", required=False, action="store_true",
+        help="Send each window's worth of packets as one BATCH frame."
+    )
+    parser.add_argument("--host", "-H", required=False, default="127.0.0.1")
+    parser.add_argument("--port", "-p", required=False, type=int, default=16981)
+    parser.add_argument(
+        "--no-spawn", dest="spawn", required=False, action="store_false",
+        help="Load an overseer that is already running instead of starting one."
+    )
+    parser.add_argument(
+        "--backend", "-b", required=False, choices=("gevent", "asyncio"), default="gevent"
+    )
+    parser.add_argument("--workers", "-n", required=False, type=int, default=1)
+    parser.add_argument("--uvloop", required=False, action="store_true")
+    args = parser.parse_args()
+    commons.check_window_size(args.window)
+
+    with tempfile.TemporaryDirectory(prefix="raftel-bench-") as log_dir:
+        overseer = spawn_overseer(args, log_dir) if args.spawn else None
+        try:
+            report = asyncio.run(run_load(args))
+        finally:
+            if overseer is not None:
+                overseer.terminate()
+                overseer.wait()
+
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+if __name__ == "__main__":
+    main()
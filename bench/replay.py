@@ -0,0 +1,354 @@
+from argparse import ArgumentParser
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List, Optional
+
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+from capture import TraceRecord, TraceRecords
+from commons import UNICAST_COMMANDS, FrameDecoder, OverseerCommands, RPCPacket
+from load import READ_SIZE, STALL_TIMEOUT, wait_for_port
+
+import capture
+import commons
+
+"""
+Plays traces recorded with the overseer's --capture back against an overseer:
+every traced client logs in again, sends what it sent then and goes away when
+it did. Reports how long that took and how the overseer answered as JSON on
+stdout:
+
+    python bench/replay.py trace.bin > replay.json
+    python bench/replay.py trace.bin.0 trace.bin.1 --speed 0 > replay-max.json
+
+--speed 1 (the default) keeps the original pacing, 2 plays twice as fast and 0
+as fast as the overseer answers. Either way a client never has more packets in
+flight than --window, as the original nodes could not have either. Each client
+keeps its own order, but clients do not wait for one another, so the faster
+the replay the likelier a packet for a client that has just gone is NACKed.
+The traces of every worker of a sharded overseer can be given at once.
+
+Client ids come back the same when replaying against a fresh single-worker
+overseer, since clients log in in the same order. Otherwise the destinations
+of unicast packets are rewritten to the ids handed out this time.
+
+By default an overseer is started for the run (--backend picks which); pass
+--no-spawn to replay against one already listening on --port instead.
+"""
+
+# Records queued for one client before the rest of the trace waits for it.
+QUEUED_PER_CLIENT = 256 # type: int
+
+class ClientIds(object):
+    """
+    The ids clients had when traced and those handed out to them this time.
+    """
+
+    def __init__(self) -> None:
+        self.replayed = {} # type: Dict[int, int]
+        self.changed = False # type: bool
+
+    def add(self, traced_id: int, client_id: int) -> None:
+        self.replayed[traced_id] = client_id
+        self.changed = self.changed or traced_id != client_id
+
+    def remap(self, frame: bytes) -> bytes:
+        """
+        frame with the destination of a unicast packet changed from its
+        traced client id to the replayed one.
+        """
+        if not self.changed:
+            return frame
+        packet = RPCPacket.parse(frame)
+        if packet.command not in UNICAST_COMMANDS or not packet.additional_info:
+            return frame
+        target = self.replayed.get(packet.additional_info[0])
+        if target is None:
+            return frame
+        packet.additional_info[0] = target
+        version = frame[1] if frame[0] == commons.SOH else commons.PROTOCOL_V1
+        return packet.make_sendable_stream(version)
+
+class ReplayClient(object):
+    """
+    One traced client, speaking on its own connection from a task of its own,
+    so that a client waiting for its window does not hold up the others.
+    """
+
+    def __init__(self, traced_id: int, window_size: int, ids: ClientIds) -> None:
+        self.traced_id = traced_id # type: int
+        self.window_size = window_size # type: int
+        # Handed out by the overseer we replay against.
+        self.client_id = None # type: Optional[int]
+        self.ids = ids # type: ClientIds
+        # Records to replay, None for the end of the trace. Set whenever there
+        # are some, and drained once there is room for more.
+        self.records = deque() # type: Deque[Optional[TraceRecord]]
+        self.queued = asyncio.Event() # type: asyncio.Event
+        self.drained = asyncio.Event() # type: asyncio.Event
+        self.decoder = FrameDecoder() # type: FrameDecoder
+        self.reader = None # type: Optional[asyncio.StreamReader]
+        self.writer = None # type: Optional[asyncio.StreamWriter]
+        self.receiver = None # type: Optional[asyncio.Future]
+        self.in_flight = 0 # type: int
+        self.window_open = asyncio.Event() # type: asyncio.Event
+        self.sent = 0 # type: int
+        self.responses = 0 # type: int
+        self.nacks = 0 # type: int
+        self.relayed = 0 # type: int
+        self.stalls = 0 # type: int
+        self.skipped = 0 # type: int
+        self.error = None # type: Optional[str]
+
+    async def __read_frames(self) -> List[RPCPacket]:
+        while True:
+            packets = [RPCPacket.parse(frame) for frame in self.decoder.frames()]
+            if packets:
+                return packets
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                raise ConnectionError("Overseer closed the connection.")
+            self.decoder.feed(data)
+
+    def __handle(self, packet: RPCPacket) -> None:
+        if packet.command == OverseerCommands.BATCH:
+            # One answer for one BATCH sent, whatever it held.
+            for frame in commons.split_frames(packet.data):
+                if RPCPacket.parse(frame).command == OverseerCommands.NACK:
+                    self.nacks += 1
+        elif packet.command not in (OverseerCommands.ACK, OverseerCommands.NACK):
+            self.relayed += 1
+            return
+        elif packet.command == OverseerCommands.NACK:
+            self.nacks += 1
+        self.responses += 1
+        self.in_flight = max(0, self.in_flight - 1)
+        self.window_open.set()
+
+    async def __receive_forever(self) -> None:
+        while True:
+            for packet in await self.__read_frames():
+                self.__handle(packet)
+
+    async def login(self, host: str, port: int, frame: bytes) -> None:
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(frame)
+        packets = await self.__read_frames()
+        ack = packets[0]
+        if ack.command != OverseerCommands.ACK:
+            raise ConnectionError("LOGIN of %s refused: %s" % (self.traced_id, ack))
+        self.client_id = ack.additional_info[0]
+        self.ids.add(self.traced_id, self.client_id)
+        for packet in packets[1:]:
+            self.__handle(packet)
+        self.receiver = asyncio.ensure_future(self.__receive_forever())
+
+    async def send(self, frame: bytes) -> None:
+        while self.in_flight >= self.window_size:
+            self.window_open.clear()
+            try:
+                await asyncio.wait_for(self.window_open.wait(), STALL_TIMEOUT)
+            except asyncio.TimeoutError:
+                # Some responses may be dropped on purpose (see the
+                # overseer's backpressure policies); do not wait forever.
+                self.stalls += 1
+                self.in_flight = 0
+        if self.receiver.done():
+            raise ConnectionError("Overseer disconnected %s." % self.traced_id)
+        self.writer.write(frame)
+        self.in_flight += 1
+        self.sent += 1
+        if self.sent % self.window_size == 0:
+            await self.writer.drain()
+
+    async def settle(self) -> None:
+        """
+        Wait for the responses still outstanding.
+        """
+        deadline = time.monotonic() + STALL_TIMEOUT
+        while self.in_flight and not self.receiver.done() and time.monotonic() < deadline:
+            self.window_open.clear()
+            try:
+                await asyncio.wait_for(self.window_open.wait(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                self.stalls += 1
+
+    def close(self) -> None:
+        if self.receiver is not None:
+            self.receiver.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+    async def queue(self, record: Optional[TraceRecord]) -> None:
+        """
+        Hand a record to run(), waiting if too many are queued already.
+        """
+        while len(self.records) >= QUEUED_PER_CLIENT:
+            self.drained.clear()
+            await self.drained.wait()
+        self.records.append(record)
+        self.queued.set()
+
+    async def __next_record(self) -> Optional[TraceRecord]:
+        while not self.records:
+            self.queued.clear()
+            self.drained.set()
+            await self.queued.wait()
+        return self.records.popleft()
+
+    async def run(self) -> None:
+        """
+        Replay queued records until CLOSED, or None for the end of the trace.
+        """
+        try:
+            while True:
+                record = await self.__next_record()
+                if record is None or record.kind == TraceRecords.CLOSED:
+                    if self.receiver is not None:
+                        await self.settle()
+                    return
+                if self.error is not None:
+                    self.skipped += 1
+                    continue
+                try:
+                    await self.send(self.ids.remap(record.frame))
+                except (ConnectionError, OSError) as error:
+                    # Drain the rest of our records so the trace moves on.
+                    self.error = repr(error)
+                    self.skipped += 1
+        finally:
+            self.close()
+
+async def replay(records: Iterable[TraceRecord], args: Any) -> Dict[str, Any]:
+    await wait_for_port(args.host, args.port, 10)
+    ids = ClientIds()
+    clients = {} # type: Dict[int, ReplayClient]
+    finished = [] # type: List[ReplayClient]
+    tasks = [] # type: List[asyncio.Future]
+    first_at = None # type: Optional[int]
+    last_at = 0
+    started = time.monotonic()
+
+    for record in records:
+        if first_at is None:
+            first_at = record.at_us
+        last_at = record.at_us
+        if args.speed:
+            delay = started + (record.at_us - first_at) / 1e6 / args.speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        client = clients.get(record.client_id)
+        if client is None:
+            if record.kind == TraceRecords.CLOSED:
+                continue
+            client = ReplayClient(record.client_id, args.window, ids)
+            clients[record.client_id] = client
+            # Logged in one after the other, in their original order, so that
+            # a fresh overseer hands out the same ids.
+            try:
+                await client.login(args.host, args.port, record.frame)
+            except (ConnectionError, OSError) as error:
+                client.error = repr(error)
+            tasks.append(asyncio.ensure_future(client.run()))
+            continue
+        await client.queue(record)
+        if record.kind == TraceRecords.CLOSED:
+            finished.append(clients.pop(record.client_id))
+
+    for client in clients.values():
+        await client.queue(None)
+        finished.append(client)
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - started
+    sent = sum(client.sent for client in finished)
+    errors = [client.error for client in finished if client.error is not None]
+
+    return {
+        "suite": "replay",
+        "python": sys.version.split()[0],
+        "settings": {
+            "traces": args.traces,
+            "speed": args.speed,
+            "window": args.window,
+            "backend": args.backend if args.spawn else None,
+            "workers": args.workers if args.spawn else None,
+            "uvloop": args.uvloop
+        },
+        "trace_s": (last_at - first_at) / 1e6 if first_at is not None else 0.0,
+        "elapsed_s": elapsed,
+        "clients": len(finished),
+        "frames_sent": sent,
+        "frames_per_sec": sent / elapsed if elapsed else 0.0,
+        "responses": sum(client.responses for client in finished),
+        "nacks": sum(client.nacks for client in finished),
+        "relayed_received": sum(client.relayed for client in finished),
+        "stalls": sum(client.stalls for client in finished),
+        "ids_remapped": ids.changed,
+        "skipped": sum(client.skipped for client in finished),
+        "errors": errors[:10],
+        "error_count": len(errors)
+    }
+
+def spawn_overseer(args: Any, log_dir: str) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.setdefault("raftel_log_level", "30")
+    command = [
+        sys.executable, os.path.join(SRC_DIR, "overseer.py"),
+        "--port", str(args.port), "--backend", args.backend,
+        "--workers", str(args.workers), "--window", str(args.window)
+    ]
+    if args.uvloop:
+        command.append("--uvloop")
+    # The overseer logs to a file in its working directory.
+    return subprocess.Popen(command, cwd=log_dir, env=env)
+
+def main() -> None:
+    parser = ArgumentParser(description="Replay captured client traffic against a raftel overseer.")
+    parser.add_argument("traces", nargs="+", help="Traces written by the overseer's --capture.")
+    parser.add_argument(
+        "--speed", "-s", required=False, type=float, default=1.0,
+        help="Pace relative to the original traffic (0 for as fast as possible)."
+    )
+    parser.add_argument(
+        "--window", "-w", required=False, type=int, default=commons.DEFAULT_WINDOW_SIZE,
+        help="Packets each client may have in flight; the overseer's window."
+    )
+    parser.add_argument("--host", "-H", required=False, default="127.0.0.1")
+    parser.add_argument("--port", "-p", required=False, type=int, default=16981)
+    parser.add_argument(
+        "--no-spawn", dest="spawn", required=False, action="store_false",
+        help="Replay against an overseer that is already running instead of starting one."
+    )
+    parser.add_argument(
+        "--backend", "-b", required=False, choices=("gevent", "asyncio"), default="gevent"
+    )
+    parser.add_argument("--workers", "-n", required=False, type=int, default=1)
+    parser.add_argument("--uvloop", required=False, action="store_true")
+    args = parser.parse_args()
+    commons.check_window_size(args.window)
+    if args.speed < 0:
+        parser.error("--speed cannot be negative.")
+
+    with tempfile.TemporaryDirectory(prefix="raftel-bench-") as log_dir:
+        overseer = spawn_overseer(args, log_dir) if args.spawn else None
+        try:
+            report = asyncio.run(replay(capture.merge_traces(args.traces), args))
+        finally:
+            if overseer is not None:
+                overseer.terminate()
+                overseer.wait()
+
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+if __name__ == "__main__":
+    main()
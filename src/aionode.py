@@ -0,0 +1,296 @@
+from commons import FrameDecoder, OverseerCommands
+from metrics import MetricsServer
+from nodecore import NodeCore, NodeSession, NodeTransport, NotLeaderError, PeerLink
+from raftlog import RaftLog
+from typing import Any, Callable, List, Optional, cast
+
+import asyncio
+import commons
+import logging
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+"""
+asyncio backend for raftel nodes. Does not depend on gevent, so a node can run
+inside an existing event loop:
+
+    node = AsyncioRaftNode(10000, 30000)
+    await node.connect("127.0.0.1", 16981)
+    ...
+    node.close()
+"""
+
+logger = logging.getLogger("raftel-node")
+
+class AsyncioPeerLink(asyncio.Protocol, PeerLink):
+    """
+    Outbound direct connection to another node.
+    """
+
+    def __init__(self, session: NodeSession, peer_id: int) -> None:
+        self.session = session # type: NodeSession
+        self.peer_id = peer_id # type: int
+        self.transport = None # type: Optional[asyncio.Transport]
+        self.pending = [] # type: List[bytes]
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        # A stream connection's transport is always a full Transport.
+        self.transport = cast(asyncio.Transport, transport)
+        self.session.peer_connected(self.peer_id, self)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.session.peer_lost(self.peer_id, self)
+
+    def push(self, frame: bytes) -> None:
+        if not self.pending:
+            asyncio.get_event_loop().call_soon(self.__flush)
+        self.pending.append(frame)
+
+    def __flush(self) -> None:
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.writelines(self.pending)
+        self.pending = []
+
+    def close(self) -> None:
+        if self.transport is not None:
+            self.transport.close()
+
+class PeerProtocol(asyncio.BufferedProtocol):
+    """
+    Inbound direct connection from another node.
+    """
+
+    def __init__(self, session: NodeSession) -> None:
+        self.session = session # type: NodeSession
+        self.decoder = FrameDecoder() # type: FrameDecoder
+        self.transport = None # type: Optional[asyncio.BaseTransport]
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = transport
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.decoder.writable()
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self.decoder.commit(nbytes)
+        try:
+            self.session.receive_direct(self.decoder)
+        except ConnectionError as e:
+            logger.warning("Dropping direct connection: %s", e)
+            if self.transport is not None:
+                self.transport.close()
+
+class AsyncioRaftNode(asyncio.BufferedProtocol, NodeTransport):
+
+    def __init__(
+        self,
+        election_timeout: int,
+        wait_sleep: int =100,
+        window_size: int = commons.DEFAULT_WINDOW_SIZE,
+        log: Optional[RaftLog] = None,
+        heartbeat_interval: Optional[int] = None,
+        direct_host: Optional[str] = None,
+        metrics_port: Optional[int] = None,
+        **options
+    ) -> None:
+        """
+        See NodeCore for what the arguments mean. Any further options, such as
+        the state machine, are passed on to it.
+
+        With a direct_host, the node accepts connections from other nodes on
+        that address and exchanges Raft traffic with them directly, leaving
+        the overseer to introduce nodes to each other.
+
+        With a metrics_port, the node's metrics are served over HTTP on that
+        port of the loopback interface while it is connected.
+        """
+        self.decoder = FrameDecoder() # type: FrameDecoder
+        self.session = NodeSession(self, wait_sleep, window_size) # type: NodeSession
+        # Group 0, which every node hosts; see add_group() for more.
+        self.core = self.session.add_group(
+            0, election_timeout, log, heartbeat_interval, **options
+        ) # type: NodeCore
+        self.transport = None # type: Optional[asyncio.Transport]
+        self.loop = None # type: Optional[asyncio.AbstractEventLoop]
+        self.logged_in = None # type: Optional[asyncio.Future]
+        self.disconnected = None # type: Optional[asyncio.Future]
+        self.direct_host = direct_host # type: Optional[str]
+        self.peer_server = None # type: Optional[asyncio.AbstractServer]
+        self.metrics_server = None # type: Optional[MetricsServer]
+        if metrics_port is not None:
+            self.metrics_server = MetricsServer(self.session.metrics, metrics_port)
+
+    def send_frame(self, frame: bytes) -> None:
+        # The session already sends whatever it has within one event loop
+        # iteration as one frame.
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(frame)
+
+    def __event_loop(self) -> asyncio.AbstractEventLoop:
+        if self.loop is None:
+            raise RuntimeError("Node is not connected to the overseer.")
+        return self.loop
+
+    def call_later(self, delay_ms: int, callback: Callable[[], None]) -> asyncio.TimerHandle:
+        return self.__event_loop().call_later(delay_ms / 1000, callback)
+
+    def connect_peer(self, peer_id: int, host: str, port: int) -> None:
+        self.__event_loop().create_task(self.__connect_peer(peer_id, host, port))
+
+    async def __connect_peer(self, peer_id: int, host: str, port: int) -> None:
+        try:
+            await self.__event_loop().create_connection(lambda: AsyncioPeerLink(self.session, peer_id), host, port)
+        except OSError as e:
+            logger.info("Could not connect to peer %s: %s", peer_id, e)
+            self.session.peer_lost(peer_id, None)
+
+    def send(
+        self,
+        command: OverseerCommands,
+        additional_info: Optional[List[int]] = None,
+        data: bytes = b"",
+        group: int = 0
+    ) -> None:
+        self.session.send(command, additional_info, data, group)
+
+    def add_group(
+        self,
+        group: int,
+        election_timeout: int,
+        log: Optional[RaftLog] = None,
+        heartbeat_interval: Optional[int] = None,
+        **options
+    ) -> NodeCore:
+        """
+        Host another Raft group over the same connection; see NodeCore for
+        what the arguments mean.
+        """
+        return self.session.add_group(group, election_timeout, log, heartbeat_interval, **options)
+
+    def propose(
+        self,
+        data: bytes,
+        callback: Optional[Callable[[Any, Optional[Exception]], None]] = None,
+        group: int = 0
+    ) -> Optional[int]:
+        return self.session.groups[group].propose(data, callback)
+
+    async def submit(self, data: bytes, group: int = 0) -> Any:
+        """
+        Propose data to group and wait for it to be applied; returns what the state
+        machine made of it. Raises NotLeaderError on a node that is not the
+        leader, and CommandError for data the state machine cannot apply.
+        """
+        result = self.__event_loop().create_future() # type: asyncio.Future
+        def done(value: Any, error: Optional[Exception]) -> None:
+            if result.done():
+                return
+            if error is not None:
+                result.set_exception(error)
+            else:
+                result.set_result(value)
+        core = self.session.groups[group]
+        if core.propose(data, done) is None:
+            raise NotLeaderError(core.leader_id)
+        return await result
+
+    async def read_barrier(self, group: int = 0) -> None:
+        """
+        Wait until reading group's state machine is linearizable. Raises
+        NotLeaderError on a node that is not the leader.
+        """
+        result = self.__event_loop().create_future() # type: asyncio.Future
+        def done(error: Optional[Exception]) -> None:
+            if result.done():
+                return
+            if error is not None:
+                result.set_exception(error)
+            else:
+                result.set_result(None)
+        self.session.groups[group].read(done)
+        await result
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = cast(asyncio.Transport, transport)
+        self.send_frame(self.session.login_frame())
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.decoder.writable()
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self.decoder.commit(nbytes)
+        try:
+            self.session.receive(self.decoder)
+        except ConnectionError as e:
+            if self.logged_in is not None and not self.logged_in.done():
+                self.logged_in.set_exception(e)
+            if self.transport is not None:
+                self.transport.close()
+            return
+
+        if self.session.connected and self.logged_in is not None and not self.logged_in.done():
+            self.logged_in.set_result(self.session.raft_id)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.session.connection_lost()
+        if self.logged_in is not None and not self.logged_in.done():
+            self.logged_in.set_exception(
+                ConnectionError("Overseer closed the connection during LOGIN.")
+            )
+        if self.disconnected is not None and not self.disconnected.done():
+            self.disconnected.set_result(None)
+
+    async def connect(self, ip: str, port: int) -> int:
+        """
+        Connect and log in to the overseer. Returns our client id.
+        """
+        loop = asyncio.get_event_loop()
+        logged_in = loop.create_future() # type: asyncio.Future
+        self.loop = loop
+        self.logged_in = logged_in
+        self.disconnected = loop.create_future()
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        if self.direct_host is not None:
+            self.peer_server = await loop.create_server(
+                lambda: PeerProtocol(self.session), self.direct_host, 0
+            )
+            self.session.direct_address = (
+                self.direct_host, self.peer_server.sockets[0].getsockname()[1]
+            )
+        await loop.create_connection(lambda: self, ip, port)
+        return await logged_in
+
+    async def serve_forever(self) -> None:
+        """
+        Wait until the connection to the overseer goes away.
+        """
+        if self.disconnected is not None:
+            await self.disconnected
+
+    def close(self) -> None:
+        if self.transport is not None:
+            self.transport.close()
+        if self.peer_server is not None:
+            self.peer_server.close()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+
+def run(node: AsyncioRaftNode, ip: str, port: int, use_uvloop: bool = False) -> None:
+    """
+    Connect node and serve until disconnected on a fresh event loop,
+    optionally uvloop's.
+    """
+    if use_uvloop:
+        if uvloop is None:
+            raise RuntimeError("uvloop was requested but is not installed.")
+        uvloop.install()
+
+    async def main():
+        await node.connect(ip, port)
+        await node.serve_forever()
+
+    asyncio.run(main())
@@ -0,0 +1,321 @@
+from capture import PacketCapture
+from commons import FrameDecoder, RPCPacket
+from metrics import MetricsServer
+from overseercore import (
+    BackpressurePolicies, ClientSession, ClientTransport, OverseerCore, ShardLink,
+    DEFAULT_CLIENT_TIMEOUT, DEFAULT_OUTBOX_SIZE, LIVENESS_TICK_MS
+)
+from typing import List, Optional, cast
+
+import asyncio
+import capture
+import commons
+import logging
+import shards
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+"""
+asyncio backend for the Overseer. Unlike the gevent backend this does not
+monkey-patch anything, so an AsyncioOverseer can be started inside an existing
+event loop:
+
+    overseer = AsyncioOverseer(16981)
+    await overseer.start()
+    ...
+    overseer.close()
+"""
+
+logger = logging.getLogger("raftel-overseer")
+
+class OverseerProtocol(asyncio.BufferedProtocol, ClientTransport):
+    """
+    One client connection. Reads straight into the FrameDecoder's buffer and
+    writes everything queued within one event loop iteration in one go.
+
+    Backpressure follows asyncio flow control: frames are held back while the
+    transport has paused writing, up to outbox_size of them, after which the
+    policy applies. asyncio cannot make the sender wait, so BLOCK instead
+    stops reading from the slow client as soon as writing pauses, which stops
+    it from generating more replies; should relays from other clients still
+    fill its outbox, it is disconnected, as is a client whose outbox fills
+    with anything but keep-alive ACKs under DROP_KEEP_ALIVE.
+    """
+
+    def __init__(
+        self,
+        core: OverseerCore,
+        outbox_size: int = DEFAULT_OUTBOX_SIZE,
+        backpressure: BackpressurePolicies = BackpressurePolicies.BLOCK
+    ) -> None:
+        self.core = core # type: OverseerCore
+        self.outbox_size = outbox_size # type: int
+        self.backpressure = backpressure # type: BackpressurePolicies
+        self.decoder = FrameDecoder() # type: FrameDecoder
+        self.session = None # type: Optional[ClientSession]
+        self.transport = None # type: Optional[asyncio.Transport]
+        self.loop = None # type: Optional[asyncio.AbstractEventLoop]
+        self.pending = [] # type: List[bytes]
+        self.flush_scheduled = False # type: bool
+        self.writing_paused = False # type: bool
+        self.reading_paused = False # type: bool
+        self.closing = False # type: bool
+
+    @property
+    def clientid(self) -> int:
+        return self.session.clientid if self.session else -1
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        logger.info("connection RECV %s", transport.get_extra_info("peername"))
+        # A stream connection's transport is always a full Transport.
+        self.transport = cast(asyncio.Transport, transport)
+        self.loop = asyncio.get_event_loop()
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.decoder.writable()
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self.decoder.commit(nbytes)
+        session = self.session if self.session is not None else self.__login()
+        if session is not None:
+            session.receive(self.decoder)
+
+    def __login(self) -> Optional[ClientSession]:
+        login = self.core.login_frames(self.decoder, self)
+        if login is None:
+            return None
+        session, resp = login
+        self.push(resp)
+        if session is None:
+            self.close()
+        self.session = session
+        return session
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        logger.info("Connection to %s lost.", self.clientid)
+        if self.session is not None:
+            self.core.unregister(self.session)
+            self.session.closed = True
+
+    def pause_writing(self) -> None:
+        self.writing_paused = True
+        if (
+            self.backpressure == BackpressurePolicies.BLOCK and not self.reading_paused and
+            self.transport is not None
+        ):
+            self.reading_paused = True
+            self.transport.pause_reading()
+
+    def resume_writing(self) -> None:
+        self.writing_paused = False
+        if self.reading_paused and self.transport is not None:
+            self.reading_paused = False
+            self.transport.resume_reading()
+        self.__schedule_flush()
+
+    def push(self, frame: bytes, droppable: bool = False) -> bool:
+        if self.transport is None or self.transport.is_closing():
+            return False
+
+        if self.writing_paused and len(self.pending) >= self.outbox_size:
+            if self.backpressure == BackpressurePolicies.DROP_KEEP_ALIVE and droppable:
+                logger.debug("Outbox of %s full, dropping keep-alive ACK.", self.clientid)
+                return False
+            # Nothing can wait for room here.
+            logger.critical(
+                "Outbox of %s full (%s frames), disconnecting.", self.clientid, self.outbox_size
+            )
+            self.transport.abort()
+            return False
+
+        self.core.outbox_depth.observe(len(self.pending))
+        self.pending.append(frame)
+        self.__schedule_flush()
+        return True
+
+    def __schedule_flush(self) -> None:
+        if not self.flush_scheduled and self.loop is not None:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.__flush)
+
+    def __flush(self) -> None:
+        self.flush_scheduled = False
+        if self.transport is None or self.transport.is_closing():
+            return
+
+        if self.pending and not self.writing_paused:
+            self.transport.writelines(self.pending)
+            self.pending = []
+        if self.closing and not self.pending:
+            self.transport.close()
+
+    def close(self) -> None:
+        # Let whatever is queued (e.g. the LOGOUT ACK) go out first.
+        self.closing = True
+        if self.transport is not None:
+            self.__schedule_flush()
+
+class AsyncioShardLink(asyncio.Protocol, ShardLink):
+    """
+    Outbound link to another shard of this overseer.
+    """
+
+    def __init__(self, core: OverseerCore, shard: int) -> None:
+        self.core = core # type: OverseerCore
+        self.shard = shard # type: int
+        self.transport = None # type: Optional[asyncio.Transport]
+        self.lost = asyncio.get_event_loop().create_future() # type: asyncio.Future
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        logger.info("Linked to shard %s.", self.shard)
+        self.transport = cast(asyncio.Transport, transport)
+        self.core.shard_connected(self.shard, self)
+
+    def push(self, frame: bytes) -> None:
+        # Only ever pushed to once connected; see shard_connected().
+        if self.transport is not None:
+            self.transport.write(frame)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        logger.critical("Lost link to shard %s.", self.shard)
+        self.core.shard_lost(self.shard)
+        if not self.lost.done():
+            self.lost.set_result(None)
+
+class ShardProtocol(asyncio.BufferedProtocol):
+    """
+    Accepts frames forwarded by another shard of this overseer.
+    """
+
+    def __init__(self, core: OverseerCore) -> None:
+        self.core = core # type: OverseerCore
+        self.decoder = FrameDecoder() # type: FrameDecoder
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.decoder.writable()
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self.decoder.commit(nbytes)
+        for frame in self.decoder.frames():
+            self.core.handle_shard_packet(RPCPacket.parse(frame))
+
+class AsyncioOverseer(object):
+    """
+    The Overseer served by asyncio. Takes the same arguments as the gevent
+    OverSeerver.
+    """
+
+    def __init__(
+        self,
+        bind_port: int,
+        max_bad_transactions: int = 5,
+        window_size: int = commons.DEFAULT_WINDOW_SIZE,
+        outbox_size: int = DEFAULT_OUTBOX_SIZE,
+        backpressure: BackpressurePolicies = BackpressurePolicies.BLOCK,
+        client_timeout: int = DEFAULT_CLIENT_TIMEOUT,
+        shard_index: int = 0,
+        shard_count: int = 1,
+        shard_dir: Optional[str] = None,
+        host: str = "127.0.0.1",
+        metrics_port: Optional[int] = None,
+        capture_path: Optional[str] = None
+    ) -> None:
+        self.host = host # type: str
+        self.bind_port = bind_port # type: int
+        self.capture = None # type: Optional[PacketCapture]
+        if capture_path is not None:
+            self.capture = PacketCapture(
+                capture.shard_capture_path(capture_path, shard_index, shard_count)
+            )
+        self.core = OverseerCore(
+            max_bad_transactions, window_size, client_timeout, shard_index, shard_count,
+            capture=self.capture
+        ) # type: OverseerCore
+        self.outbox_size = outbox_size # type: int
+        self.backpressure = backpressure # type: BackpressurePolicies
+        self.shard_dir = shard_dir # type: Optional[str]
+        self.server = None # type: Optional[asyncio.AbstractServer]
+        self.shard_server = None # type: Optional[asyncio.AbstractServer]
+        self.reaper = None # type: Optional[asyncio.Task]
+        self.shard_linkers = [] # type: List[asyncio.Task]
+        self.metrics_server = None # type: Optional[MetricsServer]
+        if metrics_port is not None:
+            # Workers of a sharded overseer each serve their own numbers.
+            self.metrics_server = MetricsServer(self.core.metrics, metrics_port + shard_index)
+
+    def __make_protocol(self) -> OverseerProtocol:
+        return OverseerProtocol(self.core, self.outbox_size, self.backpressure)
+
+    async def __reap_forever(self) -> None:
+        while True:
+            await asyncio.sleep(LIVENESS_TICK_MS / 1000)
+            self.core.reap()
+
+    async def __link_forever(self, shard: int) -> None:
+        loop = asyncio.get_event_loop()
+        path = shards.shard_socket_path(self.shard_dir, shard)
+        while True:
+            try:
+                _, link = await loop.create_unix_connection(
+                    lambda: AsyncioShardLink(self.core, shard), path
+                )
+            except OSError:
+                await asyncio.sleep(shards.SHARD_RETRY_MS / 1000)
+                continue
+            await link.lost
+
+    async def start(self) -> asyncio.AbstractServer:
+        loop = asyncio.get_event_loop()
+        sharded = self.core.shard_count > 1
+        server = await loop.create_server(
+            self.__make_protocol, self.host, self.bind_port, reuse_port=sharded or None
+        )
+        self.server = server
+        self.reaper = loop.create_task(self.__reap_forever())
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        if sharded:
+            self.shard_server = await loop.create_unix_server(
+                lambda: ShardProtocol(self.core),
+                shards.shard_socket_path(self.shard_dir, self.core.shard_index)
+            )
+            self.shard_linkers = [
+                loop.create_task(self.__link_forever(shard))
+                for shard in range(self.core.shard_count) if shard != self.core.shard_index
+            ]
+        return server
+
+    async def serve_forever(self) -> None:
+        server = self.server if self.server is not None else await self.start()
+        try:
+            await server.serve_forever()
+        finally:
+            # Also flushes the capture when interrupted.
+            self.close()
+
+    def close(self) -> None:
+        if self.reaper is not None:
+            self.reaper.cancel()
+        for linker in self.shard_linkers:
+            linker.cancel()
+        if self.shard_server is not None:
+            self.shard_server.close()
+        if self.server is not None:
+            self.server.close()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        if self.capture is not None:
+            self.capture.close()
+
+def run(overseer: AsyncioOverseer, use_uvloop: bool = False) -> None:
+    """
+    Serve overseer forever on a fresh event loop, optionally uvloop's.
+    """
+    if use_uvloop:
+        if uvloop is None:
+            raise RuntimeError("uvloop was requested but is not installed.")
+        uvloop.install()
+    asyncio.run(overseer.serve_forever())
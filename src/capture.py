@@ -0,0 +1,126 @@
+from enum import Enum
+from typing import BinaryIO, Callable, Iterable, Iterator, NamedTuple
+
+import heapq
+import struct
+import time
+
+"""
+Binary traces of what clients sent an overseer, to be replayed later (see
+bench/replay.py). A trace is a header followed by one record per event:
+
+    header: <magic:8s><version:u8><started:u64>
+    record: <delta:u32><client id:u32><kind:u8><length:u32><frame>
+
+started is the wall-clock time the capture began, in nanoseconds since the
+epoch, and delta the microseconds since the previous record (or since
+started). FRAME records hold a frame exactly as received, LOGIN included, in
+whatever wire format the client spoke; a CLOSED record, without a frame, marks
+the client going away. Everything is big-endian, like the wire formats.
+"""
+
+TRACE_MAGIC = b"RAFTELTR" # type: bytes
+TRACE_VERSION = 1 # type: int
+TRACE_HEADER = struct.Struct("!8sBQ")
+RECORD_HEADER = struct.Struct("!IIBI")
+# Longer silences are recorded as this long.
+MAX_DELTA_US = 2 ** 32 - 1 # type: int
+# Frames are written out whenever this much has piled up, and on flush().
+CAPTURE_BUFFER_SIZE = 1 << 20 # type: int
+
+class TraceRecords(Enum):
+    FRAME = 0
+    CLOSED = 1
+
+# Looked up once rather than for every frame recorded.
+_FRAME = TraceRecords.FRAME.value # type: int
+_CLOSED = TraceRecords.CLOSED.value # type: int
+
+TraceRecord = NamedTuple("TraceRecord", [
+    ("at_us", int), ("client_id", int), ("kind", TraceRecords), ("frame", bytes)
+])
+
+class PacketCapture(object):
+    """
+    Appends the frames clients send to a trace file. Writes go through a
+    buffer, so recording a frame is a copy rather than a system call; flush()
+    regularly to bound what a crash loses.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        buffer_size: int = CAPTURE_BUFFER_SIZE,
+        clock: Callable[[], int] = time.monotonic_ns
+    ) -> None:
+        self.path = path # type: str
+        self.file = open(path, "wb", buffering=buffer_size) # type: BinaryIO
+        self.write = self.file.write # type: Callable[[bytes], int]
+        self.clock = clock # type: Callable[[], int]
+        self.last = clock() # type: int
+        self.file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, time.time_ns()))
+
+    def __record(self, client_id: int, kind: int, frame: bytes) -> None:
+        now = self.clock()
+        delta = (now - self.last) // 1000
+        if delta > MAX_DELTA_US:
+            delta = MAX_DELTA_US
+            self.last = now
+        else:
+            # Keep the remainder, so rounding errors do not add up.
+            self.last += delta * 1000
+        self.write(RECORD_HEADER.pack(delta, client_id, kind, len(frame)))
+        if frame:
+            self.write(frame)
+
+    def frame(self, client_id: int, frame: bytes) -> None:
+        self.__record(client_id, _FRAME, frame)
+
+    def closed(self, client_id: int) -> None:
+        self.__record(client_id, _CLOSED, b"")
+
+    def flush(self) -> None:
+        if not self.file.closed:
+            self.file.flush()
+
+    def close(self) -> None:
+        if not self.file.closed:
+            self.file.close()
+
+def read_trace(path: str) -> Iterator[TraceRecord]:
+    """
+    Every record of a trace, timed in microseconds since the epoch. A trace
+    cut short, say by a crash, ends at its last complete record.
+    """
+    with open(path, "rb") as trace:
+        header = trace.read(TRACE_HEADER.size)
+        if len(header) < TRACE_HEADER.size:
+            raise ValueError("%s is too short to be a trace." % path)
+        magic, version, started = TRACE_HEADER.unpack(header)
+        if magic != TRACE_MAGIC or version != TRACE_VERSION:
+            raise ValueError("%s is not a version %s trace." % (path, TRACE_VERSION))
+
+        at_us = started // 1000
+        while True:
+            record = trace.read(RECORD_HEADER.size)
+            if len(record) < RECORD_HEADER.size:
+                return
+            delta, client_id, kind, length = RECORD_HEADER.unpack(record)
+            frame = trace.read(length)
+            if len(frame) < length:
+                return
+            at_us += delta
+            yield TraceRecord(at_us, client_id, TraceRecords(kind), frame)
+
+def merge_traces(paths: Iterable[str]) -> Iterator[TraceRecord]:
+    """
+    The records of several traces, such as those of every worker of a sharded
+    overseer, in the order they happened.
+    """
+    return heapq.merge(*(read_trace(path) for path in paths), key=lambda record: record.at_us)
+
+def shard_capture_path(path: str, shard_index: int, shard_count: int) -> str:
+    """
+    Where a worker of a sharded overseer captures to: one trace per worker.
+    """
+    return path if shard_count == 1 else "%s.%s" % (path, shard_index)
@@ -1,27 +1,286 @@
 from enum import Enum
-from typing import List, Optional
+from typing import Dict, Iterator, List, Optional, Union
 
-import logging
-import os
+import socket
+import struct
 import sys
+import time
 
+SOH = 1 # type: int
 STX = 2 # type: int
 ETX = 3 # type: int
 RS = int("1E", 16) # type: int
+# v1 writes arguments as bare bytes between these, so no argument may be one.
+V1_FRAMING_BYTES = frozenset((STX, ETX, RS))
+
+PROTOCOL_V1 = 1 # type: int
+PROTOCOL_V2 = 2 # type: int
+PROTOCOL_V3 = 3 # type: int
+# Highest wire format this tree speaks. Offered by nodes at LOGIN.
+PROTOCOL_VERSION = PROTOCOL_V3 # type: int
+
+# v2 frames are length-prefixed instead of ETX-terminated:
+#
+#   <SOH><version><payload length:u32><packet number:u8><command:u8><payload>
+#
+# and the payload is <argc:u16><argc x i64 args><opaque data>. Starting with
+# SOH instead of STX keeps the two framings distinguishable byte for byte.
+#
+# v3 frames are v2 frames whose payload starts with the <group:u32> of the Raft
+# group the packet belongs to. v1 and v2 packets are all for group 0.
+V2_HEADER = struct.Struct("!BBIBB")
+V2_ARGC = struct.Struct("!H")
+V3_GROUP = struct.Struct("!I")
+_V2_ARGS = {} # type: Dict[int, struct.Struct]
+
+def v2_args_struct(argc: int) -> struct.Struct:
+    """
+    Precompiled struct for a v2 argument block of the given length.
+    """
+    packer = _V2_ARGS.get(argc)
+    if packer is None:
+        packer = struct.Struct("!H%dq" % argc)
+        _V2_ARGS[argc] = packer
+    return packer
+
+# Packet numbers are eight bits. A sliding window of outstanding packet numbers
+# must stay below half of that space to keep old and new numbers apart.
+DEFAULT_WINDOW_SIZE = 32 # type: int
+MAX_WINDOW_SIZE = 128 # type: int
+
+def check_window_size(window_size: int) -> None:
+    if not 1 <= window_size <= MAX_WINDOW_SIZE:
+        raise ValueError(
+            "Window size must be between 1 and %s, got %s." % (MAX_WINDOW_SIZE, window_size)
+        )
+
+def monotonic_millis() -> int:
+    return int(time.monotonic() * 1000)
+
+def host_to_int(host: str) -> int:
+    """
+    An IPv4 address as the unsigned integer nodes advertise it as.
+    """
+    return int.from_bytes(socket.inet_aton(host), "big")
+
+def int_to_host(address: int) -> str:
+    return socket.inet_ntoa(address.to_bytes(4, "big"))
+
+# Upper bound on frames handed to a single sendmsg call (POSIX IOV_MAX is at
+# least 16, Linux allows 1024).
+MAX_COALESCED_FRAMES = 1024 # type: int
+
+def send_frames(sock, frames: List[bytes]) -> None:
+    """
+    Write several frames with one scatter/gather syscall where possible,
+    falling back to sendall for whatever the kernel did not take.
+    """
+    sent = sock.sendmsg(frames)
+    total = sum(len(frame) for frame in frames)
+    if sent < total:
+        sock.sendall(b"".join(frames)[sent:])
+
+# Anything RPCPacket.parse accepts: a frame from FrameDecoder, raw bytes or a
+# plain list of byte values.
+PacketStream = Union[bytes, bytearray, memoryview, List[int]]
 
 class OverseerCommands(Enum):
     LOGIN = ord("A")
     LOGOUT = ord("B")
     KEEP_ALIVE = ord("C")
     REQUEST_VOTE = ord("D")
+    VOTE = ord("E")
+    APPEND_ENTRIES = ord("F")
+    APPEND_RESPONSE = ord("G")
+    HEARTBEAT = ord("H")
+    INSTALL_SNAPSHOT = ord("I")
+    PEER_UPDATE = ord("J")
+    JOIN_GROUP = ord("K")
+    HEARTBEATS = ord("L")
+    HEARTBEAT_REPLIES = ord("M")
+    STATS = ord("N")
+    BATCH = ord("O")
     INVALID_CMD = ord("X")
     MALFORMED_PKT = ord("Y")
     GENERAL_FAILURE = ord("Z")
     ACK = int("6", 16)
     NACK = int("15", 16)
 
+# How Raft commands propagate: broadcasts go to every other node, unicasts to
+# the node named by their first argument. See overseercore.
+BROADCAST_COMMANDS = frozenset((
+    OverseerCommands.REQUEST_VOTE, OverseerCommands.HEARTBEAT, OverseerCommands.HEARTBEATS
+))
+UNICAST_COMMANDS = frozenset((
+    OverseerCommands.VOTE, OverseerCommands.APPEND_ENTRIES, OverseerCommands.APPEND_RESPONSE,
+    OverseerCommands.INSTALL_SNAPSHOT, OverseerCommands.HEARTBEAT_REPLIES
+))
+
+# Largest frame FrameDecoder accepts, framing bytes included. Well above a
+# full AppendEntries batch or snapshot chunk; it bounds how far one header can
+# make a receive buffer grow.
+MAX_FRAME_SIZE = 16 * 1024 * 1024 # type: int
+
+class PacketError(ValueError):
+    """
+    A frame that cannot be made into a packet. Carries what to answer it with:
+    the NACK reason (INVALID_CMD for commands we do not know, MALFORMED_PKT
+    for anything else) and the packet number as far as it could be read.
+    """
+
+    def __init__(
+        self,
+        message: str,
+        packet_number: int,
+        reason: "OverseerCommands",
+        command: int = -1
+    ) -> None:
+        super(PacketError, self).__init__(message)
+        self.packet_number = packet_number # type: int
+        self.reason = reason # type: OverseerCommands
+        # The command byte of the frame, -1 if there was none.
+        self.command = command # type: int
+
+class FramingError(PacketError):
+    """
+    A stream FrameDecoder cannot find the next frame in. Nothing after it can
+    be read, so the connection has to go once the NACK is sent. version is
+    the framing to send that NACK in.
+    """
+
+    def __init__(self, message: str, packet_number: int, version: int, command: int = -1) -> None:
+        super(FramingError, self).__init__(message, packet_number, OverseerCommands.MALFORMED_PKT, command)
+        self.version = version # type: int
+
+class FrameDecoder(object):
+    """
+    Incremental decoder for the framed Overseer stream.
+
+    Bytes are received straight into a reusable bytearray (via recv_into) and
+    every complete frame buffered so far is handed out by frames(), without
+    sleeping and without rescanning bytes already inspected. Partial frames are
+    carried over to the next read.
+
+    Frames are yielded as memoryview slices of the receive buffer. They are
+    only valid until the next call to recv_from or feed; copy them with bytes()
+    if they need to live longer than that.
+
+    A frame of an unknown version, or longer than max_frame_size, raises
+    FramingError.
+    """
+
+    def __init__(self, buffer_size: int = 4096, max_frame_size: int = MAX_FRAME_SIZE) -> None:
+        self.max_frame_size = max_frame_size # type: int
+        self.buffer = bytearray(buffer_size) # type: bytearray
+        self.view = memoryview(self.buffer) # type: memoryview
+        # Unconsumed data lives in buffer[start:end]. Everything before scan
+        # is known not to contain a frame terminator.
+        self.start = 0 # type: int
+        self.end = 0 # type: int
+        self.scan = 0 # type: int
+
+    def __make_room(self, wanted: int = 1) -> None:
+        """
+        Ensure there are at least `wanted` free bytes at the tail of the
+        buffer, compacting unconsumed data to the front and growing the buffer
+        only when a single frame outgrows it.
+        """
+        pending = self.end - self.start
+        if self.start:
+            self.view[0:pending] = self.view[self.start:self.end]
+            self.scan -= self.start
+            self.start = 0
+            self.end = pending
+
+        if len(self.buffer) - self.end < wanted:
+            # Never resize in place: previously yielded frames may still hold
+            # exports of the old buffer.
+            grown = bytearray(max(len(self.buffer) * 2, pending + wanted))
+            grown[0:pending] = self.view[0:pending]
+            self.buffer = grown
+            self.view = memoryview(grown)
+
+    def writable(self) -> memoryview:
+        """
+        The free tail of the receive buffer, for transports that read into a
+        caller-supplied buffer (like asyncio.BufferedProtocol). Report how much
+        was written into it with commit().
+        """
+        if self.start == self.end:
+            self.start = self.end = self.scan = 0
+        elif self.end == len(self.buffer):
+            self.__make_room()
+        return self.view[self.end:]
+
+    def commit(self, size: int) -> None:
+        self.end += size
+
+    def recv_from(self, sock) -> int:
+        """
+        Receive whatever is available on `sock` into the buffer. Returns the
+        number of bytes read; 0 means the peer closed the connection.
+        """
+        read = sock.recv_into(self.writable())
+        self.commit(read)
+        return read
+
+    def feed(self, data: bytes) -> None:
+        """
+        Append already-received bytes, for transports that do not expose a
+        socket.
+        """
+        if len(self.buffer) - self.end < len(data):
+            self.__make_room(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def frames(self) -> Iterator[memoryview]:
+        """
+        Yield every complete frame currently buffered, framing bytes included.
+        v1 and v2 frames may be freely interleaved.
+        """
+        while self.start < self.end:
+            if self.buffer[self.start] == SOH:
+                if self.end - self.start < V2_HEADER.size:
+                    return
+
+                _, version, length, packet_number, command = V2_HEADER.unpack_from(self.buffer, self.start)
+                if version not in (PROTOCOL_V2, PROTOCOL_V3):
+                    raise FramingError(
+                        "Unsupported frame version %s." % version, packet_number, PROTOCOL_V2, command
+                    )
+                size = V2_HEADER.size + length
+                if size > self.max_frame_size:
+                    raise FramingError(
+                        "Frame of %s bytes is over the limit of %s." % (size, self.max_frame_size),
+                        packet_number, version, command
+                    )
+                frame_end = self.start + size
+                if frame_end > self.end:
+                    return
+            else:
+                etx_index = self.buffer.find(ETX, self.scan, self.end)
+                if etx_index < 0:
+                    self.scan = self.end
+                    if self.end - self.start > self.max_frame_size:
+                        packet_number = self.buffer[self.start + 1]
+                        raise FramingError(
+                            "No end to a v1 frame within %s bytes." % self.max_frame_size,
+                            packet_number, PROTOCOL_V1
+                        )
+                    return
+                frame_end = etx_index + 1
+
+            frame = self.view[self.start:frame_end]
+            self.start = self.scan = frame_end
+            yield frame
+
 class RPCPacket(object):
 
+    # Packets are created for every frame on the wire, so keep them compact and
+    # free of per-instance setup.
+    __slots__ = ("packet_number", "command", "additional_info", "data", "group")
+
     # Specifically tailored for **dictionary usage. Please don't leave them be
     # except possibly additional_info.
     def __init__(
@@ -29,32 +288,33 @@ class RPCPacket(object):
         packet_number: int = -1,
         command: Optional[OverseerCommands] = None,
         additional_info: Optional[List[int]] = None,
-        logger_name: str = "raftel-commons"
+        data: bytes = b"",
+        group: int = 0
     ) -> None:
         if packet_number < 0 or command is None:
             raise ValueError("Please set the initial fields of RPCPacket properly.")
         self.packet_number = packet_number # type: int
         self.command = command # type: OverseerCommands
         self.additional_info = additional_info if additional_info else [] # type: List[int]
-
-        self.logger = logging.getLogger(logger_name)
-
-        if logger_name == "raftel-commons":
-            formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-            stream_handler = logging.StreamHandler()
-            stream_handler.setFormatter(formatter)
-
-            self.logger.addHandler(stream_handler)
-
-        self.logger.debug("RPCPacket debug: %s %s" % (self.packet_number, type(self.packet_number)))
-        self.logger.debug("RPCPacket debug: %s %s" % (self.command.value, type(self.command.value)))
-        self.logger.debug("RPCPacket debug: %s %s" % (self.additional_info, type(self.additional_info)))
+        # Opaque trailing payload. Only representable in v2 frames and later.
+        self.data = data # type: bytes
+        # The Raft group this packet is for. Only representable in v3 frames.
+        self.group = group # type: int
 
     def validate(self) -> bool:
-        return 0 <= self.packet_number <= 256
+        return 0 <= self.packet_number < 256
+
+    def fits_v1(self) -> bool:
+        """
+        Whether v1 can carry this packet: no data, group 0, and arguments that
+        are single bytes other than the framing bytes.
+        """
+        return not self.data and not self.group and all(
+            0 <= arg < 256 and arg not in V1_FRAMING_BYTES for arg in self.additional_info
+        )
 
     @staticmethod
-    def validate_stream(packet_stream: List[int]) -> bool:
+    def validate_stream(packet_stream: PacketStream) -> bool:
         return RPCPacket.parse(packet_stream).validate()
 
     # TODO Refactor as this is almost the same as parse method below.
@@ -78,13 +338,63 @@ class RPCPacket(object):
         return additional_info
 
     @staticmethod
-    def parse(packet_stream: List[int], logger_name="raftel-commons") -> "RPCPacket":
-        logger = logging.getLogger(logger_name)
-        logger.setLevel(int(os.environ.get("raftel_log_level", logging.INFO)))
+    def parse(packet_stream: PacketStream) -> "RPCPacket":
+        """
+        Parse a single frame, detecting whether it is a v1 or v2 frame. Raises
+        PacketError if it is neither.
+        """
+        if packet_stream[0] == SOH:
+            return RPCPacket.__parse_v2(packet_stream)
+        return RPCPacket.__parse_v1(packet_stream)
+
+    @staticmethod
+    def __command(command: int, packet_number: int) -> OverseerCommands:
+        try:
+            return OverseerCommands(command)
+        except ValueError:
+            raise PacketError(
+                "Unknown command %s." % command, packet_number % 256, OverseerCommands.INVALID_CMD, command
+            )
+
+    @staticmethod
+    def __parse_v2(packet_stream: PacketStream) -> "RPCPacket":
+        if not isinstance(packet_stream, (bytes, bytearray, memoryview)):
+            packet_stream = bytes(packet_stream)
+
+        if len(packet_stream) < V2_HEADER.size:
+            raise PacketError("Truncated v2 header.", 0, OverseerCommands.MALFORMED_PKT)
+        _, version, length, packet_number, command = V2_HEADER.unpack_from(packet_stream)
+        if version not in (PROTOCOL_V2, PROTOCOL_V3) or V2_HEADER.size + length != len(packet_stream):
+            raise PacketError(
+                "Bad v2 header %s." % ((version, length),), packet_number,
+                OverseerCommands.MALFORMED_PKT, command
+            )
+
+        try:
+            offset = V2_HEADER.size
+            group = 0
+            if version == PROTOCOL_V3:
+                group = V3_GROUP.unpack_from(packet_stream, offset)[0]
+                offset += V3_GROUP.size
+            argc = V2_ARGC.unpack_from(packet_stream, offset)[0]
+            args_struct = v2_args_struct(argc)
+            args = args_struct.unpack_from(packet_stream, offset)
+        except struct.error as e:
+            raise PacketError(
+                "Truncated v2 frame: %s" % e, packet_number, OverseerCommands.MALFORMED_PKT, command
+            )
+
+        return RPCPacket(
+            packet_number, RPCPacket.__command(command, packet_number), list(args[1:]),
+            data=bytes(packet_stream[offset + args_struct.size:]), group=group
+        )
+
+    @staticmethod
+    def __parse_v1(packet_stream: PacketStream) -> "RPCPacket":
         byte_acc = [] # type: list
 
         packet_order = ("packet_number", "command", "additional_info")
-        packet_kwargs = {"logger_name": logger_name}
+        packet_kwargs = {} # type: dict
         field_index = 0
 
         # Automagically ignore STX and ETX
@@ -92,7 +402,6 @@ class RPCPacket(object):
         limit = len(packet_stream) - 1
 
         while i < limit:
-            logger.debug("inspecting: %s" % packet_stream[i])
             if packet_stream[i] == RS and field_index < 2:
                 packet_kwargs[packet_order[field_index]] = int.from_bytes(bytes(byte_acc), sys.byteorder)
                 byte_acc = []
@@ -101,18 +410,32 @@ class RPCPacket(object):
                 byte_acc.append(packet_stream[i])
             i += 1
 
-        logger.debug("field index is %s" % field_index)
         if field_index == 2:
             packet_kwargs["additional_info"] = RPCPacket.__parse_additional_info(byte_acc)
         else:
             packet_kwargs[packet_order[field_index]] = int.from_bytes(bytes(byte_acc), sys.byteorder)
 
-        packet_kwargs["command"] = OverseerCommands(packet_kwargs["command"])
-        logger.debug("Calling RPCPacket for parsed stream")
-        parsed_packet = RPCPacket(**packet_kwargs)
-        return parsed_packet
+        packet_number = packet_kwargs["packet_number"]
+        if "command" not in packet_kwargs:
+            raise PacketError(
+                "v1 frame without a command.", packet_number % 256, OverseerCommands.MALFORMED_PKT
+            )
+        packet_kwargs["command"] = RPCPacket.__command(packet_kwargs["command"], packet_number)
+        return RPCPacket(**packet_kwargs)
+
+    def make_sendable_stream(self, version: int = PROTOCOL_V1) -> bytes:
+        """
+        Encode this packet in the given wire format. v1 can only carry
+        packets for which fits_v1() holds; use v2 for anything else, and v3
+        for packets of any group but 0.
+        """
+        if version in (PROTOCOL_V2, PROTOCOL_V3):
+            return self.__make_v2_stream(version)
+        elif version != PROTOCOL_V1:
+            raise ValueError("Unknown protocol version %s." % version)
+        elif not self.fits_v1():
+            raise ValueError("v1 cannot carry %s." % self)
 
-    def make_sendable_stream(self) -> bytes:
         partial_packet = [
             STX, self.packet_number, RS, self.command.value
         ] # type: List[int]
@@ -125,5 +448,86 @@ class RPCPacket(object):
 
         return bytes(partial_packet)
 
+    def __make_v2_stream(self, version: int) -> bytes:
+        argc = len(self.additional_info)
+        try:
+            args = v2_args_struct(argc).pack(argc, *self.additional_info)
+        except struct.error as e:
+            raise ValueError("Cannot encode arguments %s: %s" % (self.additional_info, e))
+
+        length = len(args) + len(self.data)
+        if version == PROTOCOL_V2:
+            if self.group:
+                raise ValueError("v2 packets cannot carry a group.")
+            header = V2_HEADER.pack(SOH, version, length, self.packet_number, self.command.value)
+            return b"".join((header, args, self.data))
+
+        header = V2_HEADER.pack(
+            SOH, version, length + V3_GROUP.size, self.packet_number, self.command.value
+        )
+        return b"".join((header, V3_GROUP.pack(self.group), args, self.data))
+
     def __str__(self):
-        return str(self.make_sendable_stream())
+        if self.group:
+            return "RPCPacket(%s, %s, %s, %s bytes of data, group %s)" % (
+                self.packet_number, self.command.name, self.additional_info, len(self.data),
+                self.group
+            )
+        return "RPCPacket(%s, %s, %s, %s bytes of data)" % (
+            self.packet_number, self.command.name, self.additional_info, len(self.data)
+        )
+
+
+NACK_REASONS = (
+    OverseerCommands.INVALID_CMD,
+    OverseerCommands.MALFORMED_PKT,
+    OverseerCommands.GENERAL_FAILURE
+)
+
+def _encode_responses(version: int) -> tuple:
+    acks = tuple(
+        RPCPacket(packet_number, OverseerCommands.ACK).make_sendable_stream(version)
+        for packet_number in range(256)
+    )
+    nacks = {
+        reason: tuple(
+            RPCPacket(packet_number, OverseerCommands.NACK, [reason.value]).make_sendable_stream(version)
+            for packet_number in range(256)
+        ) for reason in NACK_REASONS
+    }
+    return (acks, nacks)
+
+# Fully encoded ACK/NACK frames for every packet number, per wire format. Most
+# replies carry nothing else, so they can be served without allocating.
+_RESPONSE_FRAMES = {
+    version: _encode_responses(version) for version in (PROTOCOL_V1, PROTOCOL_V2, PROTOCOL_V3)
+} # type: Dict[int, tuple]
+
+def ack_frame(packet_number: int, version: int = PROTOCOL_V1) -> bytes:
+    return _RESPONSE_FRAMES[version][0][packet_number]
+
+def nack_frame(packet_number: int, reason: OverseerCommands, version: int = PROTOCOL_V1) -> bytes:
+    return _RESPONSE_FRAMES[version][1][reason][packet_number]
+
+def batch_frame(frames: List[bytes], version: int) -> bytes:
+    """
+    Several frames sent as one BATCH, which only v2 and later can carry.
+    """
+    return RPCPacket(0, OverseerCommands.BATCH, data=b"".join(frames)).make_sendable_stream(version)
+
+def split_frames(data: bytes) -> Iterator[memoryview]:
+    """
+    The frames packed back to back in the data of a BATCH. Raises ValueError
+    on reaching anything that is not a whole v2 or later frame.
+    """
+    view = memoryview(data)
+    offset = 0
+    end = len(view)
+    while offset < end:
+        if view[offset] != SOH or end - offset < V2_HEADER.size:
+            raise ValueError("Batched frame at byte %s is not a v2 frame." % offset)
+        frame_end = offset + V2_HEADER.size + V2_HEADER.unpack_from(view, offset)[2]
+        if frame_end > end:
+            raise ValueError("Batched frame at byte %s is truncated." % offset)
+        yield view[offset:frame_end]
+        offset = frame_end
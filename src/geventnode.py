@@ -0,0 +1,232 @@
+from commons import FrameDecoder, OverseerCommands
+from gevent import Greenlet
+from gevent.event import AsyncResult
+from gevent.queue import Queue
+from gevent.server import StreamServer
+from gevent.socket import SocketType
+from metrics import MetricsServer
+from nodecore import NodeCore, NodeSession, NodeStates, NodeTransport, NotLeaderError, PeerLink
+from raftlog import RaftLog
+from typing import Any, Callable, List, Optional
+
+import commons
+import gevent
+import logging
+
+"""
+gevent backend for raftel nodes. The node protocol lives in nodecore; see
+aionode for the asyncio equivalent, and raftnode for the command line running
+either.
+"""
+
+logger = logging.getLogger("raftel-node")
+
+class GeventTimer(object):
+    """
+    A one-shot event loop timer, cancellable like asyncio's TimerHandle.
+    """
+
+    def __init__(self, delay_ms: int, callback: Callable[[], None]) -> None:
+        self.watcher = gevent.get_hub().loop.timer(delay_ms / 1000)
+        self.watcher.start(callback)
+
+    def cancel(self) -> None:
+        self.watcher.stop()
+
+class GeventPeerLink(Greenlet, PeerLink):
+    """
+    Outbound direct connection to another node. Makes one attempt to connect
+    and reports the outcome to the node, which decides whether to try again.
+    """
+
+    def __init__(self, session: NodeSession, peer_id: int, host: str, port: int) -> None:
+        Greenlet.__init__(self)
+        self.session = session # type: NodeSession
+        self.peer_id = peer_id # type: int
+        self.address = (host, port)
+        self.outbox = Queue() # type: Queue
+
+    def push(self, frame: bytes) -> None:
+        self.outbox.put_nowait(frame)
+
+    def close(self) -> None:
+        self.kill(block=False)
+
+    def _run(self):
+        sock = SocketType()
+        try:
+            sock.connect(self.address)
+        except OSError as e:
+            logger.info("Could not connect to peer %s: %s", self.peer_id, e)
+            sock.close()
+            self.session.peer_lost(self.peer_id, None)
+            return
+
+        self.session.peer_connected(self.peer_id, self)
+        try:
+            while True:
+                frames = [self.outbox.get()]
+                while len(frames) < commons.MAX_COALESCED_FRAMES and not self.outbox.empty():
+                    frames.append(self.outbox.get_nowait())
+                commons.send_frames(sock, frames)
+        except OSError:
+            self.session.peer_lost(self.peer_id, self)
+        finally:
+            sock.close()
+
+class RaftNode(NodeTransport):
+
+    def __init__(
+        self,
+        election_timeout: int,
+        wait_sleep: int =100,
+        window_size: int = commons.DEFAULT_WINDOW_SIZE,
+        log: Optional[RaftLog] = None,
+        heartbeat_interval: Optional[int] = None,
+        direct_host: Optional[str] = None,
+        metrics_port: Optional[int] = None,
+        **options
+    ) -> None:
+        """
+        See NodeCore for what the arguments mean. Any further options, such as
+        the state machine, are passed on to it.
+
+        With a direct_host, the node accepts connections from other nodes on
+        that address and exchanges Raft traffic with them directly, leaving
+        the overseer to introduce nodes to each other.
+
+        With a metrics_port, the node's metrics are served over HTTP on that
+        port of the loopback interface while it is connected.
+        """
+        self.sock = SocketType()
+        self.decoder = FrameDecoder() # type: FrameDecoder
+        self.session = NodeSession(self, wait_sleep, window_size) # type: NodeSession
+        # Group 0, which every node hosts; see add_group() for more.
+        self.core = self.session.add_group(
+            0, election_timeout, log, heartbeat_interval, **options
+        ) # type: NodeCore
+        # Frames for the overseer, written by a dedicated greenlet. NodeCore
+        # sends from timer callbacks, which run in the hub and cannot block.
+        self.outbox = Queue() # type: Queue
+        self.writer = None # type: Optional[gevent.Greenlet]
+        self.direct_host = direct_host # type: Optional[str]
+        self.peer_server = None # type: Optional[StreamServer]
+        self.metrics_server = None # type: Optional[MetricsServer]
+        if metrics_port is not None:
+            self.metrics_server = MetricsServer(self.session.metrics, metrics_port)
+
+    def send_frame(self, frame: bytes) -> None:
+        self.outbox.put_nowait(frame)
+
+    def call_later(self, delay_ms: int, callback: Callable[[], None]) -> GeventTimer:
+        return GeventTimer(delay_ms, callback)
+
+    def connect_peer(self, peer_id: int, host: str, port: int) -> None:
+        GeventPeerLink(self.session, peer_id, host, port).start()
+
+    def __serve_peer(self, peer_socket: SocketType, address) -> None:
+        decoder = FrameDecoder()
+        try:
+            while decoder.recv_from(peer_socket):
+                self.session.receive_direct(decoder)
+        except ConnectionError as e:
+            logger.warning("Dropping direct connection: %s", e)
+
+    def send(
+        self,
+        command: OverseerCommands,
+        additional_info: Optional[List[int]] = None,
+        data: bytes = b"",
+        group: int = 0
+    ) -> None:
+        self.session.send(command, additional_info, data, group)
+
+    def add_group(
+        self,
+        group: int,
+        election_timeout: int,
+        log: Optional[RaftLog] = None,
+        heartbeat_interval: Optional[int] = None,
+        **options
+    ) -> NodeCore:
+        """
+        Host another Raft group over the same connection; see NodeCore for
+        what the arguments mean.
+        """
+        return self.session.add_group(group, election_timeout, log, heartbeat_interval, **options)
+
+    def propose(
+        self,
+        data: bytes,
+        callback: Optional[Callable[[Any, Optional[Exception]], None]] = None,
+        group: int = 0
+    ) -> Optional[int]:
+        return self.session.groups[group].propose(data, callback)
+
+    def submit(self, data: bytes, group: int = 0) -> Any:
+        """
+        Propose data to group and block until it is applied; returns what the state
+        machine made of it. Raises NotLeaderError on a node that is not the
+        leader, and CommandError for data the state machine cannot apply.
+        """
+        result = AsyncResult()
+        def done(value: Any, error: Optional[Exception]) -> None:
+            if error is not None:
+                result.set_exception(error)
+            else:
+                result.set(value)
+        core = self.session.groups[group]
+        if core.propose(data, done) is None:
+            raise NotLeaderError(core.leader_id)
+        return result.get()
+
+    def read_barrier(self, group: int = 0) -> None:
+        """
+        Block until reading group's state machine is linearizable. Raises
+        NotLeaderError on a node that is not the leader.
+        """
+        result = AsyncResult()
+        def done(error: Optional[Exception]) -> None:
+            if error is not None:
+                result.set_exception(error)
+            else:
+                result.set(None)
+        self.session.groups[group].read(done)
+        result.get()
+
+    def __write_forever(self) -> None:
+        while True:
+            frames = [self.outbox.get()]
+            while len(frames) < commons.MAX_COALESCED_FRAMES and not self.outbox.empty():
+                frames.append(self.outbox.get_nowait())
+            commons.send_frames(self.sock, frames)
+
+    def connect(self, ip: str, port: int) -> None:
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        if self.direct_host is not None:
+            self.peer_server = StreamServer((self.direct_host, 0), self.__serve_peer)
+            self.peer_server.start()
+            self.session.direct_address = (self.direct_host, self.peer_server.server_port)
+        self.sock.connect((ip, port))
+        self.writer = gevent.spawn(self.__write_forever)
+        self.send_frame(self.session.login_frame())
+        while not self.session.connected:
+            if not self.decoder.recv_from(self.sock):
+                raise ConnectionError("Overseer closed the connection during LOGIN.")
+            self.session.receive(self.decoder)
+
+    def serve_forever(self) -> None:
+        try:
+            while True:
+                self.session.receive(self.decoder)
+                if not self.decoder.recv_from(self.sock):
+                    break
+        finally:
+            self.session.connection_lost()
+            if self.writer is not None:
+                self.writer.kill()
+            if self.peer_server is not None:
+                self.peer_server.stop()
+            if self.metrics_server is not None:
+                self.metrics_server.close()
@@ -0,0 +1,320 @@
+from capture import PacketCapture
+from commons import FrameDecoder, RPCPacket
+from gevent import Greenlet
+from gevent.queue import Queue
+from gevent.server import StreamServer
+from metrics import Histogram, MetricsServer
+from overseercore import (
+    BackpressurePolicies, ClientSession, ClientTransport, OverseerCore, ShardLink,
+    DEFAULT_CLIENT_TIMEOUT, DEFAULT_OUTBOX_SIZE, LIVENESS_TICK_MS
+)
+from typing import List, Optional, Tuple
+
+import capture
+import commons
+import gevent
+import logging
+import shards
+import socket
+
+"""
+gevent backend for the Overseer. The protocol itself is described and
+implemented in overseercore; this module only moves bytes between sockets and
+an OverseerCore. See aiooverseer for the asyncio equivalent, and overseer for
+the command line serving either.
+"""
+
+logger = logging.getLogger("raftel-overseer")
+
+class ClientHandler(Greenlet, ClientTransport):
+
+    def __init__(
+        self,
+        client_socket: gevent._socket3.socket,
+        decoder: Optional[FrameDecoder] = None,
+        outbox_size: int = DEFAULT_OUTBOX_SIZE,
+        backpressure: Optional[BackpressurePolicies] = None,
+        outbox_depth: Optional[Histogram] = None
+    ) -> None:
+        Greenlet.__init__(self)
+        self.client_socket = client_socket
+        # Hand-off from the overseer so that anything the client pipelined
+        # behind its LOGIN is not lost.
+        self.decoder = decoder if decoder else FrameDecoder() # type: FrameDecoder
+        # Set by the overseer once the client has logged in.
+        self.session = None # type: Optional[ClientSession]
+        # Everything sent to this client, replies and relayed frames alike.
+        # Drained by a dedicated writer so that neither this handler nor other
+        # handlers relaying to us wait on our socket, up to outbox_size frames.
+        self.outbox = Queue(maxsize=outbox_size) # type: Queue
+        self.backpressure = (
+            backpressure if backpressure else BackpressurePolicies.BLOCK
+        ) # type: BackpressurePolicies
+        self.closing = False # type: bool
+        self.outbox_depth = outbox_depth # type: Optional[Histogram]
+
+    @property
+    def clientid(self) -> int:
+        return self.session.clientid if self.session else -1
+
+    def push(self, frame: bytes, droppable: bool = False) -> bool:
+        if self.outbox_depth is not None:
+            self.outbox_depth.observe(self.outbox.qsize())
+        if not self.outbox.full() or self.backpressure == BackpressurePolicies.BLOCK:
+            self.outbox.put(frame)
+            return True
+        elif self.backpressure == BackpressurePolicies.DROP_KEEP_ALIVE:
+            if droppable:
+                logger.debug("Outbox of %s full, dropping keep-alive ACK.", self.clientid)
+                return False
+            self.outbox.put(frame)
+            return True
+
+        logger.critical(
+            "Outbox of %s full (%s frames), disconnecting.", self.clientid, self.outbox.maxsize
+        )
+        self.kill(block=False)
+        return False
+
+    def close(self) -> None:
+        # Stop reading; _run flushes the outbox on its way out. Someone else
+        # closing us (e.g. the liveness reaper) must interrupt a blocked read.
+        self.closing = True
+        if gevent.getcurrent() is not self:
+            self.kill(block=False)
+
+    def __drain(self) -> List[bytes]:
+        frames = [] # type: List[bytes]
+        while len(frames) < commons.MAX_COALESCED_FRAMES and not self.outbox.empty():
+            frames.append(self.outbox.get_nowait())
+        return frames
+
+    def __write_forever(self) -> None:
+        while True:
+            # Block for the first frame, then take whatever else piled up in
+            # the meantime and send it all in one go.
+            frames = [self.outbox.get()]
+            frames.extend(self.__drain())
+            commons.send_frames(self.client_socket, frames)
+
+    def _run(self):
+        writer = gevent.spawn(self.__write_forever)
+        try:
+            # Serve whatever is already buffered before blocking on the socket.
+            while self.session.receive(self.decoder) and not self.closing:
+                logger.debug("Reading from socket...")
+                if not self.decoder.recv_from(self.client_socket):
+                    logger.critical("Received nothing from socket %s, breaking read loop...", self.client_socket)
+                    break
+        finally:
+            writer.kill()
+            try:
+                frames = self.__drain()
+                if frames:
+                    commons.send_frames(self.client_socket, frames)
+            except OSError:
+                pass
+
+class GeventShardLink(Greenlet, ShardLink):
+    """
+    Outbound link to another shard of this overseer. Keeps trying to connect
+    until that shard is up, and again whenever the connection breaks.
+    """
+
+    def __init__(self, core: OverseerCore, shard: int, path: str) -> None:
+        Greenlet.__init__(self)
+        self.core = core # type: OverseerCore
+        self.shard = shard # type: int
+        self.path = path # type: str
+        self.outbox = Queue() # type: Queue
+
+    def push(self, frame: bytes) -> None:
+        self.outbox.put_nowait(frame)
+
+    def __connect(self) -> socket.socket:
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                return sock
+            except OSError:
+                sock.close()
+                gevent.sleep(shards.SHARD_RETRY_MS / 1000)
+
+    def _run(self):
+        while True:
+            sock = self.__connect()
+            logger.info("Linked to shard %s.", self.shard)
+            # Anything queued while disconnected was meant for clients whose
+            # state may have moved on; start afresh.
+            self.outbox = Queue()
+            self.core.shard_connected(self.shard, self)
+            try:
+                while True:
+                    frames = [self.outbox.get()]
+                    while len(frames) < commons.MAX_COALESCED_FRAMES and not self.outbox.empty():
+                        frames.append(self.outbox.get_nowait())
+                    commons.send_frames(sock, frames)
+            except OSError:
+                logger.critical("Lost link to shard %s.", self.shard)
+                self.core.shard_lost(self.shard)
+            finally:
+                sock.close()
+
+class ShardServer(StreamServer):
+    """
+    Accepts frames forwarded by the other shards of this overseer.
+    """
+
+    def __init__(self, core: OverseerCore, path: str) -> None:
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(128)
+        super(ShardServer, self).__init__(listener)
+        self.core = core # type: OverseerCore
+
+    def handle(self, shard_socket, address):
+        decoder = FrameDecoder()
+        while decoder.recv_from(shard_socket):
+            for frame in decoder.frames():
+                self.core.handle_shard_packet(RPCPacket.parse(frame))
+
+class OverSeerver(StreamServer):
+    """
+    The Overseer facilitates a whole distributed cluster. Nodes of a cluster
+    only need to sign up to the Overseer and it will facilitate communication
+    with the rest of the cluster.
+
+    Note that even if it was written with Raft in mind, this can also be used
+    for other cluster set-ups. All you need to do is change the Greenlet spun
+    up for each new client.
+
+    When shard_count is more than 1, this is one of that many worker processes
+    sharing bind_port (see shards); shard_dir is where the workers find each
+    other.
+
+    With a metrics_port, the overseer's metrics are served over HTTP on the
+    loopback interface, each worker of a sharded overseer on metrics_port plus
+    its shard index.
+
+    With a capture_path, every frame clients send is recorded to a trace there
+    (one per worker, suffixed with its shard index, when sharded) for
+    bench/replay.py to play back.
+    """
+
+    def __init__(
+        self,
+        bind_port: int,
+        max_bad_transactions: int = 5,
+        window_size: int = commons.DEFAULT_WINDOW_SIZE,
+        outbox_size: int = DEFAULT_OUTBOX_SIZE,
+        backpressure: BackpressurePolicies = BackpressurePolicies.BLOCK,
+        client_timeout: int = DEFAULT_CLIENT_TIMEOUT,
+        shard_index: int = 0,
+        shard_count: int = 1,
+        shard_dir: Optional[str] = None,
+        metrics_port: Optional[int] = None,
+        capture_path: Optional[str] = None,
+        **kwargs
+    ) -> None:
+        if shard_count > 1:
+            listener = shards.reuseport_socket("127.0.0.1", bind_port)
+            super(OverSeerver, self).__init__(listener)
+        else:
+            super(OverSeerver, self).__init__(("127.0.0.1", bind_port))
+        self.capture = None # type: Optional[PacketCapture]
+        if capture_path is not None:
+            self.capture = PacketCapture(
+                capture.shard_capture_path(capture_path, shard_index, shard_count)
+            )
+        self.core = OverseerCore(
+            max_bad_transactions, window_size, client_timeout, shard_index, shard_count,
+            capture=self.capture
+        ) # type: OverseerCore
+        self.outbox_size = outbox_size
+        self.backpressure = backpressure
+        self.reaper = None # type: Optional[Greenlet]
+        self.shard_dir = shard_dir # type: Optional[str]
+        self.shard_server = None # type: Optional[ShardServer]
+        self.shard_links = [] # type: List[GeventShardLink]
+        self.metrics_server = None # type: Optional[MetricsServer]
+        if metrics_port is not None:
+            self.metrics_server = MetricsServer(self.core.metrics, metrics_port + shard_index)
+
+    def __reap_forever(self) -> None:
+        while True:
+            gevent.sleep(LIVENESS_TICK_MS / 1000)
+            self.core.reap()
+
+    def start(self):
+        super(OverSeerver, self).start()
+        self.reaper = gevent.spawn(self.__reap_forever)
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        if self.core.shard_count > 1:
+            self.shard_server = ShardServer(
+                self.core, shards.shard_socket_path(self.shard_dir, self.core.shard_index)
+            )
+            self.shard_server.start()
+            for shard in range(self.core.shard_count):
+                if shard != self.core.shard_index:
+                    link = GeventShardLink(
+                        self.core, shard, shards.shard_socket_path(self.shard_dir, shard)
+                    )
+                    link.start()
+                    self.shard_links.append(link)
+
+    def stop(self, *args, **kwargs):
+        if self.reaper is not None:
+            self.reaper.kill()
+        gevent.killall(self.shard_links)
+        if self.shard_server is not None:
+            self.shard_server.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        super(OverSeerver, self).stop(*args, **kwargs)
+        if self.capture is not None:
+            self.capture.close()
+
+    def __read_login(
+        self,
+        client_socket: gevent._socket3.socket,
+        decoder: FrameDecoder,
+        ch: ClientHandler
+    ) -> Optional[Tuple[Optional[ClientSession], bytes]]:
+        while True:
+            login = self.core.login_frames(decoder, ch)
+            if login is not None:
+                return login
+
+            if not decoder.recv_from(client_socket):
+                logger.critical("Client pinged but did not complete initial handshake.")
+                return None
+
+    def handle(self, client_socket: gevent._socket3.socket, address):
+        logger.info("connection RECV %s", client_socket)
+        decoder = FrameDecoder()
+        ch = ClientHandler(
+            client_socket, decoder=decoder, outbox_size=self.outbox_size,
+            backpressure=self.backpressure, outbox_depth=self.core.outbox_depth
+        )
+        login = self.__read_login(client_socket, decoder, ch)
+        if login is None:
+            return
+
+        session, resp = login
+        client_socket.sendall(resp)
+        if session is None:
+            return
+
+        ch.session = session
+        logger.info("Spawning greenlet for %s", client_socket)
+        ch.start()
+        try:
+            ch.join()
+        finally:
+            self.core.unregister(session)
+        gevent.sleep()
+        logger.info("Killing greenlet %s", client_socket)
+        ch.kill()
+        logger.info("Greenlet %s dead", client_socket)
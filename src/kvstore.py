@@ -0,0 +1,89 @@
+from enum import Enum
+from statemachine import CommandError, StateMachine
+from typing import Dict, Optional, Tuple
+
+import struct
+
+"""
+A replicated, in-memory key-value store. Writes go through the Raft log as
+commands built by put_command() and delete_command(); reads are served by
+get() on any node that has confirmed it is up to date (see NodeCore.read()).
+
+Commands are <op:u8><key length:u32><key><value>. Snapshots are <count:u64>
+followed by <key length:u32><value length:u32><key><value> per pair.
+"""
+
+KV_COMMAND = struct.Struct("!BI")
+KV_SNAPSHOT_COUNT = struct.Struct("!Q")
+KV_SNAPSHOT_PAIR = struct.Struct("!II")
+
+class KVOps(Enum):
+    PUT = 1
+    DELETE = 2
+
+def put_command(key: bytes, value: bytes) -> bytes:
+    return KV_COMMAND.pack(KVOps.PUT.value, len(key)) + key + value
+
+def delete_command(key: bytes) -> bytes:
+    return KV_COMMAND.pack(KVOps.DELETE.value, len(key)) + key
+
+def parse_command(command: bytes) -> Tuple[KVOps, bytes, bytes]:
+    """
+    Returns the operation, key and value of a command. Raises CommandError if
+    it is not one put_command() or delete_command() could have built.
+    """
+    if len(command) < KV_COMMAND.size:
+        raise CommandError("Key-value command of %s bytes is too short." % len(command))
+    op, key_length = KV_COMMAND.unpack_from(command)
+    key_end = KV_COMMAND.size + key_length
+    if key_end > len(command):
+        raise CommandError("Key-value command is too short for its key of %s bytes." % key_length)
+    if op == KVOps.PUT.value:
+        return (KVOps.PUT, bytes(command[KV_COMMAND.size:key_end]), bytes(command[key_end:]))
+    elif op == KVOps.DELETE.value:
+        return (KVOps.DELETE, bytes(command[KV_COMMAND.size:key_end]), b"")
+    raise CommandError("Unknown key-value operation %s." % op)
+
+class KVStore(StateMachine):
+
+    def __init__(self) -> None:
+        self.data = {} # type: Dict[bytes, bytes]
+
+    def get(self, key: bytes) -> Optional[bytes]:
+        return self.data.get(key)
+
+    def check(self, command: bytes) -> None:
+        parse_command(command)
+
+    def apply(self, index: int, command: bytes) -> Optional[bytes]:
+        """
+        Returns the value the key had before the command.
+        """
+        op, key, value = parse_command(command)
+        if op == KVOps.PUT:
+            previous = self.data.get(key)
+            self.data[key] = value
+            return previous
+        return self.data.pop(key, None)
+
+    def snapshot(self) -> bytes:
+        parts = [KV_SNAPSHOT_COUNT.pack(len(self.data))]
+        for key, value in self.data.items():
+            parts.append(KV_SNAPSHOT_PAIR.pack(len(key), len(value)))
+            parts.append(key)
+            parts.append(value)
+        return b"".join(parts)
+
+    def restore(self, data: bytes) -> None:
+        self.data = {}
+        if not len(data):
+            return
+        count, = KV_SNAPSHOT_COUNT.unpack_from(data)
+        offset = KV_SNAPSHOT_COUNT.size
+        for _ in range(count):
+            key_length, value_length = KV_SNAPSHOT_PAIR.unpack_from(data, offset)
+            offset += KV_SNAPSHOT_PAIR.size
+            key = bytes(data[offset:offset + key_length])
+            offset += key_length
+            self.data[key] = bytes(data[offset:offset + value_length])
+            offset += value_length
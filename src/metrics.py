@@ -0,0 +1,279 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.handlers import QueueHandler, QueueListener
+from typing import Callable, Dict, List, Optional, TypeVar, Union
+
+import functools
+import logging
+import queue
+import threading
+
+"""
+Numbers about a running overseer or node, cheap enough to update for every
+packet. Each OverseerCore and NodeSession keeps a MetricsRegistry of its own:
+counters, optionally broken down by one label (the command, the NACK reason),
+histograms over power-of-two buckets, and gauges read when rendered. The
+rendering is the Prometheus text format, so the same text answers the STATS
+command and a MetricsServer's HTTP requests.
+
+Individual packets are logged at DEBUG to child loggers of their own (see
+PACKET_LOGGER_SUFFIX) through a PacketLog, which only hands the logger one in
+every so many of them; log_off_thread() moves formatting and writing every
+record to a background thread.
+"""
+
+# Bucket i of a histogram counts the values whose bit length is i, that is
+# those below 2 ** i and, but for bucket 0, at least 2 ** (i - 1).
+HISTOGRAM_BUCKETS = 48 # type: int
+# Appended to a component's logger name for its per-packet logger.
+PACKET_LOGGER_SUFFIX = ".packets" # type: str
+DEFAULT_PACKET_LOG_EVERY = 100 # type: int
+
+Number = Union[int, float]
+
+class Counter(object):
+    """
+    A count that only goes up, optionally broken down by the value of one
+    label.
+    """
+
+    def __init__(self, name: str, description: str, label: Optional[str] = None) -> None:
+        self.name = name # type: str
+        self.description = description # type: str
+        self.label = label # type: Optional[str]
+        self.values = {} # type: Dict[str, int]
+
+    def inc(self, label_value: str = "", amount: int = 1) -> None:
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    @property
+    def total(self) -> int:
+        return sum(self.values.values())
+
+    def render(self) -> List[str]:
+        if self.label is None:
+            return ["%s %s" % (self.name, self.values.get("", 0))]
+        # Copied first: rendering may happen on another thread.
+        return [
+            '%s{%s="%s"} %s' % (self.name, self.label, value, count)
+            for value, count in sorted(list(self.values.items()))
+        ]
+
+class Histogram(object):
+    """
+    Distribution of non-negative integer observations, to within a factor of
+    two.
+    """
+
+    def __init__(self, name: str, description: str) -> None:
+        self.name = name # type: str
+        self.description = description # type: str
+        self.count = 0 # type: int
+        self.total = 0 # type: int
+        self.maximum = 0 # type: int
+        self.buckets = [0] * HISTOGRAM_BUCKETS # type: List[int]
+
+    def observe(self, value: int) -> None:
+        self.count += 1
+        self.total += value
+        if value > self.maximum:
+            self.maximum = value
+        bucket = value.bit_length()
+        self.buckets[bucket if bucket < HISTOGRAM_BUCKETS else HISTOGRAM_BUCKETS - 1] += 1
+
+    def percentile(self, fraction: float) -> int:
+        """
+        An upper bound on the given percentile (0.99 for p99), exact to
+        within a factor of two.
+        """
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min((1 << bucket) - 1, self.maximum)
+        return self.maximum
+
+    def render(self) -> List[str]:
+        buckets = list(self.buckets)
+        lines = [] # type: List[str]
+        seen = 0
+        for bucket, count in enumerate(buckets):
+            seen += count
+            lines.append('%s_bucket{le="%s"} %s' % (self.name, (1 << bucket) - 1, seen))
+            if seen == self.count:
+                break
+        lines.append('%s_bucket{le="+Inf"} %s' % (self.name, self.count))
+        lines.append("%s_sum %s" % (self.name, self.total))
+        lines.append("%s_count %s" % (self.name, self.count))
+        return lines
+
+class Gauge(object):
+    """
+    A value read from its owner whenever the metrics are rendered.
+    """
+
+    def __init__(self, name: str, description: str, read: Callable[[], Number]) -> None:
+        self.name = name # type: str
+        self.description = description # type: str
+        self.read = read # type: Callable[[], Number]
+
+    def render(self) -> List[str]:
+        return ["%s %s" % (self.name, self.read())]
+
+Metric = Union[Counter, Histogram, Gauge]
+AnyMetric = TypeVar("AnyMetric", Counter, Histogram, Gauge)
+
+class MetricsRegistry(object):
+    """
+    Every metric of one overseer or node, their names all starting with
+    prefix. Hot paths should hold on to the metrics they update rather than
+    look them up each time.
+    """
+
+    def __init__(self, prefix: str) -> None:
+        self.prefix = prefix # type: str
+        self.metrics = {} # type: Dict[str, Metric]
+
+    def __register(self, metric: AnyMetric) -> AnyMetric:
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            if not isinstance(existing, type(metric)):
+                raise ValueError("Metric %s is already a %s." % (metric.name, type(existing).__name__))
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, description: str, label: Optional[str] = None) -> Counter:
+        return self.__register(Counter(self.prefix + "_" + name, description, label))
+
+    def histogram(self, name: str, description: str) -> Histogram:
+        return self.__register(Histogram(self.prefix + "_" + name, description))
+
+    def gauge(self, name: str, description: str, read: Callable[[], Number]) -> Gauge:
+        return self.__register(Gauge(self.prefix + "_" + name, description, read))
+
+    def render(self) -> str:
+        lines = [] # type: List[str]
+        for name, metric in sorted(list(self.metrics.items())):
+            kind = {Counter: "counter", Histogram: "histogram", Gauge: "gauge"}[type(metric)]
+            lines.append("# HELP %s %s" % (name, metric.description))
+            lines.append("# TYPE %s %s" % (name, kind))
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def __init__(self, *args, registry: MetricsRegistry, **kwargs) -> None:
+        # Before the base class, which handles the request there and then.
+        self.registry = registry # type: MetricsRegistry
+        super(MetricsRequestHandler, self).__init__(*args, **kwargs)
+
+    def do_GET(self) -> None:
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        # Scrapes are not worth a line each in the log.
+        pass
+
+class MetricsServer(object):
+    """
+    Serves a registry's metrics as text over HTTP, on any path, from a
+    thread of its own. Binds to the loopback interface unless told
+    otherwise; there is no authentication.
+    """
+
+    def __init__(self, registry: MetricsRegistry, port: int, host: str = "127.0.0.1") -> None:
+        self.registry = registry # type: MetricsRegistry
+        self.host = host # type: str
+        self.port = port # type: int
+        self.server = None # type: Optional[ThreadingHTTPServer]
+        self.thread = None # type: Optional[threading.Thread]
+
+    def start(self) -> None:
+        self.server = ThreadingHTTPServer(
+            (self.host, self.port), functools.partial(MetricsRequestHandler, registry=self.registry)
+        )
+        self.server.daemon_threads = True
+        # Port 0 picks a free one.
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name="raftel-metrics", daemon=True
+        )
+        self.thread.start()
+
+    def close(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+class PacketLog(object):
+    """
+    The per-packet logger of a component. Packets are sampled before the
+    logger is involved at all, so the ones not logged (all of them unless
+    the logger is enabled for DEBUG) never cost a LogRecord.
+    """
+
+    def __init__(self, name: str, every: int = DEFAULT_PACKET_LOG_EVERY) -> None:
+        self.logger = logging.getLogger(name + PACKET_LOGGER_SUFFIX) # type: logging.Logger
+        # Log one packet in every this many; 0 for none.
+        self.every = every # type: int
+        self.seen = 0 # type: int
+
+    def log(self, message: str, *args) -> None:
+        if not self.every or not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        self.seen += 1
+        if self.seen < self.every:
+            return
+        self.seen = 0
+        self.logger.debug(message, *args)
+
+_PACKET_LOGS = {} # type: Dict[str, PacketLog]
+
+def packet_log(name: str) -> PacketLog:
+    """
+    The PacketLog of the component logging to the logger called name.
+    """
+    log = _PACKET_LOGS.get(name)
+    if log is None:
+        log = _PACKET_LOGS[name] = PacketLog(name)
+    return log
+
+def sample_packets(logger: logging.Logger, every: int) -> None:
+    """
+    Log only one in every `every` packets (0 for none) through the
+    per-packet logger of logger.
+    """
+    packet_log(logger.name).every = every
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Queues records as they are, leaving even the formatting of their message
+    to the listener's thread. Fine within one process as long as nothing
+    logged is modified afterwards, which holds for packets once sent or
+    received.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+def log_off_thread(logger: logging.Logger) -> QueueListener:
+    """
+    Hand logger's records to its current handlers on a background thread
+    instead of the caller's. Returns the listener, already started; stop it
+    to flush what is still queued.
+    """
+    handlers = list(logger.handlers)
+    for handler in handlers:
+        logger.removeHandler(handler)
+    records = queue.SimpleQueue() # type: queue.SimpleQueue
+    logger.addHandler(DeferredQueueHandler(records))
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
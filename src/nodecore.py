@@ -0,0 +1,1505 @@
+from collections import OrderedDict, deque
+from commons import BROADCAST_COMMANDS, UNICAST_COMMANDS, FrameDecoder, FramingError, RPCPacket, OverseerCommands
+from enum import Enum
+from metrics import MetricsRegistry
+from raftlog import GroupCommitter, LogEntry, RaftLog
+from snapshot import Snapshot, SnapshotStore, SnapshotWriter
+from statemachine import CommandError, NullStateMachine, StateMachine
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+import commons
+import logging
+import metrics
+import random
+import struct
+import time
+
+logger = logging.getLogger("raftel-node")
+# Every packet in and out, sampled; see metrics.
+packet_log = metrics.packet_log("raftel-node")
+
+# Limits on one APPEND_ENTRIES frame, and on how many of them a leader keeps
+# unanswered per follower.
+MAX_BATCH_ENTRIES = 1024 # type: int
+MAX_BATCH_BYTES = 1024 * 1024 # type: int
+MAX_BATCHES_IN_FLIGHT = 8 # type: int
+# Heartbeats a follower may leave in-flight batches unanswered for before the
+# leader assumes they were lost and resends from its last known match. The
+# overseer relays reliably, so this is a last resort rather than a
+# retransmission timer: resending too eagerly only adds to the load that made
+# the answers late.
+MAX_STALLED_HEARTBEATS = 16 # type: int
+# Applied entries a node lets its log grow by before taking a snapshot and
+# compacting the log behind it.
+DEFAULT_SNAPSHOT_THRESHOLD = 100000 # type: int
+SNAPSHOT_CHUNK_SIZE = 256 * 1024 # type: int
+# How long a node waits before redialling a peer it lost its direct
+# connection to, for as long as the overseer still lists that peer.
+PEER_RETRY_MS = 250 # type: int
+# Fraction of election_timeout a leader lease gives up to allow for clocks
+# running at different rates on different nodes.
+LEASE_CLOCK_DRIFT = 0.1 # type: float
+# Frames queued to go out as one BATCH add up to at most this much, so that
+# the BATCH stays within the frame size the overseer accepts.
+MAX_QUEUED_BYTES = (
+    commons.MAX_FRAME_SIZE - commons.V2_HEADER.size - commons.V3_GROUP.size - commons.V2_ARGC.size
+) # type: int
+
+# <term><length> before each entry's data in an APPEND_ENTRIES payload.
+ENTRY_PREFIX = struct.Struct("!QI")
+
+class NodeStates(Enum):
+    FOLLOWER = 0
+    CANDIDATE = 1
+    LEADER = 2
+
+class AppendOutcomes(Enum):
+    REJECTED = 0
+    ACCEPTED = 1
+    HEARTBEAT = 2
+    SNAPSHOT_CHUNK = 3
+
+def pack_entries(entries: List[LogEntry]) -> bytes:
+    parts = [] # type: List[bytes]
+    for entry in entries:
+        parts.append(ENTRY_PREFIX.pack(entry.term, len(entry.data)))
+        parts.append(entry.data)
+    return b"".join(parts)
+
+def unpack_entries(data: bytes) -> List[Tuple[int, bytes]]:
+    """
+    The (term, data) pairs packed by pack_entries.
+    """
+    entries = [] # type: List[Tuple[int, bytes]]
+    offset = 0
+    while offset < len(data):
+        term, length = ENTRY_PREFIX.unpack_from(data, offset)
+        offset += ENTRY_PREFIX.size
+        entries.append((term, data[offset:offset + length]))
+        offset += length
+    return entries
+
+def nack_reason(nack: RPCPacket) -> str:
+    reason = nack.additional_info[0] if nack.additional_info else 0
+    try:
+        return OverseerCommands(reason).name
+    except ValueError:
+        return str(reason)
+
+class NotLeaderError(Exception):
+    """
+    The node asked to propose or read is not (or no longer) the leader.
+    leader_id is who it believes leads instead, if anyone.
+    """
+
+    def __init__(self, leader_id: Optional[int]) -> None:
+        super(NotLeaderError, self).__init__("Not the leader; the leader is %s." % leader_id)
+        self.leader_id = leader_id # type: Optional[int]
+
+class PendingRead(object):
+    """
+    A linearizable read waiting for the leader to confirm its leadership.
+    """
+
+    def __init__(self, heartbeat_round: int, callback: Callable[[Optional[Exception]], None]) -> None:
+        # Answered once a quorum has acknowledged this heartbeat round, which
+        # was not sent before the read arrived.
+        self.heartbeat_round = heartbeat_round # type: int
+        self.callback = callback
+        # The commit index the read must wait to be applied, fixed once the
+        # leader has committed an entry of its own term.
+        self.read_index = None # type: Optional[int]
+
+class FollowerProgress(object):
+    """
+    What a leader knows of one follower's log.
+    """
+
+    def __init__(self, next_index: int) -> None:
+        # The next entry to send; batches are sent ahead of their answers, so
+        # this runs ahead of what the follower has acknowledged.
+        self.next_index = next_index # type: int
+        # The last entry known to match the leader's log.
+        self.match_index = 0 # type: int
+        self.batches_in_flight = 0 # type: int
+        self.stalled_heartbeats = 0 # type: int
+        # Set while the follower is behind our log and catches up from a
+        # snapshot instead: the snapshot and how much of it has been sent.
+        self.snapshot = None # type: Optional[Snapshot]
+        self.snapshot_offset = 0 # type: int
+        self.snapshot_sent = False # type: bool
+        # The latest heartbeat round this follower answered.
+        self.heartbeat_round = 0 # type: int
+
+    def forget_snapshot(self) -> None:
+        self.snapshot = None
+        self.snapshot_offset = 0
+        self.snapshot_sent = False
+
+class PeerLink(object):
+    """
+    The backend-specific, outbound half of a direct connection to another
+    node. Inbound connections are only ever read from.
+    """
+
+    def push(self, frame: bytes) -> None:
+        """
+        Queue an encoded frame for the peer. Must not block.
+        """
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        raise NotImplementedError()
+
+class NodeTransport(object):
+    """
+    The backend-specific side of a node: how frames reach the overseer and how
+    timers are scheduled. Backends (gevent, asyncio) implement this and leave
+    the protocol itself to NodeCore.
+    """
+
+    def send_frame(self, frame: bytes) -> None:
+        """
+        Queue an encoded frame for the overseer. Must not block: NodeCore calls
+        this from timer callbacks too.
+        """
+        raise NotImplementedError()
+
+    def call_later(self, delay_ms: int, callback: Callable[[], None]) -> Any:
+        """
+        Run callback once after delay_ms. Returns a handle with a cancel()
+        method.
+        """
+        raise NotImplementedError()
+
+    def connect_peer(self, peer_id: int, host: str, port: int) -> None:
+        """
+        Start connecting to another node, then report back through
+        NodeSession.peer_connected() or NodeSession.peer_lost(). Only needed
+        by backends that set NodeSession.direct_address. Must not block.
+        """
+        raise NotImplementedError()
+
+    def now_millis(self) -> int:
+        """
+        The clock timers and leases are measured against, in milliseconds.
+        Only ever compared with itself, so it need not be the wall clock;
+        simulations substitute a virtual one.
+        """
+        return commons.monotonic_millis()
+
+class NodeSession(object):
+    """
+    A node's connection to the overseer, shared by every Raft group the node
+    hosts (see NodeCore): log-in, the window of packets in flight,
+    keep-alives and, in direct mode, the connections to other nodes. Backends
+    feed it whatever they read from the overseer through receive() and tell
+    it when the connection is lost; it answers through its NodeTransport.
+    """
+
+    def __init__(
+        self,
+        transport: NodeTransport,
+        wait_sleep: int = 100,
+        window_size: int = commons.DEFAULT_WINDOW_SIZE
+    ) -> None:
+        """
+        wait_sleep is the time, in milliseconds, this node sleeps between
+        sending a keep alive to the RPC Overseer.
+
+        window_size is how many packets this node keeps in flight to the
+        overseer before holding further packets back.
+        """
+        commons.check_window_size(window_size)
+        self.transport = transport # type: NodeTransport
+        self.wait_sleep = wait_sleep # type: int
+        self.window_size = window_size # type: int
+        self.raft_id = -1 # type: int
+        self.protocol_version = commons.PROTOCOL_V1 # type: int
+        self.connected = False # type: bool
+        self.last_transaction = transport.now_millis() # type: int
+        # Where election timeouts are drawn from; simulations seed it to be
+        # repeatable.
+        self.random = random.Random() # type: random.Random
+        # Armed once logged in. Keep-alives go out after wait_sleep without
+        # any response from the overseer.
+        self.keep_alive_timer = None # type: Any
+        self.next_packet_number = 1 # type: int
+        # Sent but not yet ACKed/NACKed, by packet number. Insertion order is
+        # send order, so the first key is the oldest outstanding packet.
+        self.in_flight = OrderedDict() # type: OrderedDict
+        # Commands held back while the window is full, in send order.
+        self.backlog = deque() # type: Deque[Tuple[OverseerCommands, Optional[List[int]], bytes, int]]
+
+        # Every Raft group hosted here, by group id.
+        self.groups = {} # type: Dict[int, NodeCore]
+        # Heartbeats of the groups we lead, as (group, arguments), waiting to
+        # go out together.
+        self.queued_heartbeats = [] # type: List[Tuple[int, List[int]]]
+        # Frames transmitted within this event loop iteration, waiting to go
+        # out together as one BATCH (v2 and later).
+        self.queued_frames = [] # type: List[bytes]
+        self.queued_packet_numbers = [] # type: List[int]
+        self.queued_bytes = 0 # type: int
+        # Packet numbers of each BATCH sent and not answered yet, oldest
+        # first. The overseer answers batches in the order they were sent.
+        self.sent_batches = deque() # type: Deque[List[int]]
+
+        # Set by backends that accept direct connections from other nodes,
+        # before logging in: the (host, port) they listen on.
+        self.direct_address = None # type: Optional[Tuple[str, int]]
+        # Direct mode only: every other node as the overseer lists it, as
+        # (host, port) with port 0 for nodes only reachable through the
+        # overseer, and our direct connections to them.
+        self.peers = {} # type: Dict[int, Tuple[str, int]]
+        self.peer_links = {} # type: Dict[int, PeerLink]
+
+        self.metrics = MetricsRegistry("raftel_node") # type: MetricsRegistry
+        self.packets_sent = self.metrics.counter(
+            "packets_sent_total", "Packets sent to the overseer, by command.", "command"
+        )
+        self.packets_received = self.metrics.counter(
+            "packets_received_total", "Packets received from the overseer, by command.", "command"
+        )
+        self.direct_packets_sent = self.metrics.counter(
+            "direct_packets_sent_total", "Packets sent straight to other nodes, by command.", "command"
+        )
+        self.direct_packets_received = self.metrics.counter(
+            "direct_packets_received_total",
+            "Packets received straight from other nodes, by command.", "command"
+        )
+        self.nacks_received = self.metrics.counter(
+            "nacks_received_total", "NACKs received from the overseer, by reason.", "reason"
+        )
+        self.rtt = self.metrics.histogram(
+            "rtt_us", "Time from sending a packet to the overseer to its ACK or NACK, in microseconds."
+        )
+        self.parse_time = self.metrics.histogram(
+            "parse_time_ns", "Time taken to parse a received frame, in nanoseconds."
+        )
+        self.backlog_depth = self.metrics.histogram(
+            "backlog_depth", "Commands already held back for a full window when another is sent."
+        )
+        self.batch_size = self.metrics.histogram(
+            "batch_size", "Packets sent to the overseer together, in one frame or one BATCH."
+        )
+        self.metrics.gauge("in_flight", "Packets awaiting an overseer response.", lambda: len(self.in_flight))
+        self.metrics.gauge("peer_links", "Direct connections to other nodes.", lambda: len(self.peer_links))
+        self.metrics.gauge("groups", "Raft groups hosted.", lambda: len(self.groups))
+        # When each packet number in flight was sent, for the RTT. Entries are
+        # simply overwritten once a packet number comes round again.
+        self.sent_at = {} # type: Dict[int, int]
+
+    def add_group(
+        self,
+        group: int,
+        election_timeout: int,
+        log: Optional[RaftLog] = None,
+        heartbeat_interval: Optional[int] = None,
+        **options
+    ) -> "NodeCore":
+        """
+        Host Raft group `group` on this node; see NodeCore for the other
+        arguments. Every node hosts group 0.
+        """
+        if group in self.groups:
+            raise ValueError("Group %s is already hosted here." % group)
+        core = NodeCore(self, group, election_timeout, log, heartbeat_interval, **options)
+        self.groups[group] = core
+        if self.connected:
+            self.__join(group, True)
+            core.start()
+        return core
+
+    def remove_group(self, group: int) -> None:
+        core = self.groups.pop(group)
+        core.stop()
+        if self.connected:
+            self.__join(group, False)
+
+    def __join(self, group: int, joined: bool) -> None:
+        # Everyone is in group 0 anyway.
+        if group:
+            self.send(OverseerCommands.JOIN_GROUP, [int(joined)], group=group)
+
+    def login_frame(self) -> bytes:
+        """
+        The first frame a backend must send after connecting. Everything else
+        waits for the overseer's answer to it.
+        """
+        # Offer our highest wire format; the ACK tells us what was agreed.
+        login = RPCPacket(0, OverseerCommands.LOGIN, [commons.PROTOCOL_VERSION])
+        if self.direct_address is not None:
+            host, port = self.direct_address
+            login.additional_info.extend((commons.host_to_int(host), port))
+        logger.info("SEND: %s", login)
+        # Neither the version (ETX) nor an address or port fits in a v1 argument.
+        return login.make_sendable_stream(commons.PROTOCOL_V2)
+
+    def __handle_login(self, parse_resp: RPCPacket) -> None:
+        if parse_resp.command != OverseerCommands.ACK or not parse_resp.additional_info:
+            raise ConnectionError("Overseer refused LOGIN: %s" % parse_resp)
+
+        logger.info("Got client id %s", parse_resp.additional_info)
+        self.raft_id = parse_resp.additional_info[0]
+        if len(parse_resp.additional_info) > 1:
+            self.protocol_version = parse_resp.additional_info[1]
+        self.last_transaction = self.transport.now_millis()
+        self.connected = True
+        self.__reset_keep_alive_timer()
+        if self.direct_address is not None:
+            members = parse_resp.additional_info[2:]
+            for i in range(0, len(members) - 2, 3):
+                self.__add_peer(*members[i:i + 3])
+        for group, core in self.groups.items():
+            self.__join(group, True)
+            core.start()
+
+    def __add_peer(self, peer_id: int, host: int, port: int) -> None:
+        self.peers[peer_id] = (commons.int_to_host(host), port)
+        if port:
+            self.transport.connect_peer(peer_id, *self.peers[peer_id])
+
+    def __remove_peer(self, peer_id: int) -> None:
+        self.peers.pop(peer_id, None)
+        link = self.peer_links.pop(peer_id, None)
+        if link is not None:
+            link.close()
+        for core in self.groups.values():
+            core.forget_follower(peer_id)
+
+    def __handle_peer_update(self, update: RPCPacket) -> None:
+        peer_id, host, port, joined = update.additional_info[0:4]
+        logger.info("Peer %s %s.", peer_id, "joined" if joined else "left")
+        if joined:
+            self.__add_peer(peer_id, host, port)
+        else:
+            self.__remove_peer(peer_id)
+
+    def peer_connected(self, peer_id: int, link: PeerLink) -> None:
+        """
+        Called by backends once a direct connection asked for through
+        connect_peer() is up.
+        """
+        if peer_id not in self.peers or not self.connected:
+            link.close()
+            return
+        logger.info("Direct connection to %s is up.", peer_id)
+        self.peer_links[peer_id] = link
+
+    def peer_lost(self, peer_id: int, link: Optional[PeerLink]) -> None:
+        """
+        Called by backends when a direct connection could not be made (link
+        is None) or broke. Until it is back, traffic for that peer goes
+        through the overseer.
+        """
+        if link is not None:
+            if self.peer_links.get(peer_id) is not link:
+                return
+            del self.peer_links[peer_id]
+            logger.warning("Lost direct connection to %s.", peer_id)
+        self.transport.call_later(PEER_RETRY_MS, lambda: self.__redial(peer_id))
+
+    def __redial(self, peer_id: int) -> None:
+        if self.connected and peer_id not in self.peer_links and self.peers.get(peer_id, (None, 0))[1]:
+            self.transport.connect_peer(peer_id, *self.peers[peer_id])
+
+    def connection_lost(self) -> None:
+        logger.critical("Node seems to be disconnected...")
+        self.connected = False
+        if self.keep_alive_timer is not None:
+            self.keep_alive_timer.cancel()
+        for core in self.groups.values():
+            core.stop()
+        # Peers only know of us through the overseer.
+        for peer_id in list(self.peers):
+            self.__remove_peer(peer_id)
+
+    def __window_has_room(self) -> bool:
+        if not self.in_flight:
+            return True
+        oldest = next(iter(self.in_flight))
+        return (self.next_packet_number - oldest) % 256 < self.window_size
+
+    def send(
+        self,
+        command: OverseerCommands,
+        additional_info: Optional[List[int]] = None,
+        data: bytes = b"",
+        group: int = 0
+    ) -> None:
+        """
+        Send a command to the overseer without waiting for its response. If
+        the window of outstanding packets is full, the command goes out as
+        soon as responses make room for it.
+
+        In direct mode, Raft commands go straight to the peers they are for
+        whenever there is a direct connection to all of them.
+        """
+        if self.peers and self.__send_direct(command, additional_info or [], data, group):
+            return
+        self.backlog_depth.observe(len(self.backlog))
+        if self.backlog or not self.__window_has_room():
+            self.backlog.append((command, additional_info, data, group))
+            return
+        self.__transmit(command, additional_info, data, group)
+
+    def __send_direct(
+        self,
+        command: OverseerCommands,
+        additional_info: List[int],
+        data: bytes,
+        group: int
+    ) -> bool:
+        if command in UNICAST_COMMANDS:
+            link = self.peer_links.get(additional_info[0])
+            if link is None:
+                return False
+            # What the overseer would have delivered: our id instead of theirs.
+            packet = RPCPacket(0, command, [self.raft_id] + additional_info[1:], data=data, group=group)
+            packet_log.log("SEND to %s: %s", additional_info[0], packet)
+            self.direct_packets_sent.inc(command.name)
+            link.push(packet.make_sendable_stream(commons.PROTOCOL_VERSION))
+            return True
+
+        # Broadcasts would reach some peers twice if they went out both ways.
+        # Only the overseer knows who is in which group but 0.
+        if (
+            command not in (OverseerCommands.REQUEST_VOTE, OverseerCommands.HEARTBEAT) or
+            group or len(self.peer_links) < len(self.peers)
+        ):
+            return False
+        packet = RPCPacket(0, command, [self.raft_id] + additional_info, data=data)
+        packet_log.log("SEND to all: %s", packet)
+        self.direct_packets_sent.inc(command.name, len(self.peer_links))
+        frame = packet.make_sendable_stream(commons.PROTOCOL_VERSION)
+        for link in self.peer_links.values():
+            link.push(frame)
+        self.groups[group].learn_cluster_size(len(self.peers))
+        return True
+
+    def __transmit(
+        self,
+        command: OverseerCommands,
+        additional_info: Optional[List[int]],
+        data: bytes,
+        group: int
+    ) -> None:
+        packet = RPCPacket(self.next_packet_number, command, additional_info, data=data, group=group)
+        self.next_packet_number = (self.next_packet_number + 1) % 256
+        self.in_flight[packet.packet_number] = packet
+        self.sent_at[packet.packet_number] = time.perf_counter_ns()
+        # Formatted lazily: most packets are never logged at all.
+        packet_log.log("SEND: %s", packet)
+        self.packets_sent.inc(command.name)
+        frame = packet.make_sendable_stream(self.protocol_version)
+        if self.protocol_version == commons.PROTOCOL_V1:
+            self.transport.send_frame(frame)
+            return
+        if self.queued_bytes + len(frame) > MAX_QUEUED_BYTES:
+            self.__flush_frames()
+        if not self.queued_frames:
+            self.transport.call_later(0, self.__flush_frames)
+        self.queued_frames.append(frame)
+        self.queued_packet_numbers.append(packet.packet_number)
+        self.queued_bytes += len(frame)
+
+    def __flush_frames(self) -> None:
+        frames, self.queued_frames = self.queued_frames, []
+        packet_numbers, self.queued_packet_numbers = self.queued_packet_numbers, []
+        self.queued_bytes = 0
+        if not self.connected or not frames:
+            return
+        self.batch_size.observe(len(frames))
+        if len(frames) == 1:
+            self.transport.send_frame(frames[0])
+        else:
+            self.sent_batches.append(packet_numbers)
+            self.transport.send_frame(commons.batch_frame(frames, self.protocol_version))
+
+    def send_heartbeat(self, group: int, additional_info: List[int]) -> None:
+        """
+        Send a HEARTBEAT for group, together with those of any other groups
+        we lead that are due within the same event loop iteration.
+        """
+        if not self.queued_heartbeats:
+            self.transport.call_later(0, self.__flush_heartbeats)
+        self.queued_heartbeats.append((group, additional_info))
+
+    def __flush_heartbeats(self) -> None:
+        heartbeats, self.queued_heartbeats = self.queued_heartbeats, []
+        if not self.connected:
+            return
+        if len(heartbeats) == 1:
+            group, additional_info = heartbeats[0]
+            self.send(OverseerCommands.HEARTBEAT, additional_info, group=group)
+            return
+        coalesced = [] # type: List[int]
+        for group, additional_info in heartbeats:
+            coalesced.append(group)
+            coalesced.extend(additional_info)
+        self.send(OverseerCommands.HEARTBEATS, coalesced)
+
+    def __handle_heartbeats(self, heartbeats: RPCPacket) -> None:
+        leader_id = heartbeats.additional_info[0]
+        replies = [] # type: List[int]
+        for i in range(1, len(heartbeats.additional_info) - 3, 4):
+            group, term, leader_commit, heartbeat_round = heartbeats.additional_info[i:i + 4]
+            core = self.groups.get(group)
+            if core is not None:
+                replies.append(group)
+                replies.extend(core.heartbeat(leader_id, term, leader_commit, heartbeat_round))
+        if replies:
+            self.send(OverseerCommands.HEARTBEAT_REPLIES, [leader_id] + replies)
+
+    def __handle_heartbeat_replies(self, replies: RPCPacket) -> None:
+        follower_id = replies.additional_info[0]
+        for i in range(1, len(replies.additional_info) - 3, 4):
+            group, term, index, heartbeat_round = replies.additional_info[i:i + 4]
+            core = self.groups.get(group)
+            if core is not None:
+                core.heartbeat_reply(follower_id, term, index, heartbeat_round)
+
+    def __handle_response(self, resp: RPCPacket) -> None:
+        if self.__settle(resp):
+            self.__responded()
+
+    def __handle_batch(self, batch: RPCPacket) -> None:
+        """
+        The overseer's answer to a BATCH: the packet numbers it simply ACKed
+        as arguments, and any other responses as frames in the data. Packets
+        of the batch it does not answer at all count as NACKed.
+        """
+        packet_numbers = self.sent_batches.popleft() if self.sent_batches else []
+        settled = False
+        self.packets_received.inc(OverseerCommands.ACK.name, len(batch.additional_info))
+        for packet_number in batch.additional_info:
+            settled = self.__settle(RPCPacket(packet_number, OverseerCommands.ACK)) or settled
+        for frame in commons.split_frames(batch.data):
+            resp = self.__parse(frame)
+            self.packets_received.inc(resp.command.name)
+            settled = self.__settle(resp) or settled
+        unanswered = [packet_number for packet_number in packet_numbers if packet_number in self.in_flight]
+        if unanswered:
+            logger.warning("Overseer left packets %s of a batch unanswered.", unanswered)
+        for packet_number in unanswered:
+            self.__settle(RPCPacket(
+                packet_number, OverseerCommands.NACK, [OverseerCommands.MALFORMED_PKT.value]
+            ))
+            settled = True
+        if settled:
+            self.__responded()
+
+    def __settle(self, resp: RPCPacket) -> bool:
+        """
+        Retire the packet resp answers. Returns whether it was in flight.
+        """
+        request = self.in_flight.pop(resp.packet_number, None)
+        if request is None:
+            logger.warning("Response for packet %s which is not in flight.", resp.packet_number)
+            return False
+        self.rtt.observe((time.perf_counter_ns() - self.sent_at[resp.packet_number]) // 1000)
+        if resp.command == OverseerCommands.NACK:
+            self.nacks_received.inc(nack_reason(resp))
+
+        # The overseer answers in order but may drop keep-alive ACKs when we
+        # fall behind reading; anything answered implies those went through.
+        for packet_number, packet in list(self.in_flight.items()):
+            if packet.command != OverseerCommands.KEEP_ALIVE:
+                continue
+            if (resp.packet_number - packet_number) % 256 >= self.window_size:
+                break
+            del self.in_flight[packet_number]
+
+        if request.command == OverseerCommands.HEARTBEATS:
+            if resp.command == OverseerCommands.ACK:
+                groups = request.additional_info[0::4]
+                for group, reached in zip(groups, resp.additional_info):
+                    core = self.groups.get(group)
+                    if core is not None:
+                        core.learn_cluster_size(reached)
+        else:
+            core = self.groups.get(request.group)
+            if core is not None:
+                core.handle_response(request, resp)
+        return True
+
+    def __responded(self) -> None:
+        self.last_transaction = self.transport.now_millis()
+        self.__reset_keep_alive_timer()
+        while self.backlog and self.__window_has_room():
+            self.__transmit(*self.backlog.popleft())
+
+    def handle_packet(self, resp: RPCPacket) -> None:
+        packet_log.log("RECV: %s", resp)
+        self.packets_received.inc(resp.command.name)
+        if not self.connected:
+            self.__handle_login(resp)
+        elif resp.command in (OverseerCommands.ACK, OverseerCommands.NACK):
+            self.__handle_response(resp)
+        elif resp.command == OverseerCommands.BATCH:
+            self.__handle_batch(resp)
+        elif resp.command == OverseerCommands.PEER_UPDATE:
+            self.__handle_peer_update(resp)
+        else:
+            self.__handle_raft_packet(resp)
+
+    def __handle_raft_packet(self, packet: RPCPacket) -> None:
+        if packet.command == OverseerCommands.HEARTBEATS:
+            self.__handle_heartbeats(packet)
+        elif packet.command == OverseerCommands.HEARTBEAT_REPLIES:
+            self.__handle_heartbeat_replies(packet)
+        else:
+            core = self.groups.get(packet.group)
+            if core is not None:
+                core.handle_packet(packet)
+
+    def receive(self, decoder: FrameDecoder) -> None:
+        """
+        Handle every complete frame buffered in decoder. Raises
+        ConnectionError if the rest of the stream cannot be framed.
+        """
+        try:
+            for frame in decoder.frames():
+                self.handle_packet(self.__parse(frame))
+        except FramingError as e:
+            raise ConnectionError("Cannot read the overseer's frames: %s" % e)
+
+    def __parse(self, frame: memoryview) -> RPCPacket:
+        started = time.perf_counter_ns()
+        packet = RPCPacket.parse(frame)
+        self.parse_time.observe(time.perf_counter_ns() - started)
+        return packet
+
+    def receive_direct(self, decoder: FrameDecoder) -> None:
+        """
+        Handle every complete frame buffered in decoder, read from a direct
+        connection another node made to us. Raises ConnectionError if the
+        rest of the stream cannot be framed.
+        """
+        try:
+            for frame in decoder.frames():
+                packet = self.__parse(frame)
+                packet_log.log("RECV direct: %s", packet)
+                self.direct_packets_received.inc(packet.command.name)
+                if self.connected:
+                    self.__handle_raft_packet(packet)
+        except FramingError as e:
+            raise ConnectionError("Cannot read a peer's frames: %s" % e)
+
+    def __reset_keep_alive_timer(self) -> None:
+        if self.keep_alive_timer is not None:
+            self.keep_alive_timer.cancel()
+        self.keep_alive_timer = self.transport.call_later(self.wait_sleep, self.__on_keep_alive_timeout)
+
+    def __on_keep_alive_timeout(self) -> None:
+        self.send(OverseerCommands.KEEP_ALIVE)
+        self.__reset_keep_alive_timer()
+
+class NodeCore(object):
+    """
+    The protocol state of one Raft group on a node, independent of how bytes
+    move. Created through NodeSession.add_group(), which feeds it the packets
+    of its group.
+    """
+
+    def __init__(
+        self,
+        session: NodeSession,
+        group: int,
+        election_timeout: int,
+        log: Optional[RaftLog] = None,
+        heartbeat_interval: Optional[int] = None,
+        state_machine: Optional[StateMachine] = None,
+        snapshots: Optional[SnapshotStore] = None,
+        snapshot_threshold: int = DEFAULT_SNAPSHOT_THRESHOLD,
+        lease_reads: bool = False
+    ) -> None:
+        """
+        election_timeout is the time, in milliseconds, this node will wait for a
+        leader heartbeat. Once elapsed, it will volunteer itself to be the
+        leader. The actual wait is randomized between election_timeout and
+        twice that.
+
+        You typically want election_timeout to be greater than the session's
+        wait_sleep. The rationale is that you want the node to send a few keep
+        alives to overseer before trying to go for election; this gives the
+        other nodes time to join the cluster.
+
+        log is where this node keeps its Raft log, term and vote. Without one,
+        they are kept in memory and lost on exit.
+
+        heartbeat_interval is how often, in milliseconds, this node asserts
+        its leadership while leader. It defaults to a quarter of
+        election_timeout.
+
+        Committed entries are applied to state_machine. Every
+        snapshot_threshold applied entries (0 for never), its state is saved
+        to snapshots and the log compacted. Both default to keeping nothing
+        beyond the log.
+
+        With lease_reads, a leader that heard from a quorum less than
+        election_timeout ago answers reads without another heartbeat round.
+        This relies on clocks on different nodes running at about the same
+        rate.
+        """
+        self.session = session # type: NodeSession
+        self.transport = session.transport # type: NodeTransport
+        self.group = group # type: int
+        # "Mock" leader ping to start with.
+        self.last_leader_ping = self.__current_time_millis() # type: int
+        self.log = log if log is not None else RaftLog() # type: RaftLog
+        # Appends are made durable in batches.
+        self.committer = GroupCommitter(self.log, self.transport.call_later) # type: GroupCommitter
+        self.election_timeout = election_timeout # type: int
+
+        # Timer handles, armed once logged in.
+        self.election_timer = None # type: Any
+        self.heartbeat_timer = None # type: Any
+        self.replication_timer = None # type: Any
+        self.heartbeat_interval = (
+            heartbeat_interval if heartbeat_interval else max(1, election_timeout // 4)
+        ) # type: int
+
+        self.current_term, self.voted_for = self.log.load_hard_state()
+        self.state = NodeStates.FOLLOWER # type: NodeStates
+        self.votes_received = set() # type: Set[int]
+        # Learned from the overseer whenever we request votes or send
+        # heartbeats; 0 until then.
+        self.cluster_size = 0 # type: int
+
+        self.leader_id = None # type: Optional[int]
+        self.leader_term = 0 # type: int
+        # Entries up to here are known to match the current leader's log, so
+        # its commit index may be followed up to here.
+        self.verified_index = 0 # type: int
+        self.commit_index = 0 # type: int
+        # Leaders only: replication progress of every known follower.
+        self.followers = {} # type: Dict[int, FollowerProgress]
+
+        self.state_machine = (
+            state_machine if state_machine is not None else NullStateMachine()
+        ) # type: StateMachine
+        self.snapshots = snapshots if snapshots is not None else SnapshotStore() # type: SnapshotStore
+        self.snapshot_threshold = snapshot_threshold # type: int
+        self.last_applied = 0 # type: int
+        # A snapshot on its way from the leader.
+        self.incoming_snapshot = None # type: Optional[SnapshotWriter]
+
+        # Leaders only: proposals by index, as (term, callback), and reads
+        # waiting to be served.
+        self.pending_proposals = {} # type: Dict[int, Tuple[int, Callable[[Any, Optional[Exception]], None]]]
+        self.pending_reads = [] # type: List[PendingRead]
+        self.lease_reads = lease_reads # type: bool
+        # Heartbeats are numbered so that reads can tell which of them were
+        # sent after they arrived; rounds a quorum has answered are confirmed.
+        self.heartbeat_round = 0 # type: int
+        self.confirmed_round = 0 # type: int
+        self.round_sent_at = {} # type: Dict[int, int]
+        # When the last confirmed round was sent, and until when that
+        # guarantees nobody else can have been elected.
+        self.quorum_contact = 0 # type: int
+        self.lease_until = 0 # type: int
+        self.read_heartbeat_timer = None # type: Any
+        snapshot = self.snapshots.load()
+        if snapshot is not None:
+            self.__install_snapshot(snapshot)
+
+    def __current_time_millis(self) -> int:
+        # Only ever compared with itself, and leases must not jump with the
+        # wall clock.
+        return self.transport.now_millis()
+
+    @property
+    def raft_id(self) -> int:
+        return self.session.raft_id
+
+    @property
+    def last_log_index(self) -> int:
+        return self.log.last_index
+
+    @property
+    def last_log_term(self) -> int:
+        return self.log.last_term
+
+    def __save_hard_state(self) -> None:
+        self.log.save_hard_state(self.current_term, self.voted_for)
+
+    def start(self) -> None:
+        """
+        Called by the session once logged in.
+        """
+        self.__reset_election_timer()
+
+    def stop(self) -> None:
+        """
+        Called by the session when the group is removed or the connection to
+        the overseer is lost.
+        """
+        for timer in (
+            self.election_timer, self.heartbeat_timer, self.replication_timer,
+            self.read_heartbeat_timer
+        ):
+            if timer is not None:
+                timer.cancel()
+        # Nobody is waiting on the timer any more.
+        self.committer.flush()
+        # Cut off from the others we can no longer tell whether we lead; a
+        # leader staying one would keep accepting proposals and reads.
+        self.__step_down(self.current_term)
+        self.leader_id = None
+        self.__fail_pending()
+
+    def send(
+        self,
+        command: OverseerCommands,
+        additional_info: Optional[List[int]] = None,
+        data: bytes = b""
+    ) -> None:
+        """
+        Send a command for this group; see NodeSession.send().
+        """
+        self.session.send(command, additional_info, data, self.group)
+
+    def learn_cluster_size(self, reached: int) -> None:
+        """
+        Called by the session with how many other nodes one of our broadcasts
+        reached.
+        """
+        self.cluster_size = reached + 1
+        self.__tally_votes()
+        self.__advance_leader_commit()
+        self.__confirm_rounds()
+
+    def handle_response(self, request: RPCPacket, resp: RPCPacket) -> None:
+        """
+        Called by the session with the overseer's answer to one of our
+        packets.
+        """
+        if resp.command == OverseerCommands.NACK:
+            logger.warning("%s was NACKed: %s", request, resp.additional_info)
+            if request.command == OverseerCommands.APPEND_ENTRIES:
+                # The follower is gone; it is picked up again by heartbeat
+                # should it come back.
+                self.followers.pop(request.additional_info[0], None)
+        elif (
+            request.command in (OverseerCommands.REQUEST_VOTE, OverseerCommands.HEARTBEAT) and
+            resp.additional_info
+        ):
+            # The overseer tells us how many peers it relayed our request to.
+            self.learn_cluster_size(resp.additional_info[0])
+
+    def forget_follower(self, follower_id: int) -> None:
+        """
+        Called by the session when a node is gone for good, unlike one that
+        merely stopped answering.
+        """
+        self.followers.pop(follower_id, None)
+
+    def __step_down(self, term: int) -> None:
+        if term > self.current_term:
+            logger.info("Saw term %s (ours is %s), reverting to follower.", term, self.current_term)
+            self.current_term = term
+            self.voted_for = None
+            self.__save_hard_state()
+        was_leader = self.state == NodeStates.LEADER
+        self.state = NodeStates.FOLLOWER
+        self.followers = {}
+        if self.heartbeat_timer is not None:
+            self.heartbeat_timer.cancel()
+            self.heartbeat_timer = None
+        if was_leader:
+            self.__fail_pending()
+
+    def __fail_pending(self) -> None:
+        # Proposals may still be committed by the next leader; their callers
+        # only learn that this node cannot tell them.
+        error = NotLeaderError(None)
+        proposals, self.pending_proposals = self.pending_proposals, {}
+        reads, self.pending_reads = self.pending_reads, []
+        self.round_sent_at = {}
+        self.lease_until = 0
+        for _, callback in proposals.values():
+            callback(None, error)
+        for read in reads:
+            read.callback(error)
+
+    def __start_election(self) -> None:
+        self.current_term += 1
+        self.state = NodeStates.CANDIDATE
+        self.voted_for = self.raft_id
+        self.__save_hard_state()
+        self.votes_received = {self.raft_id}
+        self.leader_id = None
+        # Membership may have changed since the last election.
+        self.cluster_size = 0
+        self.last_leader_ping = self.__current_time_millis()
+        # Tell the overseer you want to be the leader
+        self.send(
+            OverseerCommands.REQUEST_VOTE,
+            [self.current_term, self.last_log_index, self.last_log_term]
+        )
+
+    def __tally_votes(self) -> None:
+        if (
+            self.state == NodeStates.CANDIDATE and self.cluster_size and
+            len(self.votes_received) > self.cluster_size // 2
+        ):
+            logger.info(
+                "Won election for term %s with %s of %s votes.",
+                self.current_term, len(self.votes_received), self.cluster_size
+            )
+            self.__become_leader()
+
+    def __become_leader(self) -> None:
+        self.state = NodeStates.LEADER
+        self.leader_id = self.raft_id
+        self.leader_term = self.current_term
+        self.quorum_contact = self.__current_time_millis()
+        # Everyone who voted for us is a follower; the rest show up by
+        # answering heartbeats.
+        self.followers = {
+            voter: FollowerProgress(self.log.last_index + 1)
+            for voter in self.votes_received if voter != self.raft_id
+        }
+        # Entries from earlier terms only count as committed once one from
+        # this term is, so get one in straight away.
+        self.propose(b"")
+        self.__on_heartbeat_timeout()
+
+    def propose(
+        self,
+        data: bytes,
+        callback: Optional[Callable[[Any, Optional[Exception]], None]] = None
+    ) -> Optional[int]:
+        """
+        Append data to the replicated log if this node is the leader, and
+        return its index. Proposals made within one event loop iteration are
+        replicated together.
+
+        Once the entry is applied, callback gets what the state machine
+        returned for it, or a NotLeaderError if this node lost leadership
+        before then (in which case the entry may or may not be committed).
+        Raises CommandError, without logging anything, if the state machine
+        could never apply data.
+        """
+        if self.state != NodeStates.LEADER:
+            return None
+        if data:
+            self.state_machine.check(data)
+        index = self.log.append(self.current_term, data)
+        if callback is not None:
+            self.pending_proposals[index] = (self.current_term, callback)
+        if self.replication_timer is None:
+            self.replication_timer = self.transport.call_later(0, self.__replicate_all)
+        return index
+
+    def read(self, callback: Callable[[Optional[Exception]], None]) -> None:
+        """
+        Call callback once this node's state machine reflects every write
+        committed before the call, so that reading it is linearizable; or with
+        a NotLeaderError should this node not be the leader.
+
+        Reads are not logged. The leader notes its commit index and confirms
+        it still leads through a heartbeat round (ReadIndex), which reads
+        arriving together share; with lease_reads, a recent enough round
+        suffices.
+        """
+        if self.state != NodeStates.LEADER:
+            callback(NotLeaderError(self.leader_id))
+            return
+        self.pending_reads.append(PendingRead(self.heartbeat_round + 1, callback))
+        if not self.__lease_valid() and self.read_heartbeat_timer is None:
+            self.read_heartbeat_timer = self.transport.call_later(0, self.__on_read_heartbeat)
+        self.__confirm_rounds()
+        self.__serve_reads()
+
+    def __lease_valid(self) -> bool:
+        return self.lease_reads and self.__current_time_millis() < self.lease_until
+
+    def __on_read_heartbeat(self) -> None:
+        self.read_heartbeat_timer = None
+        if self.state == NodeStates.LEADER and self.pending_reads:
+            self.__send_heartbeat()
+
+    def __send_heartbeat(self) -> None:
+        self.heartbeat_round += 1
+        self.round_sent_at[self.heartbeat_round] = self.__current_time_millis()
+        self.session.send_heartbeat(
+            self.group, [self.current_term, self.commit_index, self.heartbeat_round]
+        )
+
+    def __confirm_rounds(self) -> None:
+        if self.state != NodeStates.LEADER or not self.cluster_size:
+            return
+        quorum = self.cluster_size // 2 + 1
+        if quorum == 1:
+            confirmed = self.heartbeat_round
+        else:
+            # We count as one of the quorum.
+            rounds = sorted(
+                (progress.heartbeat_round for progress in self.followers.values()), reverse=True
+            )
+            if len(rounds) < quorum - 1:
+                return
+            confirmed = rounds[quorum - 2]
+        if confirmed <= self.confirmed_round:
+            return
+
+        self.confirmed_round = confirmed
+        sent_at = self.round_sent_at.get(confirmed)
+        self.round_sent_at = {
+            heartbeat_round: sent for heartbeat_round, sent in self.round_sent_at.items()
+            if heartbeat_round > confirmed
+        }
+        if sent_at is not None:
+            self.quorum_contact = sent_at
+            # Followers that answered will not vote anyone else in until an
+            # election timeout after hearing from us.
+            self.lease_until = sent_at + int(self.election_timeout * (1 - LEASE_CLOCK_DRIFT))
+        self.__serve_reads()
+
+    def __serve_reads(self) -> None:
+        if not self.pending_reads or self.state != NodeStates.LEADER:
+            return
+        # Until an entry of our own term is committed, our commit index may
+        # lag behind what an earlier leader committed.
+        if self.log.term_at(self.commit_index) != self.current_term:
+            return
+
+        lease_valid = self.__lease_valid()
+        waiting = [] # type: List[PendingRead]
+        ready = [] # type: List[PendingRead]
+        for read in self.pending_reads:
+            if read.read_index is None:
+                read.read_index = self.commit_index
+            if (
+                (read.heartbeat_round > self.confirmed_round and not lease_valid) or
+                self.last_applied < read.read_index
+            ):
+                waiting.append(read)
+            else:
+                ready.append(read)
+        self.pending_reads = waiting
+        for read in ready:
+            read.callback(None)
+
+    def __replicate_all(self) -> None:
+        self.replication_timer = None
+        if self.state != NodeStates.LEADER:
+            return
+        # The leader's own copy counts towards the quorum once durable.
+        self.committer.commit(lambda durable_index: self.__advance_leader_commit())
+        for follower_id, progress in self.followers.items():
+            self.__replicate(follower_id, progress)
+
+    def __replicate(self, follower_id: int, progress: FollowerProgress) -> None:
+        if (
+            progress.snapshot is not None or progress.next_index < self.log.first_index or
+            not self.log.has_term(progress.next_index - 1)
+        ):
+            # What the follower needs next was compacted away.
+            self.__send_snapshot(follower_id, progress)
+            return
+
+        # Pipelined: send batch after batch without waiting for answers, up
+        # to MAX_BATCHES_IN_FLIGHT of them.
+        while (
+            progress.batches_in_flight < MAX_BATCHES_IN_FLIGHT and
+            progress.next_index <= self.log.last_index
+        ):
+            batch = self.log.entries(progress.next_index, MAX_BATCH_ENTRIES, MAX_BATCH_BYTES)
+            prev_index = progress.next_index - 1
+            self.send(
+                OverseerCommands.APPEND_ENTRIES,
+                [
+                    follower_id, self.current_term, prev_index,
+                    self.log.term_at(prev_index), self.commit_index
+                ],
+                data=pack_entries(batch)
+            )
+            progress.next_index += len(batch)
+            progress.batches_in_flight += 1
+
+    def __send_snapshot(self, follower_id: int, progress: FollowerProgress) -> None:
+        if progress.snapshot is None:
+            logger.info("Sending snapshot to %s, which needs entry %s.", follower_id, progress.next_index)
+            progress.snapshot = self.snapshots.current
+            progress.batches_in_flight = 0
+
+        snapshot = progress.snapshot
+        # Chunks are views of the snapshot's mapping, not copies.
+        while progress.batches_in_flight < MAX_BATCHES_IN_FLIGHT and not progress.snapshot_sent:
+            chunk = snapshot.chunk(progress.snapshot_offset, SNAPSHOT_CHUNK_SIZE)
+            self.send(
+                OverseerCommands.INSTALL_SNAPSHOT,
+                [
+                    follower_id, self.current_term, snapshot.last_index, snapshot.last_term,
+                    progress.snapshot_offset, snapshot.size
+                ],
+                data=chunk
+            )
+            progress.snapshot_offset += len(chunk)
+            progress.snapshot_sent = progress.snapshot_offset >= snapshot.size
+            progress.batches_in_flight += 1
+
+    def __advance_leader_commit(self) -> None:
+        if self.state != NodeStates.LEADER or not self.cluster_size:
+            return
+        quorum = self.cluster_size // 2 + 1
+        matches = sorted(
+            [progress.match_index for progress in self.followers.values()] +
+            [self.log.durable_index],
+            reverse=True
+        )
+        if len(matches) < quorum:
+            return
+        # The highest index stored on a quorum of nodes.
+        index = matches[quorum - 1]
+        if index > self.commit_index and self.log.term_at(index) == self.current_term:
+            self.__set_commit_index(index)
+
+    def __set_commit_index(self, index: int) -> None:
+        logger.debug("Committed up to %s.", index)
+        self.commit_index = index
+        while self.last_applied < self.commit_index:
+            self.last_applied += 1
+            entry = self.log.entry(self.last_applied)
+            result = None # type: Any
+            error = None # type: Optional[Exception]
+            # Empty entries are the no-ops new leaders start their term with.
+            if entry.data:
+                try:
+                    result = self.state_machine.apply(entry.index, entry.data)
+                except CommandError as e:
+                    # Committed all the same, so every node has to skip it.
+                    logger.warning("Skipped entry %s: %s", entry.index, e)
+                    error = e
+            pending = self.pending_proposals.pop(entry.index, None)
+            if pending is not None:
+                term, callback = pending
+                if term != entry.term:
+                    callback(None, NotLeaderError(self.leader_id))
+                else:
+                    callback(result, error)
+        if (
+            self.snapshot_threshold and
+            self.last_applied - self.log.snapshot_index >= self.snapshot_threshold
+        ):
+            self.take_snapshot()
+        self.__serve_reads()
+
+    def take_snapshot(self) -> Snapshot:
+        """
+        Save the state machine as of the last applied entry, then compact the
+        log up to that entry.
+        """
+        index = self.last_applied
+        term = self.log.term_at(index)
+        snapshot = self.snapshots.save(index, term, self.state_machine.snapshot())
+        self.log.compact(index, term)
+        logger.info("Took snapshot at %s; log now starts at %s.", index, self.log.first_index)
+        return snapshot
+
+    def __install_snapshot(self, snapshot: Snapshot) -> None:
+        self.state_machine.restore(snapshot.data)
+        self.log.compact(snapshot.last_index, snapshot.last_term)
+        self.last_applied = snapshot.last_index
+        self.commit_index = max(self.commit_index, snapshot.last_index)
+
+    def __handle_append_response(self, response: RPCPacket) -> None:
+        self.__append_response(*response.additional_info[0:5])
+
+    def heartbeat_reply(self, follower_id: int, term: int, index: int, heartbeat_round: int) -> None:
+        """
+        Called by the session for each reply to our heartbeats it got together
+        with those of other groups.
+        """
+        self.__append_response(
+            follower_id, term, AppendOutcomes.HEARTBEAT.value, index, heartbeat_round
+        )
+
+    def __append_response(
+        self,
+        follower_id: int,
+        term: int,
+        outcome: int,
+        index: int,
+        heartbeat_round: int
+    ) -> None:
+        if term > self.current_term:
+            self.__step_down(term)
+            self.__reset_election_timer()
+            return
+        if self.state != NodeStates.LEADER or term < self.current_term:
+            return
+
+        progress = self.followers.get(follower_id)
+        if progress is None:
+            progress = FollowerProgress(min(self.log.last_index, index) + 1)
+            self.followers[follower_id] = progress
+
+        if outcome == AppendOutcomes.HEARTBEAT.value:
+            progress.heartbeat_round = max(progress.heartbeat_round, heartbeat_round)
+            self.__confirm_rounds()
+        elif outcome == AppendOutcomes.ACCEPTED.value:
+            progress.batches_in_flight = max(0, progress.batches_in_flight - 1)
+            progress.stalled_heartbeats = 0
+            progress.match_index = max(progress.match_index, index)
+            progress.next_index = max(progress.next_index, index + 1)
+            if progress.snapshot is not None and progress.match_index >= progress.snapshot.last_index:
+                progress.forget_snapshot()
+                progress.batches_in_flight = 0
+            self.__advance_leader_commit()
+        elif outcome == AppendOutcomes.REJECTED.value:
+            # Whatever else is in flight was sent from the wrong place too.
+            progress.batches_in_flight = 0
+            progress.stalled_heartbeats = 0
+            progress.forget_snapshot()
+            progress.next_index = max(progress.match_index + 1, min(progress.next_index, index + 1))
+        elif outcome == AppendOutcomes.SNAPSHOT_CHUNK.value:
+            progress.batches_in_flight = max(0, progress.batches_in_flight - 1)
+            progress.stalled_heartbeats = 0
+            if index < 0:
+                logger.warning("%s lost track of the snapshot, starting over.", follower_id)
+                progress.forget_snapshot()
+                progress.batches_in_flight = 0
+        self.__replicate(follower_id, progress)
+
+    def __follow(self, leader_id: int, term: int) -> None:
+        if term > self.current_term or self.state != NodeStates.FOLLOWER:
+            self.__step_down(term)
+        if (leader_id, term) != (self.leader_id, self.leader_term):
+            logger.info("Following %s in term %s.", leader_id, term)
+            self.leader_id = leader_id
+            self.leader_term = term
+            self.verified_index = 0
+        self.last_leader_ping = self.__current_time_millis()
+        self.__reset_election_timer()
+
+    def __follow_commit(self, leader_commit: int) -> None:
+        index = min(leader_commit, self.verified_index)
+        if index > self.commit_index:
+            self.__set_commit_index(index)
+
+    def __respond_append(
+        self,
+        leader_id: int,
+        outcome: AppendOutcomes,
+        index: int,
+        heartbeat_round: int = 0
+    ) -> None:
+        self.send(
+            OverseerCommands.APPEND_RESPONSE,
+            [leader_id, self.current_term, outcome.value, index, heartbeat_round]
+        )
+
+    def __conflict_hint(self, prev_index: int) -> int:
+        """
+        Where a leader whose prev_index did not match should back off to: our
+        last entry if we are behind, else just before the conflicting term.
+        """
+        if prev_index > self.log.last_index:
+            return self.log.last_index
+        conflict_term = self.log.term_at(prev_index)
+        index = prev_index - 1
+        while index > self.commit_index and self.log.term_at(index) == conflict_term:
+            index -= 1
+        return index
+
+    def __handle_heartbeat(self, heartbeat: RPCPacket) -> None:
+        leader_id = heartbeat.additional_info[0]
+        term, last_index, heartbeat_round = self.heartbeat(*heartbeat.additional_info[0:4])
+        self.__respond_append(leader_id, AppendOutcomes.HEARTBEAT, last_index, heartbeat_round)
+
+    def heartbeat(self, leader_id: int, term: int, leader_commit: int, heartbeat_round: int) -> List[int]:
+        """
+        Take in a leader's heartbeat and return our reply to it: our term,
+        last log index and the heartbeat's round. A stale leader learns our
+        term from it and steps down.
+        """
+        if term >= self.current_term:
+            self.__follow(leader_id, term)
+            self.__follow_commit(leader_commit)
+        return [self.current_term, self.log.last_index, heartbeat_round]
+
+    def __handle_append_entries(self, append: RPCPacket) -> None:
+        leader_id, term, prev_index, prev_term, leader_commit = append.additional_info[0:5]
+        if term < self.current_term:
+            self.__respond_append(leader_id, AppendOutcomes.REJECTED, self.log.last_index)
+            return
+
+        self.__follow(leader_id, term)
+        # Entries covered by our snapshot are committed, so match any leader's.
+        if prev_index >= self.log.snapshot_index and (
+            prev_index > self.log.last_index or self.log.term_at(prev_index) != prev_term
+        ):
+            self.__respond_append(leader_id, AppendOutcomes.REJECTED, self.__conflict_hint(prev_index))
+            return
+
+        index = prev_index
+        for entry_term, data in unpack_entries(append.data):
+            index += 1
+            if index <= self.log.snapshot_index:
+                continue
+            if index <= self.log.last_index:
+                if self.log.term_at(index) == entry_term:
+                    continue
+                # Only ever uncommitted entries from an old leader.
+                self.log.truncate_after(index - 1)
+            self.log.append(entry_term, data)
+
+        self.verified_index = max(self.verified_index, index)
+        self.__follow_commit(leader_commit)
+        # Answer once the entries are on disk, together with whatever else
+        # arrives before the next sync.
+        self.committer.commit(
+            lambda durable_index: self.__respond_append(leader_id, AppendOutcomes.ACCEPTED, index)
+        )
+
+    def __handle_request_vote(self, request: RPCPacket) -> None:
+        candidate_id, term, last_log_index, last_log_term = request.additional_info[0:4]
+        # While a leader is known to be alive, candidates are most likely
+        # nodes cut off from it; ignoring them keeps them from disrupting the
+        # cluster and is what makes leader leases safe.
+        if candidate_id != self.leader_id and (
+            self.state == NodeStates.LEADER or (
+                self.leader_id is not None and
+                self.__current_time_millis() - self.last_leader_ping < self.election_timeout
+            )
+        ):
+            logger.info("Ignoring vote request from %s while %s leads.", candidate_id, self.leader_id)
+            self.send(OverseerCommands.VOTE, [candidate_id, self.current_term, 0])
+            return
+
+        if term > self.current_term:
+            self.__step_down(term)
+
+        log_ok = (
+            last_log_term > self.last_log_term or
+            (last_log_term == self.last_log_term and last_log_index >= self.last_log_index)
+        )
+        granted = (
+            term == self.current_term and log_ok and
+            self.voted_for in (None, candidate_id)
+        )
+        if granted:
+            self.voted_for = candidate_id
+            self.__save_hard_state()
+            self.last_leader_ping = self.__current_time_millis()
+            self.__reset_election_timer()
+
+        self.send(OverseerCommands.VOTE, [candidate_id, self.current_term, int(granted)])
+
+    def __handle_vote(self, vote: RPCPacket) -> None:
+        voter_id, term, granted = vote.additional_info[0:3]
+        if term > self.current_term:
+            self.__step_down(term)
+        elif granted and term == self.current_term:
+            self.votes_received.add(voter_id)
+            self.__tally_votes()
+
+    def __handle_install_snapshot(self, install: RPCPacket) -> None:
+        leader_id, term, last_index, last_term, offset, size = install.additional_info[0:6]
+        if term < self.current_term:
+            self.__respond_append(leader_id, AppendOutcomes.REJECTED, self.log.last_index)
+            return
+
+        self.__follow(leader_id, term)
+        if last_index <= self.commit_index:
+            # Nothing in it we do not have already.
+            self.__respond_append(leader_id, AppendOutcomes.ACCEPTED, self.commit_index)
+            return
+
+        writer = self.incoming_snapshot
+        if offset == 0:
+            if writer is not None:
+                writer.abort()
+            writer = self.incoming_snapshot = self.snapshots.writer(last_index, last_term, size)
+        elif (
+            writer is None or writer.received != offset or
+            (writer.last_index, writer.last_term) != (last_index, last_term)
+        ):
+            self.__respond_append(leader_id, AppendOutcomes.SNAPSHOT_CHUNK, -1)
+            return
+
+        writer.write(install.data)
+        if not writer.done:
+            self.__respond_append(leader_id, AppendOutcomes.SNAPSHOT_CHUNK, writer.received)
+            return
+
+        self.incoming_snapshot = None
+        logger.info("Installing snapshot up to %s from %s.", last_index, leader_id)
+        self.__install_snapshot(writer.finish())
+        self.verified_index = max(self.verified_index, last_index)
+        self.__respond_append(leader_id, AppendOutcomes.ACCEPTED, last_index)
+
+    def handle_packet(self, resp: RPCPacket) -> None:
+        """
+        Act on a Raft command for this group, relayed or sent directly.
+        """
+        if resp.command == OverseerCommands.REQUEST_VOTE:
+            self.__handle_request_vote(resp)
+        elif resp.command == OverseerCommands.VOTE:
+            self.__handle_vote(resp)
+        elif resp.command == OverseerCommands.APPEND_ENTRIES:
+            self.__handle_append_entries(resp)
+        elif resp.command == OverseerCommands.APPEND_RESPONSE:
+            self.__handle_append_response(resp)
+        elif resp.command == OverseerCommands.HEARTBEAT:
+            self.__handle_heartbeat(resp)
+        elif resp.command == OverseerCommands.INSTALL_SNAPSHOT:
+            self.__handle_install_snapshot(resp)
+
+    def __restart_timer(self, timer: Any, delay_ms: int, callback: Callable[[], None]) -> Any:
+        if timer is not None:
+            timer.cancel()
+        return self.transport.call_later(delay_ms, callback)
+
+    def __reset_election_timer(self) -> None:
+        # Randomized so that nodes that lost their leader together do not all
+        # stand for election at the same moment.
+        timeout = self.session.random.randint(self.election_timeout, 2 * self.election_timeout)
+        self.election_timer = self.__restart_timer(
+            self.election_timer, timeout, self.__on_election_timeout
+        )
+
+    def __on_heartbeat_timeout(self) -> None:
+        if self.state != NodeStates.LEADER:
+            self.heartbeat_timer = None
+            return
+        self.__send_heartbeat()
+        for follower_id, progress in self.followers.items():
+            if progress.batches_in_flight:
+                progress.stalled_heartbeats += 1
+                if progress.stalled_heartbeats > MAX_STALLED_HEARTBEATS:
+                    logger.warning("No answer from %s, resending from %s.", follower_id, progress.match_index + 1)
+                    progress.batches_in_flight = 0
+                    progress.stalled_heartbeats = 0
+                    progress.forget_snapshot()
+                    progress.next_index = progress.match_index + 1
+                    self.__replicate(follower_id, progress)
+        # On a common beat, so that groups led from the same node send their
+        # heartbeats together.
+        delay = self.heartbeat_interval - self.__current_time_millis() % self.heartbeat_interval
+        if delay < self.heartbeat_interval // 2:
+            delay += self.heartbeat_interval
+        self.heartbeat_timer = self.__restart_timer(
+            self.heartbeat_timer, delay, self.__on_heartbeat_timeout
+        )
+
+    def __on_election_timeout(self) -> None:
+        # A leader no quorum has answered for an election timeout may well
+        # have been replaced, and must not go on serving reads.
+        if (
+            self.state == NodeStates.LEADER and self.cluster_size > 1 and
+            self.__current_time_millis() - self.quorum_contact > self.election_timeout
+        ):
+            logger.warning("No word from a quorum in %s ms, stepping down.", self.election_timeout)
+            self.__step_down(self.current_term)
+        # Candidates whose election went nowhere try again with a new term.
+        elif self.state != NodeStates.LEADER:
+            leader_ping_delta = self.__current_time_millis() - self.last_leader_ping
+            logger.info("Too long without a leader, initiating transaction. (%s since last leader comms, willing to wait for %s).", leader_ping_delta, self.election_timeout)
+            self.__start_election()
+        self.__reset_election_timer()
@@ -1,58 +1,19 @@
 from argparse import ArgumentParser
-from commons import RPCPacket, OverseerCommands
-from gevent import Greenlet, monkey
-from gevent.server import StreamServer
-from typing import List
+from overseercore import BackpressurePolicies, DEFAULT_CLIENT_TIMEOUT, DEFAULT_OUTBOX_SIZE
+from typing import Optional
 
 import commons
-import gevent
 import logging
+import metrics
 import os
+import shards
 
 """
-The Overseer protocol is a RS-delimited (byte 1E) protocol which follows the
-following guidelines. This is the RPC router/mechanism between raftel nodes:
-
-- All transmissions are wrapped around STX (2) and ETX (3) bytes. Immediately
-after the STX, is the packet number which is eight bits (so wrap around 256).
-After that is the command.
-
-- Commands (between STX and ETX) follow the format <command><RS><args...>
-where arguments are also RS delimited.
-
-# Reserved instructions for Overseer.
-
-- Responses will have either ACK or NACK for their commmand field.
-
-- Responses will take the form <ACK OR NACK><RS><ADDITIONAL INFO>. The data in
-the additional info field is also separated with RS, where it applies.
-
-- Every command will be ACKed (6) or NACKed (15), depending on whether the
-transaction is successful or not. NACKs will give the following reasons:
-    
-    Z - General failure
-    Y - Malformed packet, please retransmit.
-    X - Invalid/unknown command.
-
-Responses will also start with the packet number they are acknowledging.
-
-- When a client connects to the Overseer, it connects with a log-in command (A).
-The acknowledgement will return the candidate id in the additional info section.
-
-- Graceful termination would happen by sending a log-out command (B).
-
-- During idle times, each node should send a keep alive (C) to the Overseer.
-This is distinct from the leader heartbeat specified in the Raft protocol.
-
-# Raft-specific commands
-
-Note that these are commands received by the overseer, for propagation.
-
-D - Request Vote
+Runs the Overseer from the command line, served by either backend: gevent
+(geventoverseer) or asyncio (aiooverseer). Only the chosen backend is
+imported, so the asyncio one works without gevent installed.
 """
 
-monkey.patch_all()
-
 LOGGER_NAME = "raftel-overseer"
 logger = logging.getLogger(LOGGER_NAME)
 logger.setLevel(int(os.environ.get("raftel_log_level", logging.INFO)))
@@ -68,165 +29,6 @@ stream_handler.setFormatter(formatter)
 logger.addHandler(file_handler)
 logger.addHandler(stream_handler)
 
-class ClientHandler(Greenlet):
-
-    def __init__(
-        self,
-        client_socket: gevent._socket3.socket,
-        clientid: int,
-        max_bad_transactions: int = 5
-    ) -> None:
-        Greenlet.__init__(self)
-        self.client_socket = client_socket
-        self.clientid = clientid # type: int
-        self.expected_packet_number = 1 # type: int
-        self.max_bad_transactions = max_bad_transactions # type: int
-
-        self.bad_transaction_count = 0 # type: int
-
-    def __state_validate(self, parsed_packet: RPCPacket) -> bool:
-        """
-        This validation takes into account the actual state of our connection so
-        far with the client. Ensures client cannot issue commands that may be
-        legal RPC packets but are illegal under present circumstances.
-        """
-        return parsed_packet.packet_number == self.expected_packet_number
-
-    def __make_response(self, parsed_packet: RPCPacket) -> RPCPacket:
-        # TODO Handle unknown command
-        response = None
-
-        if not parsed_packet.validate():
-            response = RPCPacket(
-                parsed_packet.packet_number, OverseerCommands.NACK,
-                (OverseerCommands.MALFORMED_PKT,)
-            )
-        elif not self.__state_validate(parsed_packet):
-            response = RPCPacket(
-                parsed_packet.packet_number, OverseerCommands.NACK,
-                (OverseerCommands.GENERAL_FAILURE.value,)
-            )
-            ack = RPCPacket(parsed_packet.packet_number, OverseerCommands.ACK)
-        else:
-            response = RPCPacket(parsed_packet.packet_number, OverseerCommands.ACK)
-            self.bad_transaction_count = 0
-
-        if response.command == OverseerCommands.NACK:
-            logger.warn("Bad transaction from %s." % self.clientid)
-            self.bad_transaction_count += 1
-
-        return response
-
-    def __read_from_client(self, client_socket: gevent._socket3.socket, _packet_acc=None) -> List[int]:
-        packet_acc = _packet_acc if _packet_acc else [] # type: List[int]
-
-        while commons.ETX not in packet_acc:
-            p = client_socket.recvfrom(32)
-            logger.debug("Raw RECV from socket: %s" % str(p))
-            if not len(p[0]):
-                logger.critical("Received nothing from socket %s, breaking read loop..." % self.client_socket)
-                break
-            packet_acc.extend(p[0])
-            gevent.sleep(0.5)
-
-        return packet_acc
-
-    def __partition_read_dump(self, read_dump):
-        """
-        Divide read_dump on the first ETX character present. The first ETX
-        character will be returned as part of the first partition.
-        """
-        # Just use ETX as a sentinel character for now. Actual checking that the
-        # packet is sandwiched between STX and ETX should happen when the stream
-        # is actually parsed.
-        etx_index = read_dump.index(commons.ETX)
-        return (read_dump[0:etx_index + 1], read_dump[etx_index + 1:])
-
-    def _run(self):
-        read_so_far = []
-        while True:
-            logger.debug("Reading from socket...")
-            read_packet, read_so_far = self.__partition_read_dump(
-                self.__read_from_client(self.client_socket, read_so_far)
-            )
-            recv = RPCPacket.parse(read_packet)
-            logger.info("RECV %s" % recv)
-            resp = self.__make_response(recv)
-            logger.info("SEND %s" % resp)
-            self.client_socket.sendall(resp.make_sendable_stream())
-            self.expected_packet_number = (self.expected_packet_number + 1) % 256
-            if self.bad_transaction_count >= self.max_bad_transactions:
-                logger.critical(
-                    "Client %s hit %s consecutive bad transactions (limit: %s)" % 
-                    (self.clientid, self.bad_transaction_count, self.max_bad_transactions)
-                )
-                self.kill()
-            gevent.sleep(1)
-
-class OverSeerver(StreamServer):
-    """
-    The Overseer facilitates a whole distributed cluster. Nodes of a cluster
-    only need to sign up to the Overseer and it will facilitate communication
-    with the rest of the cluster.
-
-    Note that even if it was written with Raft in mind, this can also be used
-    for other cluster set-ups. All you need to do is change the Greenlet spun
-    up for each new client.
-    """
-
-    def __init__(self, bind_port: int, max_bad_transactions: int = 5, **kwargs) -> None:
-        super(OverSeerver, self).__init__(("127.0.0.1", bind_port))
-        self.leader = None
-        self.socket_clique = [] # type: list
-        # In Java-speak, this member should be synchronized.
-        self.client_id = 1
-        self.max_bad_transactions = max_bad_transactions
-
-    def __make_response(self, parsed_recv: RPCPacket) -> RPCPacket:
-        if parsed_recv.validate():
-            logger.debug("Calling RPCPacket for ACK")
-            ack = RPCPacket(parsed_recv.packet_number, OverseerCommands.ACK)
-
-            # Add additional_info that might be relevant
-            if parsed_recv.command == OverseerCommands.LOGIN:
-                ack.additional_info = [self.client_id]
-                self.client_id += 1
-            return ack
-
-    def __read_from_client(self, client_socket: gevent._socket3.socket, _packet_acc=None) -> List[int]:
-        packet_acc = _packet_acc if _packet_acc else [] # type: List[int]
-
-        while commons.ETX not in packet_acc:
-            # TODO Refactor this with ClientHandler above.
-            p = client_socket.recvfrom(32)
-            logger.debug(p)
-            if not len(p[0]):
-                logger.critical("Client pinged but did not complete initial handshake.")
-                break
-            packet_acc.extend(p[0])
-
-        return packet_acc
-
-    def handle(self, client_socket: gevent._socket3.socket, address):
-        logger.info("connection RECV %s" % client_socket)
-        packet_acc = self.__read_from_client(client_socket) # type: List[int]
-        
-        parsed_packet = RPCPacket.parse(packet_acc)
-        logger.info("RECV %s" % parsed_packet)
-        ch = ClientHandler(client_socket, self.client_id)
-        resp = self.__make_response(parsed_packet)
-        if parsed_packet.command == OverseerCommands.LOGIN and resp.command == OverseerCommands.ACK:
-            self.socket_clique.append(client_socket)
-        logger.info("SEND %s" % resp)
-        logger.info("Spawning greenlet for %s" % client_socket)
-        client_socket.sendall(resp.make_sendable_stream())
-        ch.start()
-        ch.join()
-        gevent.sleep()
-        logger.info("Killing greenlet %s" % client_socket)
-        ch.kill()
-        logger.info("Greenlet %s dead" % client_socket)
-
 if __name__ == "__main__":
     parser = ArgumentParser(description="An RPC overseer for facilitating RAFT.")
     parser.add_argument(
@@ -234,10 +36,84 @@ if __name__ == "__main__":
         help="The port to which the overseer will bind and listen for connections."
     )
     parser.add_argument(
-        "--max-bad-transactions", "-x", required=False, default=5,
+        "--max-bad-transactions", "-x", required=False, type=int, default=5,
         help="Max consecutive transactions that are NACKed before forcefully disconnecting client."
     )
+    parser.add_argument(
+        "--window", "-w", required=False, type=int, default=commons.DEFAULT_WINDOW_SIZE,
+        help="How many packets a client may have in flight at once (at most %s)." % commons.MAX_WINDOW_SIZE
+    )
+    parser.add_argument(
+        "--outbox-size", required=False, type=int, default=DEFAULT_OUTBOX_SIZE,
+        help="How many frames may queue up for a client before backpressure applies."
+    )
+    parser.add_argument(
+        "--backpressure", required=False, type=BackpressurePolicies,
+        default=BackpressurePolicies.BLOCK, choices=list(BackpressurePolicies),
+        help="What to do when a client's outbox is full."
+    )
+    parser.add_argument(
+        "--client-timeout", "-t", required=False, type=int, default=DEFAULT_CLIENT_TIMEOUT,
+        help="Disconnect clients silent for this long. Measured in milliseconds."
+    )
+    parser.add_argument(
+        "--workers", "-n", required=False, type=int, default=1,
+        help="Worker processes sharing the port, each owning a share of the clients."
+    )
+    parser.add_argument(
+        "--backend", "-b", required=False, choices=("gevent", "asyncio"), default="gevent",
+        help="Which I/O framework serves connections."
+    )
+    parser.add_argument(
+        "--uvloop", required=False, action="store_true",
+        help="Run the asyncio backend on uvloop (must be installed)."
+    )
+    parser.add_argument(
+        "--metrics-port", required=False, type=int, default=None,
+        help="Serve metrics over HTTP on this port of the loopback interface (plus the worker index when sharded)."
+    )
+    parser.add_argument(
+        "--packet-log-every", required=False, type=int, default=metrics.DEFAULT_PACKET_LOG_EVERY,
+        help="At log level DEBUG, log one packet in every this many (1 for all, 0 for none)."
+    )
+    parser.add_argument(
+        "--capture", required=False, type=str, default=None,
+        help="Record every frame clients send to a binary trace at this path (plus .N per worker when sharded)."
+    )
     args = vars(parser.parse_args())
-    overseer = OverSeerver(args["port"], args["max_bad_transactions"])
-    logger.info("Starting overseer...")
-    overseer.serve_forever()
+    server_args = (
+        args["port"], args["max_bad_transactions"], args["window"],
+        args["outbox_size"], args["backpressure"], args["client_timeout"]
+    )
+
+    def serve(shard_index: int = 0, shard_dir: Optional[str] = None) -> None:
+        shard_args = (shard_index, args["workers"], shard_dir)
+        if args["backend"] != "asyncio":
+            from gevent import monkey
+            monkey.patch_all()
+        # Started in the worker, and after patching, so that it ends up in
+        # the right process as the right kind of thread.
+        metrics.log_off_thread(logger)
+        metrics.sample_packets(logger, args["packet_log_every"])
+        logger.info("Starting overseer (worker %s of %s)...", shard_index + 1, args["workers"])
+        if args["backend"] == "asyncio":
+            import aiooverseer
+            aiooverseer.run(
+                aiooverseer.AsyncioOverseer(
+                    *(server_args + shard_args), metrics_port=args["metrics_port"],
+                    capture_path=args["capture"]
+                ),
+                args["uvloop"]
+            )
+        else:
+            import geventoverseer
+            overseer = geventoverseer.OverSeerver(
+                *(server_args + shard_args), metrics_port=args["metrics_port"],
+                capture_path=args["capture"]
+            )
+            overseer.serve_forever()
+
+    if args["workers"] > 1:
+        shards.run_workers(args["workers"], serve)
+    else:
+        serve()
@@ -0,0 +1,954 @@
+from capture import PacketCapture
+from commons import (
+    BROADCAST_COMMANDS, UNICAST_COMMANDS, FrameDecoder, FramingError, PacketError, RPCPacket, OverseerCommands
+)
+from enum import Enum
+from metrics import MetricsRegistry
+from timerwheel import TimerWheel
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import commons
+import logging
+import metrics
+import time
+
+"""
+The Overseer protocol is a RS-delimited (byte 1E) protocol which follows the
+following guidelines. This is the RPC router/mechanism between raftel nodes:
+
+- All transmissions are wrapped around STX (2) and ETX (3) bytes. Immediately
+after the STX, is the packet number which is eight bits (so wrap around 256).
+After that is the command.
+
+- Commands (between STX and ETX) follow the format <command><RS><args...>
+where arguments are also RS delimited.
+
+- Nodes may offer a higher wire format version as the sole argument of their
+log-in command. Version 2 frames are length-prefixed rather than ETX
+terminated: <SOH><version><length:u32><packet number:u8><command:u8><payload>,
+where the payload is <argc:u16>, argc big-endian signed 64-bit arguments and
+then opaque data. The log-in ACK and everything after it use the negotiated
+version; nodes that offer nothing keep the RS-delimited format described here.
+Version 3 frames add the <group:u32> of the Raft group a packet is for at the
+start of the payload; earlier versions only speak for group 0. A 3 cannot be
+framed RS-delimited (it is ETX), so nodes offering v3 send LOGIN as a v2 frame.
+
+# Reserved instructions for Overseer.
+
+- Responses will have either ACK or NACK for their commmand field.
+
+- Responses will take the form <ACK OR NACK><RS><ADDITIONAL INFO>. The data in
+the additional info field is also separated with RS, where it applies.
+
+- Every command will be ACKed (6) or NACKed (15), depending on whether the
+transaction is successful or not. NACKs will give the following reasons:
+    
+    Z - General failure
+    Y - Malformed packet, please retransmit.
+    X - Invalid/unknown command.
+
+Frames that cannot be parsed are NACKed as malformed, or as invalid if only
+their command is unknown, and so are commands clients are not meant to send.
+Responses will also start with the packet number they are acknowledging.
+Clients may pipeline requests: any packet number within the window (by default
+32) following the oldest unacknowledged one is accepted, and responses are
+matched by packet number rather than by order.
+
+- When a client connects to the Overseer, it connects with a log-in command (A).
+The acknowledgement will return the candidate id in the additional info section.
+
+- Nodes that accept direct connections from each other (v2 only, so their
+LOGIN is already a v2 frame) follow the version with <host><port>, the IPv4
+address (as an unsigned 32-bit integer) and port they listen on. Their ACK
+carries <id><host><port> for every other logged-in node after the version,
+port 0 marking nodes only reachable through the overseer, and they are sent
+J - Peer Update: <client id><host><port><joined (1) or left (0)> with packet
+number 0 whenever a node logs in or goes away. Such nodes send each other Raft
+commands directly, in the form the overseer would deliver them in, and only
+fall back on the overseer while a direct connection is down.
+
+- Graceful termination would happen by sending a log-out command (B).
+
+- During idle times, each node should send a keep alive (C) to the Overseer.
+This is distinct from the leader heartbeat specified in the Raft protocol.
+Nodes that send nothing at all for the client timeout are disconnected.
+
+# Raft-specific commands
+
+Note that these are commands received by the overseer, for propagation. The
+overseer relays them to other nodes with packet number 0. Node-originated
+packet numbers wrap around through 0 as well, so nodes tell relayed packets
+from the overseer's answers by their command, not their packet number; they
+do not respond to relayed packets with ACK/NACK.
+
+Broadcast commands are sent to every other logged-in node, with the sender's
+id prepended to the arguments. Their ACK carries the number of nodes reached.
+
+Unicast commands name their target node id as the first argument. The
+overseer replaces it with the sender's id before delivery, and NACKs with a
+general failure when the target is not logged in.
+
+Nodes speaking v1 only get the relayed packets v1 can carry: no data, and
+arguments that are single bytes other than 2, 3 and 1E. They count as not
+reached for any other broadcast, and as not logged in for any other unicast.
+v1 ACKs of broadcasts carry no count.
+
+D - Request Vote (broadcast): <term><last log index><last log term>
+E - Vote (unicast): <candidate id><term><granted (1) or not (0)>
+F - Append Entries (unicast): <follower id><term><prev log index>
+    <prev log term><leader commit>, with the entries as data (v2 only), each
+    one <term:u64><length:u32><bytes>.
+G - Append Response (unicast): <leader id><term><outcome><index><round>, where the
+    outcome is rejected (0, index is where the leader should back off to),
+    accepted (1, index is the last entry now matching the leader's), a
+    heartbeat reply (2, index is the follower's last log index) or a snapshot
+    chunk received (3, index is how many bytes of it arrived so far, or -1 to
+    start the transfer over). round echoes that of a heartbeat, else is 0.
+H - Heartbeat (broadcast): <term><leader commit><round>, where round numbers
+    the leader's heartbeats so it can tell which of them were answered.
+I - Install Snapshot (unicast): <follower id><term><last included index>
+    <last included term><offset><total size>, with a chunk of the snapshot
+    as data. The chunk completing the snapshot is answered as accepted.
+
+# Raft groups
+
+One connection may serve many independent Raft groups, each packet naming its
+group in the v3 header. Every node is in group 0; other groups are joined and
+left with
+
+K - Join Group: <joined (1) or left (0)>, sent with the group in the header.
+
+and broadcasts for a group only reach its members. Leaders of several groups
+send their heartbeats for them together, and followers answer them together:
+
+L - Heartbeats (broadcast): <group><term><leader commit><round> for each
+    group. Every member of any of the groups gets those of its own groups
+    only, and the ACK carries how many nodes each group's heartbeat reached.
+M - Heartbeat Replies (unicast): <leader id>, then <group><term><last log
+    index><round> for each group, each as the HEARTBEAT reply of G would be.
+
+# Monitoring
+
+N - Stats: ACKed with the overseer's metrics (see metrics) as text in the
+    data, so v2 and later only. Tools may send it instead of LOGIN, with the
+    version they speak as its argument; the overseer then answers and hangs up
+    without ever counting them as a client.
+
+# Batching
+
+Clients may send several packets in one frame, v2 and later only:
+
+O - Batch: no arguments, and complete frames packed back to back as data,
+    each with a packet number of its own in the window. They are handled in
+    order as if sent one by one. The batch itself has packet number 0 and
+    takes no place in the window; batches do not nest.
+
+A batch is answered with a single BATCH of packet number 0, whose arguments
+are the packet numbers that were simply ACKed and whose data holds the frames
+of every other response (NACKs, and ACKs carrying anything), in order. Batches
+are answered in the order they were sent, and a packet of a batch that its
+answer leaves out, as happens when the batch cannot be taken apart, counts as
+NACKed.
+"""
+
+logger = logging.getLogger("raftel-overseer")
+# Every packet in and out, sampled; see metrics.
+packet_log = metrics.packet_log("raftel-overseer")
+
+# What logged-in clients may send; anything else is NACKed as invalid.
+CLIENT_COMMANDS = frozenset((
+    OverseerCommands.LOGOUT, OverseerCommands.KEEP_ALIVE, OverseerCommands.JOIN_GROUP,
+    OverseerCommands.STATS, OverseerCommands.BATCH
+)) | BROADCAST_COMMANDS | UNICAST_COMMANDS
+
+DEFAULT_OUTBOX_SIZE = 1024 # type: int
+# Three node keep-alive intervals at the node's default.
+DEFAULT_CLIENT_TIMEOUT = 90000 # type: int
+LIVENESS_TICK_MS = 100 # type: int
+
+class BackpressurePolicies(Enum):
+    """
+    What to do when a client's outbox is full because it is not reading.
+    """
+    # Make whoever is sending to the client wait.
+    BLOCK = "block"
+    # Discard keep-alive ACKs, wait for anything else. Nodes treat any later
+    # response as implying the keep-alives before it got through.
+    DROP_KEEP_ALIVE = "drop-keep-alive"
+    # Disconnect the client.
+    DISCONNECT = "disconnect"
+
+    def __str__(self):
+        return self.value
+
+class ShardMessages(Enum):
+    """
+    Kinds of frames exchanged between the worker processes of a sharded
+    overseer, carried as the first argument of the forwarded packet.
+    """
+    BROADCAST = 0
+    UNICAST = 1
+    # The sending shard's number of logged-in clients, or of members of the
+    # packet's group.
+    CLIENT_COUNT = 2
+    # A client of the sending shard logged in or went away, as the arguments
+    # of the corresponding PEER_UPDATE.
+    MEMBER = 3
+
+def shard_frame(message: ShardMessages, source_id: int, packet: RPCPacket) -> bytes:
+    """
+    Wrap packet for another shard: <message><source id><original args...>,
+    always in the v2 format since shards are all this same version.
+    """
+    return RPCPacket(
+        0, packet.command, [message.value, source_id] + packet.additional_info,
+        data=packet.data, group=packet.group
+    ).make_sendable_stream(commons.PROTOCOL_VERSION)
+
+class ShardLink(object):
+    """
+    The backend-specific, outbound half of a connection to another shard.
+    """
+
+    def push(self, frame: bytes) -> None:
+        """
+        Queue an encoded frame for the other shard. Must not block.
+        """
+        raise NotImplementedError()
+
+class ClientTransport(object):
+    """
+    The backend-specific half of a client connection: how frames reach the
+    client and how the connection is torn down. Backends (gevent, asyncio)
+    implement this and leave the protocol itself to ClientSession.
+    """
+
+    def push(self, frame: bytes, droppable: bool = False) -> bool:
+        """
+        Queue an already encoded frame for delivery, applying the backpressure
+        policy if the client is not keeping up. droppable marks frames that
+        the DROP_KEEP_ALIVE policy may discard. Returns whether the frame was
+        queued.
+        """
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        """
+        Disconnect the client once whatever is already queued has been sent.
+        """
+        raise NotImplementedError()
+
+class ClientSession(object):
+    """
+    Protocol state of one logged-in client, independent of how bytes move.
+    """
+
+    def __init__(
+        self,
+        core: "OverseerCore",
+        clientid: int,
+        transport: ClientTransport,
+        version: int = commons.PROTOCOL_V1,
+        address: Optional[Tuple[int, int]] = None
+    ) -> None:
+        self.core = core # type: OverseerCore
+        self.clientid = clientid # type: int
+        self.transport = transport # type: ClientTransport
+        # Wire format negotiated at LOGIN, used for everything we send back.
+        self.version = version # type: int
+        # (host, port) other nodes can reach this one on directly, if any.
+        self.address = address # type: Optional[Tuple[int, int]]
+        # Raft groups joined besides group 0.
+        self.groups = set() # type: Set[int]
+        # Lowest packet number not received yet; the window starts here.
+        self.expected_packet_number = 1 # type: int
+        # Packet numbers received ahead of expected_packet_number.
+        self.received_ahead = set() # type: Set[int]
+
+        self.bad_transaction_count = 0 # type: int
+        self.closed = False # type: bool
+
+    def __state_validate(self, parsed_packet: RPCPacket) -> bool:
+        """
+        This validation takes into account the actual state of our connection so
+        far with the client. Ensures client cannot issue commands that may be
+        legal RPC packets but are illegal under present circumstances.
+
+        Clients may have up to window_size packets in flight, so any packet
+        number in the window that was not seen yet is accepted.
+        """
+        return self.__in_window(parsed_packet.packet_number)
+
+    def __in_window(self, packet_number: int) -> bool:
+        offset = (packet_number - self.expected_packet_number) % 256
+        return offset < self.core.window_size and packet_number not in self.received_ahead
+
+    def __slide_window(self, packet_number: int) -> None:
+        self.received_ahead.add(packet_number)
+        while self.expected_packet_number in self.received_ahead:
+            self.received_ahead.remove(self.expected_packet_number)
+            self.expected_packet_number = (self.expected_packet_number + 1) % 256
+
+    def __make_response(self, parsed_packet: RPCPacket) -> bytes:
+        """
+        Returns the encoded reply frame. Most are fixed-shape, so they come
+        straight from the pre-encoded response cache.
+        """
+        if not parsed_packet.validate():
+            # The packet number itself may be what is broken. Echo back what
+            # fits in a byte so the client can still correlate.
+            response = self.__nack(parsed_packet.packet_number % 256, OverseerCommands.MALFORMED_PKT)
+        elif not self.__state_validate(parsed_packet):
+            response = self.__nack(parsed_packet.packet_number, OverseerCommands.GENERAL_FAILURE)
+        elif parsed_packet.command not in CLIENT_COMMANDS:
+            # Well-formed, so it still takes its place in the window.
+            self.__slide_window(parsed_packet.packet_number)
+            response = self.__nack(parsed_packet.packet_number, OverseerCommands.INVALID_CMD)
+        else:
+            self.__slide_window(parsed_packet.packet_number)
+            self.bad_transaction_count = 0
+            return self.__dispatch(parsed_packet)
+
+        logger.warning("Bad transaction from %s.", self.clientid)
+        self.bad_transaction_count += 1
+        return response
+
+    def __reject(self, error: PacketError) -> bytes:
+        """
+        Returns the NACK for a frame that could not be parsed. One whose
+        command alone is unknown still takes its place in the window.
+        """
+        logger.warning("Bad packet from %s: %s", self.clientid, error)
+        if error.reason == OverseerCommands.INVALID_CMD and self.__in_window(error.packet_number):
+            self.__slide_window(error.packet_number)
+        self.bad_transaction_count += 1
+        return self.__nack(error.packet_number, error.reason)
+
+    def __nack(self, packet_number: int, reason: OverseerCommands) -> bytes:
+        self.core.nacks_sent.inc(reason.name)
+        return commons.nack_frame(packet_number, reason, self.version)
+
+    def __dispatch(self, parsed_packet: RPCPacket) -> bytes:
+        """
+        Act on a packet that passed validation and return the reply frame.
+        """
+        command = parsed_packet.command
+        if command == OverseerCommands.LOGOUT:
+            logger.info("Client %s logged out.", self.clientid)
+            self.close()
+        elif command == OverseerCommands.JOIN_GROUP:
+            joined = not parsed_packet.additional_info or bool(parsed_packet.additional_info[0])
+            self.core.join_group(self, parsed_packet.group, joined)
+        elif command in BROADCAST_COMMANDS:
+            ack = RPCPacket(
+                parsed_packet.packet_number, OverseerCommands.ACK,
+                self.core.broadcast(self.clientid, parsed_packet)
+            )
+            if self.version == commons.PROTOCOL_V1 and not ack.fits_v1():
+                # Old nodes never expected the count anyway.
+                return commons.ack_frame(parsed_packet.packet_number, self.version)
+            return ack.make_sendable_stream(self.version)
+        elif command in UNICAST_COMMANDS:
+            if not self.core.unicast(self.clientid, parsed_packet):
+                return self.__nack(parsed_packet.packet_number, OverseerCommands.GENERAL_FAILURE)
+        elif command == OverseerCommands.STATS:
+            if self.version == commons.PROTOCOL_V1:
+                return self.__nack(parsed_packet.packet_number, OverseerCommands.INVALID_CMD)
+            return self.core.stats_frame(parsed_packet.packet_number, self.version)
+        elif command == OverseerCommands.BATCH:
+            # Only reached by batches within batches, or by v1 clients.
+            return self.__nack(parsed_packet.packet_number, OverseerCommands.INVALID_CMD)
+
+        return commons.ack_frame(parsed_packet.packet_number, self.version)
+
+    def handle_packet(self, recv: RPCPacket) -> None:
+        # Formatted lazily: most packets are never logged at all.
+        packet_log.log("RECV %s", recv)
+        self.core.packets_received.inc(recv.command.name)
+        self.core.touch(self.clientid)
+        if recv.command == OverseerCommands.BATCH and self.version != commons.PROTOCOL_V1:
+            self.__handle_batch(recv)
+            return
+        resp = self.__make_response(recv)
+        packet_log.log("SEND %s", resp)
+        self.transport.push(resp, droppable=recv.command == OverseerCommands.KEEP_ALIVE)
+        self.__check_bad_transactions()
+
+    def __handle_batch(self, batch: RPCPacket) -> None:
+        """
+        Handle every packet of a BATCH in one pass and answer them all in one
+        frame.
+        """
+        acked = [] # type: List[int]
+        responses = [] # type: List[bytes]
+        try:
+            for frame in commons.split_frames(batch.data):
+                try:
+                    recv = RPCPacket.parse(frame)
+                except PacketError as e:
+                    responses.append(self.__reject(e))
+                else:
+                    packet_log.log("RECV %s", recv)
+                    self.core.packets_received.inc(recv.command.name)
+                    resp = self.__make_response(recv)
+                    if resp == commons.ack_frame(recv.packet_number, self.version):
+                        acked.append(recv.packet_number)
+                    else:
+                        responses.append(resp)
+                if self.closed or self.bad_transaction_count >= self.core.max_bad_transactions:
+                    break
+        except ValueError as e:
+            # Where the rest of the frames are is anyone's guess. Leaving them
+            # unanswered has the client count them as NACKed.
+            logger.warning("Bad batch from %s: %s", self.clientid, e)
+            self.bad_transaction_count += 1
+
+        self.core.batch_size.observe(len(acked) + len(responses))
+        self.__answer_batch(acked, responses)
+
+    def __answer_batch(self, acked: List[int], responses: List[bytes]) -> None:
+        resp = RPCPacket(
+            0, OverseerCommands.BATCH, acked, data=b"".join(responses)
+        ).make_sendable_stream(self.version)
+        packet_log.log("SEND %s", resp)
+        self.transport.push(resp)
+        self.__check_bad_transactions()
+
+    def __check_bad_transactions(self) -> None:
+        if self.bad_transaction_count >= self.core.max_bad_transactions:
+            logger.critical(
+                "Client %s hit %s consecutive bad transactions (limit: %s)",
+                self.clientid, self.bad_transaction_count, self.core.max_bad_transactions
+            )
+            self.core.bad_transaction_disconnects.inc()
+            self.close()
+
+    def receive(self, decoder: FrameDecoder) -> bool:
+        """
+        Handle every complete frame buffered in decoder. Returns False once the
+        session is over and the connection should stop being read.
+        """
+        parse_time = self.core.parse_time
+        capture = self.core.capture
+        try:
+            for frame in decoder.frames():
+                if capture is not None:
+                    capture.frame(self.clientid, frame)
+                started = time.perf_counter_ns()
+                try:
+                    packet = RPCPacket.parse(frame)
+                except PacketError as e:
+                    self.__answer_error(e)
+                else:
+                    parse_time.observe(time.perf_counter_ns() - started)
+                    self.handle_packet(packet)
+                if self.closed:
+                    return False
+        except FramingError as e:
+            # Where the next frame would start is anyone's guess.
+            self.__answer_error(e)
+            self.close()
+            return False
+        return True
+
+    def __answer_error(self, error: PacketError) -> None:
+        self.core.touch(self.clientid)
+        if error.command == OverseerCommands.BATCH.value and self.version != commons.PROTOCOL_V1:
+            # A batch has packet number 0, which nothing waits on. An empty
+            # answer has the client count all of it as NACKed.
+            logger.warning("Bad batch from %s: %s", self.clientid, error)
+            self.bad_transaction_count += 1
+            self.__answer_batch([], [])
+        else:
+            self.transport.push(self.__reject(error))
+            self.__check_bad_transactions()
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.transport.close()
+
+class OverseerCore(object):
+    """
+    Everything the overseer does that does not depend on how connections are
+    served: id allocation, version negotiation, the client registry, routing
+    and liveness tracking. Backends feed it packets and call reap() every
+    LIVENESS_TICK_MS.
+    """
+
+    def __init__(
+        self,
+        max_bad_transactions: int = 5,
+        window_size: int = commons.DEFAULT_WINDOW_SIZE,
+        client_timeout: int = DEFAULT_CLIENT_TIMEOUT,
+        shard_index: int = 0,
+        shard_count: int = 1,
+        clock: Callable[[], int] = commons.monotonic_millis,
+        capture: Optional[PacketCapture] = None
+    ) -> None:
+        """
+        shard_index and shard_count describe this core's place among the
+        worker processes of a sharded overseer (see shards). Each shard hands
+        out client ids from its own residue class modulo shard_count, so ids
+        never clash and the shard owning any id is known without asking.
+
+        clock returns the time liveness is tracked against, in milliseconds;
+        simulations substitute a virtual one.
+
+        With a capture, every frame logged-in clients send is recorded to it
+        (see capture), flushed every LIVENESS_TICK_MS.
+        """
+        commons.check_window_size(window_size)
+        if not 0 <= shard_index < shard_count:
+            raise ValueError("Shard %s out of %s does not exist." % (shard_index, shard_count))
+        self.leader = None
+        # Every logged-in client, by client id.
+        self.clients = {} # type: Dict[int, ClientSession]
+        self.shard_index = shard_index # type: int
+        self.shard_count = shard_count # type: int
+        # Outbound links to the other shards, by shard index, and how many
+        # clients each of them last reported.
+        self.shard_links = {} # type: Dict[int, ShardLink]
+        # By group, then by shard.
+        self.remote_client_counts = {} # type: Dict[int, Dict[int, int]]
+        # Members of every group but 0, which everyone is in, by group.
+        self.group_members = {} # type: Dict[int, Set[int]]
+        # Clients of other shards by id, as (host, port) with port 0 for
+        # those that take no direct connections.
+        self.remote_members = {} # type: Dict[int, Tuple[int, int]]
+        # Only ever touched by this process, so no synchronization is needed
+        # even when sharded.
+        self.client_id = shard_index + 1
+        self.max_bad_transactions = max_bad_transactions
+        self.window_size = window_size
+        # Clients silent for client_timeout milliseconds are disconnected.
+        self.client_timeout = client_timeout
+        self.clock = clock # type: Callable[[], int]
+        self.liveness = TimerWheel(LIVENESS_TICK_MS, now=clock())
+        self.capture = capture # type: Optional[PacketCapture]
+
+        self.metrics = MetricsRegistry("raftel_overseer") # type: MetricsRegistry
+        self.packets_received = self.metrics.counter(
+            "packets_received_total", "Packets received from logged-in clients, by command.", "command"
+        )
+        self.nacks_sent = self.metrics.counter(
+            "nacks_sent_total", "NACKs sent, by reason.", "reason"
+        )
+        self.bad_transaction_disconnects = self.metrics.counter(
+            "bad_transaction_disconnects_total",
+            "Clients disconnected for too many consecutive bad transactions."
+        )
+        self.timeouts = self.metrics.counter(
+            "client_timeouts_total", "Clients disconnected for staying silent too long."
+        )
+        self.parse_time = self.metrics.histogram(
+            "parse_time_ns", "Time taken to parse a received frame, in nanoseconds."
+        )
+        # Observed by backends as they queue frames for a client.
+        self.outbox_depth = self.metrics.histogram(
+            "outbox_depth", "Frames already queued for a client when another is queued."
+        )
+        self.batch_size = self.metrics.histogram(
+            "batch_size", "Packets received together in one BATCH."
+        )
+        self.v1_relays_skipped = self.metrics.counter(
+            "v1_relays_skipped_total", "Relayed packets v1 clients were left out of, by command.", "command"
+        )
+        self.metrics.gauge("clients", "Clients logged in to this overseer.", lambda: len(self.clients))
+
+    def __negotiate_version(self, login: RPCPacket) -> int:
+        """
+        Nodes that understand later wire formats offer their highest version
+        as the first argument of LOGIN (or STATS). Old nodes send no arguments
+        and keep talking v1.
+        """
+        if (
+            login.command not in (OverseerCommands.LOGIN, OverseerCommands.STATS) or
+            not login.additional_info
+        ):
+            return commons.PROTOCOL_V1
+        return max(commons.PROTOCOL_V1, min(login.additional_info[0], commons.PROTOCOL_VERSION))
+
+    def __direct_address(self, login: RPCPacket, version: int) -> Optional[Tuple[int, int]]:
+        if version == commons.PROTOCOL_V1 or len(login.additional_info) < 3:
+            return None
+        host, port = login.additional_info[1:3]
+        return (host, port) if port > 0 else None
+
+    def __members(self, exclude: int) -> List[int]:
+        """
+        <id><host><port> for every client but exclude, flattened.
+        """
+        members = [] # type: List[int]
+        for client_id, session in self.clients.items():
+            if client_id != exclude:
+                members.extend((client_id,) + (session.address or (0, 0)))
+        for client_id, address in self.remote_members.items():
+            members.extend((client_id,) + address)
+        return members
+
+    def login(
+        self,
+        parsed_recv: RPCPacket,
+        transport: ClientTransport,
+        frame: Optional[bytes] = None
+    ) -> Tuple[Optional[ClientSession], bytes]:
+        """
+        Handle the first packet of a connection. Returns the new session (None
+        if the packet was not a valid LOGIN) and the reply frame, which the
+        backend must send before anything else. frame is the packet as
+        received, for the capture.
+        """
+        logger.info("RECV %s", parsed_recv)
+        version = self.__negotiate_version(parsed_recv)
+        if not parsed_recv.validate():
+            return (None, commons.nack_frame(
+                parsed_recv.packet_number % 256, OverseerCommands.MALFORMED_PKT, version
+            ))
+        elif parsed_recv.command == OverseerCommands.STATS and version != commons.PROTOCOL_V1:
+            return (None, self.stats_frame(parsed_recv.packet_number, version))
+        elif parsed_recv.command != OverseerCommands.LOGIN:
+            return (None, commons.nack_frame(
+                parsed_recv.packet_number, OverseerCommands.INVALID_CMD, version
+            ))
+
+        session = ClientSession(
+            self, self.client_id, transport, version, self.__direct_address(parsed_recv, version)
+        )
+        self.client_id += self.shard_count
+        self.clients[session.clientid] = session
+        if self.capture is not None and frame is not None:
+            self.capture.frame(session.clientid, frame)
+        self.touch(session.clientid)
+        self.__announce_client_count()
+        self.__announce_member(session.clientid, session.address or (0, 0), True)
+
+        # Add additional_info that might be relevant
+        ack = RPCPacket(parsed_recv.packet_number, OverseerCommands.ACK, [session.clientid])
+        if version != commons.PROTOCOL_V1:
+            ack.additional_info.append(version)
+        if session.address is not None:
+            ack.additional_info.extend(self.__members(session.clientid))
+        logger.info("SEND %s", ack)
+        # The LOGIN ACK already uses the negotiated format; a node offering v2
+        # can tell either framing apart.
+        return (session, ack.make_sendable_stream(version))
+
+    def login_frame(
+        self,
+        frame: bytes,
+        transport: ClientTransport
+    ) -> Tuple[Optional[ClientSession], bytes]:
+        """
+        login() for the first frame of a connection as received, which is
+        NACKed if it cannot even be parsed.
+        """
+        try:
+            parsed_recv = RPCPacket.parse(frame)
+        except PacketError as e:
+            logger.warning("Bad LOGIN: %s", e)
+            version = commons.PROTOCOL_V2 if frame[0] == commons.SOH else commons.PROTOCOL_V1
+            return (None, commons.nack_frame(e.packet_number, e.reason, version))
+        return self.login(parsed_recv, transport, frame)
+
+    def login_frames(
+        self,
+        decoder: FrameDecoder,
+        transport: ClientTransport
+    ) -> Optional[Tuple[Optional[ClientSession], bytes]]:
+        """
+        login_frame() for the first frame buffered in decoder, or None until
+        it is complete. Streams that cannot be framed get a NACK and no
+        session.
+        """
+        try:
+            for frame in decoder.frames():
+                return self.login_frame(frame, transport)
+        except FramingError as e:
+            logger.warning("Bad LOGIN: %s", e)
+            return (None, commons.nack_frame(e.packet_number, e.reason, e.version))
+        return None
+
+    def stats_frame(self, packet_number: int, version: int) -> bytes:
+        """
+        The answer to STATS: an ACK with the rendered metrics as data.
+        """
+        return RPCPacket(
+            packet_number, OverseerCommands.ACK, data=self.metrics.render().encode()
+        ).make_sendable_stream(version)
+
+    def unregister(self, session: ClientSession) -> None:
+        """
+        Stop routing to a client, whether it logged out or just went away.
+        """
+        if self.clients.get(session.clientid) is session:
+            for group in list(session.groups):
+                self.join_group(session, group, False)
+            del self.clients[session.clientid]
+            if self.capture is not None:
+                self.capture.closed(session.clientid)
+            self.__announce_client_count()
+            self.__announce_member(session.clientid, session.address or (0, 0), False)
+        self.liveness.cancel(session.clientid)
+
+    def join_group(self, session: ClientSession, group: int, joined: bool) -> None:
+        """
+        Add session to group, or remove it. Group 0 always has everyone.
+        """
+        if not group or (group in session.groups) == joined:
+            return
+        members = self.group_members.setdefault(group, set())
+        if joined:
+            session.groups.add(group)
+            members.add(session.clientid)
+        else:
+            session.groups.discard(group)
+            members.discard(session.clientid)
+            if not members:
+                del self.group_members[group]
+        self.__announce_client_count(group)
+
+    def __members_of(self, group: int) -> Iterable[Tuple[int, ClientSession]]:
+        if not group:
+            return list(self.clients.items())
+        return [(client_id, self.clients[client_id]) for client_id in self.group_members.get(group, ())]
+
+    def touch(self, client_id: int) -> None:
+        """
+        Record activity from a client, pushing back its liveness deadline.
+        """
+        self.liveness.schedule(client_id, self.clock() + self.client_timeout)
+
+    def reap(self) -> None:
+        """
+        Disconnect every client whose liveness deadline has passed.
+        """
+        if self.capture is not None:
+            self.capture.flush()
+        for client_id in self.liveness.advance(self.clock()):
+            session = self.clients.get(client_id)
+            if session is not None:
+                logger.warning(
+                    "No activity from %s in %s ms, disconnecting.", client_id, self.client_timeout
+                )
+                self.timeouts.inc()
+                session.close()
+
+    def __relay_frames(self, relayed: RPCPacket) -> Callable[[int], Optional[bytes]]:
+        """
+        Lazily encoded copies of a relayed packet, one per wire format, so that
+        a broadcast encodes once per version rather than once per client. None
+        for v1 if it cannot carry the packet.
+        """
+        frames = {} # type: Dict[int, Optional[bytes]]
+
+        def frame_for(version: int) -> Optional[bytes]:
+            if version not in frames:
+                frames[version] = self.__relay_frame(relayed, version)
+            return frames[version]
+
+        return frame_for
+
+    def __relay_frame(self, relayed: RPCPacket, version: int) -> Optional[bytes]:
+        """
+        relayed in the given wire format, or None if that is v1 and the packet
+        does not fit it: the arguments of Raft packets (terms, indices) soon
+        outgrow a byte. Such packets are not relayed to v1 clients, which
+        count as unreachable for them.
+        """
+        if version == commons.PROTOCOL_V1 and not relayed.fits_v1():
+            self.v1_relays_skipped.inc(relayed.command.name)
+            return None
+        return relayed.make_sendable_stream(version)
+
+    def __deliver_broadcast(self, source_id: int, packet: RPCPacket) -> List[int]:
+        if packet.command == OverseerCommands.HEARTBEATS:
+            return self.__deliver_heartbeats(source_id, packet)
+
+        relayed = RPCPacket(
+            0, packet.command, [source_id] + packet.additional_info, data=packet.data,
+            group=packet.group
+        )
+        frame_for = self.__relay_frames(relayed)
+        reached = 0
+        # Pushing may yield under backpressure, and the registry with it.
+        for client_id, session in self.__members_of(packet.group):
+            if client_id != source_id:
+                frame = frame_for(session.version)
+                if frame is not None:
+                    session.transport.push(frame)
+                    reached += 1
+        return [reached]
+
+    def __deliver_heartbeats(self, source_id: int, packet: RPCPacket) -> List[int]:
+        """
+        Hand every node the heartbeats of its own groups, all in one frame.
+        """
+        heartbeats = packet.additional_info
+        reached = [] # type: List[int]
+        # client id -> (session, [source id, heartbeats of its groups...])
+        relayed = {} # type: Dict[int, Tuple[ClientSession, List[int]]]
+        for i in range(0, len(heartbeats) - 3, 4):
+            count = 0
+            for client_id, session in self.__members_of(heartbeats[i]):
+                if client_id == source_id:
+                    continue
+                if client_id not in relayed:
+                    relayed[client_id] = (session, [source_id])
+                relayed[client_id][1].extend(heartbeats[i:i + 4])
+                count += 1
+            reached.append(count)
+        for session, additional_info in relayed.values():
+            frame = self.__relay_frame(
+                RPCPacket(0, OverseerCommands.HEARTBEATS, additional_info), session.version
+            )
+            if frame is not None:
+                session.transport.push(frame)
+                continue
+            # Not reached after all, in any of its groups.
+            for i in range(0, len(heartbeats) - 3, 4):
+                if heartbeats[i] == 0 or heartbeats[i] in session.groups:
+                    reached[i // 4] -= 1
+        return reached
+
+    def __deliver_unicast(self, source_id: int, target_id: int, packet: RPCPacket) -> bool:
+        session = self.clients.get(target_id)
+        if session is None:
+            return False
+
+        relayed = RPCPacket(
+            0, packet.command, [source_id] + packet.additional_info[1:], data=packet.data,
+            group=packet.group
+        )
+        frame = self.__relay_frame(relayed, session.version)
+        if frame is None:
+            return False
+        session.transport.push(frame)
+        return True
+
+    def broadcast(self, source_id: int, packet: RPCPacket) -> List[int]:
+        """
+        Relay packet to every logged-in member of its group other than
+        source_id, prefixing its arguments with source_id. Returns the number
+        of clients reached, counting those of other shards as last reported by
+        them; for HEARTBEATS, one such number per group.
+        """
+        for link in self.shard_links.values():
+            link.push(shard_frame(ShardMessages.BROADCAST, source_id, packet))
+        reached = self.__deliver_broadcast(source_id, packet)
+        if self.remote_client_counts:
+            if packet.command == OverseerCommands.HEARTBEATS:
+                groups = packet.additional_info[0::4][:len(reached)]
+            else:
+                groups = [packet.group]
+            for i, group in enumerate(groups):
+                reached[i] += sum(self.remote_client_counts.get(group, {}).values())
+        return reached
+
+    def unicast(self, source_id: int, packet: RPCPacket) -> bool:
+        """
+        Relay packet to the client whose id is its first argument, replacing
+        that argument with source_id. Returns False if there is no such client.
+        Packets for clients of other shards are forwarded to that shard and
+        assumed delivered.
+        """
+        if not packet.additional_info:
+            return False
+
+        target_id = packet.additional_info[0]
+        shard = self.shard_of(target_id)
+        if shard == self.shard_index:
+            return self.__deliver_unicast(source_id, target_id, packet)
+
+        link = self.shard_links.get(shard)
+        if link is None:
+            return False
+        link.push(shard_frame(ShardMessages.UNICAST, source_id, packet))
+        return True
+
+    def shard_of(self, client_id: int) -> int:
+        return (client_id - 1) % self.shard_count
+
+    def shard_connected(self, shard: int, link: "ShardLink") -> None:
+        """
+        Called by backends once the outbound link to another shard is up.
+        """
+        self.shard_links[shard] = link
+        link.push(self.__client_count_frame(0))
+        for group in self.group_members:
+            link.push(self.__client_count_frame(group))
+        for client_id, session in self.clients.items():
+            link.push(self.__member_frame(client_id, session.address or (0, 0), True))
+
+    def shard_lost(self, shard: int) -> None:
+        """
+        Called by backends when the outbound link to another shard breaks.
+        Its clients are unreachable, and not counted, until it is back.
+        """
+        self.shard_links.pop(shard, None)
+        for counts in self.remote_client_counts.values():
+            counts.pop(shard, None)
+        for client_id in [
+            client_id for client_id in self.remote_members if self.shard_of(client_id) == shard
+        ]:
+            self.__deliver_member(client_id, self.remote_members.pop(client_id), False)
+
+    def __client_count_frame(self, group: int) -> bytes:
+        count = len(self.clients) if not group else len(self.group_members.get(group, ()))
+        return shard_frame(
+            ShardMessages.CLIENT_COUNT, self.shard_index,
+            RPCPacket(0, OverseerCommands.KEEP_ALIVE, [count], group=group)
+        )
+
+    def __member_frame(self, client_id: int, address: Tuple[int, int], joined: bool) -> bytes:
+        return shard_frame(
+            ShardMessages.MEMBER, self.shard_index,
+            RPCPacket(0, OverseerCommands.PEER_UPDATE, [client_id, address[0], address[1], int(joined)])
+        )
+
+    def __deliver_member(self, client_id: int, address: Tuple[int, int], joined: bool) -> None:
+        """
+        Tell every local client taking direct connections that client_id
+        joined or left.
+        """
+        update = RPCPacket(
+            0, OverseerCommands.PEER_UPDATE, [client_id, address[0], address[1], int(joined)]
+        ).make_sendable_stream(commons.PROTOCOL_V2)
+        for other_id, session in list(self.clients.items()):
+            if other_id != client_id and session.address is not None:
+                session.transport.push(update)
+
+    def __announce_member(self, client_id: int, address: Tuple[int, int], joined: bool) -> None:
+        self.__deliver_member(client_id, address, joined)
+        if self.shard_links:
+            frame = self.__member_frame(client_id, address, joined)
+            for link in self.shard_links.values():
+                link.push(frame)
+
+    def __announce_client_count(self, group: int = 0) -> None:
+        if self.shard_links:
+            frame = self.__client_count_frame(group)
+            for link in self.shard_links.values():
+                link.push(frame)
+
+    def handle_shard_packet(self, packet: RPCPacket) -> None:
+        """
+        Act on a frame forwarded by another shard.
+        """
+        message, source_id = packet.additional_info[0:2]
+        forwarded = RPCPacket(
+            0, packet.command, packet.additional_info[2:], data=packet.data, group=packet.group
+        )
+        if message == ShardMessages.BROADCAST.value:
+            self.__deliver_broadcast(source_id, forwarded)
+        elif message == ShardMessages.UNICAST.value:
+            self.__deliver_unicast(source_id, forwarded.additional_info[0], forwarded)
+        elif message == ShardMessages.CLIENT_COUNT.value:
+            self.remote_client_counts.setdefault(forwarded.group, {})[source_id] = forwarded.additional_info[0]
+        elif message == ShardMessages.MEMBER.value:
+            client_id, host, port, joined = forwarded.additional_info[0:4]
+            if joined:
+                self.remote_members[client_id] = (host, port)
+            else:
+                self.remote_members.pop(client_id, None)
+            self.__deliver_member(client_id, (host, port), bool(joined))
@@ -0,0 +1,426 @@
+from array import array
+from typing import Any, Callable, List, NamedTuple, Optional, Tuple
+
+import bisect
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+"""
+The Raft log of a node, kept in segment files that are memory-mapped for both
+appends and reads.
+
+Each segment file is named after the index of its first entry and is
+preallocated, so appending never changes file metadata. Entries are laid out
+back to back as <crc32:u32><length:u32><index:u64><term:u64><data>, big-endian,
+with the CRC covering everything after itself. On open, every segment is
+scanned once to rebuild the in-memory offset index; the scan of the last
+segment stops at the first record that does not check out, which is where an
+interrupted write left off.
+
+Appends only land in the page cache. Durability is explicit: sync() flushes
+every segment written to since the last sync, and GroupCommitter batches the
+sync()s of everything appended within a window into one.
+
+Once a snapshot covers a prefix of the log, compact() deletes the segments
+that lie wholly inside it. The log only remembers the index and term of the
+snapshot's last entry; the snapshot itself is kept by the snapshot module.
+"""
+
+logger = logging.getLogger("raftel-node")
+
+ENTRY_HEADER = struct.Struct("!IIQQ")
+# crc32 covers the header from here on, then the data.
+CRC_SIZE = 4 # type: int
+SEGMENT_SUFFIX = ".seg" # type: str
+HARD_STATE = struct.Struct("!Qq")
+HARD_STATE_FILE = "hardstate" # type: str
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024 # type: int
+DEFAULT_GROUP_COMMIT_MS = 2 # type: int
+
+LogEntry = NamedTuple("LogEntry", [("index", int), ("term", int), ("data", bytes)])
+
+def fsync_directory(directory: str) -> None:
+    """
+    Make file creations, renames and removals in directory durable.
+    """
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class Segment(object):
+    """
+    One preallocated, memory-mapped log file holding consecutive entries
+    starting at first_index. Without a path, the segment lives in anonymous
+    memory and nothing survives the process.
+    """
+
+    def __init__(self, path: Optional[str], first_index: int, size: int) -> None:
+        self.path = path # type: Optional[str]
+        self.first_index = first_index # type: int
+        if path is None:
+            self.mm = mmap.mmap(-1, size)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size < size:
+                    os.ftruncate(fd, size)
+                self.mm = mmap.mmap(fd, 0)
+            finally:
+                os.close(fd)
+        self.size = len(self.mm) # type: int
+        # Byte offset of each entry; entry first_index + i is at offsets[i].
+        self.offsets = array("Q") # type: array
+        self.end = 0 # type: int
+        self.dirty = False # type: bool
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    @property
+    def last_index(self) -> int:
+        return self.first_index + len(self.offsets) - 1
+
+    def recover(self) -> None:
+        """
+        Rebuild the offset index from the file, stopping at the first record
+        that is torn, corrupt or out of sequence.
+        """
+        offset = 0
+        while offset + ENTRY_HEADER.size <= self.size:
+            crc, length, index, term = ENTRY_HEADER.unpack_from(self.mm, offset)
+            record_end = offset + ENTRY_HEADER.size + length
+            if (
+                index != self.first_index + len(self.offsets) or
+                record_end > self.size or
+                zlib.crc32(self.mm[offset + CRC_SIZE:record_end]) != crc
+            ):
+                break
+            self.offsets.append(offset)
+            offset = record_end
+        self.end = offset
+
+        # Whatever follows is the remains of a write that never completed;
+        # clear it so that it cannot be mistaken for entries later on.
+        if self.mm[self.end:self.end + ENTRY_HEADER.size].strip(b"\x00"):
+            self.__zero(self.end, self.size)
+
+    def __zero(self, start: int, end: int) -> None:
+        self.mm[start:end] = bytes(end - start)
+        self.dirty = True
+
+    def has_room(self, data_size: int) -> bool:
+        return self.end + ENTRY_HEADER.size + data_size <= self.size
+
+    def append(self, term: int, data: bytes) -> int:
+        index = self.first_index + len(self.offsets)
+        offset = self.end
+        record_end = offset + ENTRY_HEADER.size + len(data)
+        ENTRY_HEADER.pack_into(self.mm, offset, 0, len(data), index, term)
+        self.mm[offset + ENTRY_HEADER.size:record_end] = data
+        crc = zlib.crc32(self.mm[offset + CRC_SIZE:record_end])
+        struct.pack_into("!I", self.mm, offset, crc)
+        self.offsets.append(offset)
+        self.end = record_end
+        self.dirty = True
+        return index
+
+    def header(self, index: int) -> Tuple[int, int, int]:
+        """
+        (offset of the data, its length, term) of the entry at index.
+        """
+        offset = self.offsets[index - self.first_index]
+        _, length, _, term = ENTRY_HEADER.unpack_from(self.mm, offset)
+        return offset + ENTRY_HEADER.size, length, term
+
+    def read(self, index: int) -> LogEntry:
+        start, length, term = self.header(index)
+        return LogEntry(index, term, self.mm[start:start + length])
+
+    def truncate_after(self, index: int) -> None:
+        """
+        Drop every entry after index.
+        """
+        keep = index - self.first_index + 1
+        if keep >= len(self.offsets):
+            return
+        new_end = self.offsets[keep]
+        self.__zero(new_end, self.end)
+        del self.offsets[keep:]
+        self.end = new_end
+
+    def flush(self) -> None:
+        if self.dirty and self.path is not None:
+            self.mm.flush()
+        self.dirty = False
+
+    def close(self) -> None:
+        self.flush()
+        self.mm.close()
+
+class RaftLog(object):
+    """
+    Append-only Raft log. Indices start at 1; index 0 with term 0 stands for
+    the empty log.
+
+    Looking an entry up by index is a binary search over the (few) segments
+    followed by an array lookup, and reading its data is a slice of the
+    mapping.
+    """
+
+    def __init__(self, directory: Optional[str] = None, segment_size: int = DEFAULT_SEGMENT_SIZE) -> None:
+        """
+        Without a directory the log is kept in memory only, for nodes that do
+        not need to survive restarts.
+        """
+        self.directory = directory # type: Optional[str]
+        self.segment_size = segment_size # type: int
+        self.segments = [] # type: List[Segment]
+        # First index of each segment, for bisecting.
+        self.segment_starts = [] # type: List[int]
+        # The last entry covered by the latest snapshot.
+        self.snapshot_index = 0 # type: int
+        self.snapshot_term = 0 # type: int
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.__open_segments()
+        # Everything up to here is on disk.
+        self.durable_index = self.last_index # type: int
+
+    def __segment_path(self, first_index: int) -> Optional[str]:
+        if self.directory is None:
+            return None
+        return os.path.join(self.directory, "%020d%s" % (first_index, SEGMENT_SUFFIX))
+
+    def __open_segments(self) -> None:
+        first_indices = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+        for first_index in first_indices:
+            if self.segments and first_index != self.last_index + 1:
+                # A gap means the segments after it cannot be trusted.
+                logger.critical("Log segment %s does not follow index %s, dropping it and everything after.", first_index, self.last_index)
+                for stale in first_indices[first_indices.index(first_index):]:
+                    stale_path = self.__segment_path(stale)
+                    if stale_path is not None:
+                        os.remove(stale_path)
+                break
+            segment = Segment(self.__segment_path(first_index), first_index, self.segment_size)
+            segment.recover()
+            self.segments.append(segment)
+            self.segment_starts.append(first_index)
+
+    @property
+    def first_index(self) -> int:
+        return self.segment_starts[0] if self.segments else self.snapshot_index + 1
+
+    @property
+    def last_index(self) -> int:
+        return self.segments[-1].last_index if self.segments else self.snapshot_index
+
+    @property
+    def last_term(self) -> int:
+        return self.term_at(self.last_index)
+
+    def __segment_for(self, index: int) -> Segment:
+        if not self.first_index <= index <= self.last_index:
+            raise IndexError("Log index %s out of range [%s, %s]." % (index, self.first_index, self.last_index))
+        return self.segments[bisect.bisect_right(self.segment_starts, index) - 1]
+
+    def has_term(self, index: int) -> bool:
+        """
+        Whether term_at(index) is known, which is what a leader needs to send
+        the entries after index rather than a snapshot.
+        """
+        return (
+            index in (0, self.snapshot_index) or
+            self.first_index <= index <= self.last_index
+        )
+
+    def term_at(self, index: int) -> int:
+        if index == 0:
+            return 0
+        if index == self.snapshot_index and not self.first_index <= index <= self.last_index:
+            return self.snapshot_term
+        return self.__segment_for(index).header(index)[2]
+
+    def entry(self, index: int) -> LogEntry:
+        return self.__segment_for(index).read(index)
+
+    def entries(self, start: int, max_count: int, max_bytes: int) -> List[LogEntry]:
+        """
+        Up to max_count consecutive entries from start, stopping before they
+        add up to more than max_bytes of data (but always at least one).
+        """
+        batch = [] # type: List[LogEntry]
+        size = 0
+        index = start
+        while index <= self.last_index and len(batch) < max_count:
+            entry = self.entry(index)
+            size += len(entry.data)
+            if batch and size > max_bytes:
+                break
+            batch.append(entry)
+            index += 1
+        return batch
+
+    def __new_segment(self, first_index: int, data_size: int) -> Segment:
+        size = max(self.segment_size, ENTRY_HEADER.size + data_size)
+        segment = Segment(self.__segment_path(first_index), first_index, size)
+        if self.directory is not None:
+            fsync_directory(self.directory)
+        self.segments.append(segment)
+        self.segment_starts.append(first_index)
+        return segment
+
+    def append(self, term: int, data: bytes) -> int:
+        """
+        Append an entry and return its index. It is not durable until the
+        next sync().
+        """
+        if term < self.last_term:
+            raise ValueError("Term %s is older than the last entry's (%s)." % (term, self.last_term))
+        segment = self.segments[-1] if self.segments else None
+        if segment is None or not segment.has_room(len(data)):
+            segment = self.__new_segment(self.last_index + 1, len(data))
+        return segment.append(term, data)
+
+    def truncate_after(self, index: int) -> None:
+        """
+        Drop every entry after index, as a follower must when its log
+        conflicts with the leader's.
+        """
+        if index >= self.last_index:
+            return
+        while self.segments and self.segments[-1].first_index > index:
+            segment = self.segments.pop()
+            self.segment_starts.pop()
+            segment.close()
+            if segment.path is not None:
+                os.remove(segment.path)
+        if self.segments:
+            self.segments[-1].truncate_after(index)
+        self.durable_index = min(self.durable_index, index)
+
+    def __drop_first_segment(self) -> None:
+        segment = self.segments.pop(0)
+        self.segment_starts.pop(0)
+        segment.close()
+        if segment.path is not None:
+            os.remove(segment.path)
+
+    def compact(self, index: int, term: int) -> None:
+        """
+        Forget the entries up to index, which a snapshot now covers. Whole
+        segments are deleted, so some entries before index may remain.
+
+        If the log does not contain that entry, as when a follower installs a
+        snapshot from its leader, every entry goes: the snapshot supersedes
+        them.
+        """
+        if index <= self.snapshot_index:
+            return
+        matches = (
+            (self.first_index <= index <= self.last_index and self.term_at(index) == term) or
+            # Entries appended after installing this very snapshot.
+            (bool(self.segments) and self.first_index == index + 1)
+        )
+        while self.segments and (not matches or self.segments[0].last_index <= index):
+            self.__drop_first_segment()
+        self.snapshot_index = index
+        self.snapshot_term = term
+        if not matches:
+            self.durable_index = index
+        if self.directory is not None:
+            fsync_directory(self.directory)
+
+    def sync(self) -> int:
+        """
+        Make every appended entry durable. Returns the last durable index.
+        """
+        for segment in reversed(self.segments):
+            if not segment.dirty:
+                break
+            segment.flush()
+        self.durable_index = self.last_index
+        return self.durable_index
+
+    def save_hard_state(self, term: int, voted_for: Optional[int]) -> None:
+        """
+        Durably record the current term and vote, which Raft requires to
+        survive restarts just like the log.
+        """
+        if self.directory is None:
+            return
+        path = os.path.join(self.directory, HARD_STATE_FILE)
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as state_file:
+            state_file.write(HARD_STATE.pack(term, -1 if voted_for is None else voted_for))
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(temp_path, path)
+        fsync_directory(self.directory)
+
+    def load_hard_state(self) -> Tuple[int, Optional[int]]:
+        if self.directory is None:
+            return 0, None
+        try:
+            with open(os.path.join(self.directory, HARD_STATE_FILE), "rb") as state_file:
+                term, voted_for = HARD_STATE.unpack(state_file.read(HARD_STATE.size))
+        except FileNotFoundError:
+            return 0, None
+        return term, None if voted_for < 0 else voted_for
+
+    def close(self) -> None:
+        for segment in self.segments:
+            segment.close()
+
+class GroupCommitter(object):
+    """
+    Batches log syncs: whatever is appended within window_ms of the first
+    unsynced append is made durable by a single sync(), after which every
+    callback waiting on it runs.
+    """
+
+    def __init__(
+        self,
+        log: RaftLog,
+        call_later: Callable[[int, Callable[[], None]], Any],
+        window_ms: int = DEFAULT_GROUP_COMMIT_MS
+    ) -> None:
+        """
+        call_later schedules a callback after some milliseconds, like
+        NodeTransport.call_later.
+        """
+        self.log = log # type: RaftLog
+        self.call_later = call_later
+        self.window_ms = window_ms # type: int
+        self.waiting = [] # type: List[Callable[[int], None]]
+        self.timer = None # type: Any
+
+    def commit(self, callback: Callable[[int], None]) -> None:
+        """
+        Call callback with the durable index once everything appended so far
+        is on disk.
+        """
+        if self.log.durable_index >= self.log.last_index and not self.waiting:
+            callback(self.log.durable_index)
+            return
+        self.waiting.append(callback)
+        if self.timer is None:
+            self.timer = self.call_later(self.window_ms, self.flush)
+
+    def flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        durable_index = self.log.sync()
+        waiting, self.waiting = self.waiting, []
+        for callback in waiting:
+            callback(durable_index)
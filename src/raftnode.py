@@ -1,14 +1,20 @@
 from argparse import ArgumentParser
-from commons import RPCPacket, OverseerCommands
-from enum import Enum
-from gevent.socket import SocketType
-from typing import List, Optional
+from kvstore import KVStore
+from nodecore import DEFAULT_SNAPSHOT_THRESHOLD
+from raftlog import RaftLog
+from snapshot import SnapshotStore
+from statemachine import NullStateMachine
 
 import commons
-import gevent
 import logging
+import metrics
 import os
-import time
+
+"""
+Runs a raftel node from the command line, driven by either backend: gevent
+(geventnode) or asyncio (aionode). Only the chosen backend is imported, so the
+asyncio one works without gevent installed.
+"""
 
 LOGGER_NAME = "raftel-node"
 logger = logging.getLogger(LOGGER_NAME)
@@ -25,106 +31,6 @@ stream_handler.setFormatter(formatter)
 logger.addHandler(file_handler)
 logger.addHandler(stream_handler)
 
-class NodeStates(Enum):
-    FOLLOWER = 0
-    CANDIDATE = 1
-    LEADER = 2
-
-class RaftNode(object):
-
-    def __init__(self, election_timeout: int, wait_sleep: int =100) -> None:
-        """
-        election_timeout and wait_sleep are both specified as milliseconds.
-
-        election_timeout is the time this node will wait for a leader heartbeat.
-        Once elapsed, it will volunteer itself to be the leader.
-
-        wait_sleep is the time this node sleeps between sending a keep alive to
-        the RPC Overseer.
-
-        You typically want election_timeout to be greater than wait_sleep. The
-        rationale is that you want the node to send a few keep alives to
-        overseer before trying to go for election; this gives the other nodes
-        time to join the cluster.
-        """
-        self.sock = SocketType()
-        # "Mock" leader ping to start with.
-        self.last_leader_ping = self.__current_time_millis() # type: int
-        self.last_transaction = self.__current_time_millis() # type: int
-        self.last_log_index = 0 # type: int
-        self.last_log_term = 0 # type: int
-        self.election_timeout = election_timeout # type: int
-        self.wait_sleep = wait_sleep # type: int
-        self.raft_id = -1 # type: int
-
-        self.current_term = 0 # type: int
-        self.state = NodeStates.FOLLOWER # type: NodeStates
-
-    def __current_time_millis(self) -> int:
-        return int(time.time() * 1000)
-
-    def connect(self, ip: str, port: int) -> None:
-        self.sock.connect((ip, port))
-        login = RPCPacket(0, OverseerCommands.LOGIN)
-        logger.info("SEND: %s" % login)
-        self.sock.sendall(login.make_sendable_stream())
-        overseer_resp = self.sock.recvfrom(128)
-        logger.info("RECV: %s" % overseer_resp[0])
-        parse_resp = RPCPacket.parse(overseer_resp[0])
-        logger.info("Got client id %s" % parse_resp.additional_info)
-        self.raft_id = parse_resp.additional_info[0]
-        self.last_transaction = self.__current_time_millis()
-
-    def __recv(self, buffer: int, _packet_acc: Optional[List[int]] = None):
-        packet_acc = _packet_acc if _packet_acc else [] # type: List[int]
-
-        while commons.ETX not in packet_acc:
-             p = self.sock.recvfrom(buffer)
-             if not len(p[0]):
-                logger.critical("Node seems to be disconnected...")
-                break
-
-             packet_acc.extend(p[0])
-             gevent.sleep(0.5)
-
-        return packet_acc
-
-    def __partition_read_dump(self, read_dump): 
-
-    def serve_forever(self) -> None:
-        packet_number = 1
-        while True:
-            now = self.__current_time_millis()
-            send_packet = None # type: RPCPacket
-            leader_ping_delta = now - self.last_leader_ping
-            if leader_ping_delta > self.election_timeout and self.state == NodeStates.FOLLOWER:
-                logger.info("Too long without a leader, initiating transaction. (%s since last leader comms, willing to wait for %s)." % (leader_ping_delta, self.election_timeout)) 
-                if self.raft_id <= 0:
-                    raise ValueError("Haven't received a valid ID from Overseer yet.")
-                # Tell the overseer you want to be the leader
-                send_packet = RPCPacket(packet_number=packet_number, command=OverseerCommands.REQUEST_VOTE)
-                self.current_term += 1
-                self.state = NodeStates.CANDIDATE
-            else:
-                # Send a keep alive
-                keep_alive_diff = now - self.last_transaction
-                if keep_alive_diff >= self.wait_sleep:
-                    send_packet = RPCPacket(packet_number=packet_number, command=ord("C"))
-                else:
-                    gevent.sleep((self.wait_sleep - keep_alive_diff) / 1000)
-                    send_packet = RPCPacket(packet_number=packet_number, command=OverseerCommands.KEEP_ALIVE)
-            
-            logger.info("SEND: %s" % send_packet)
-            self.sock.sendall(send_packet.make_sendable_stream())
-            resp = self.__recv(128)
-            logger.info("RECV: %s" % resp)
-
-            if commons.ETX not in resp:
-                logger.critical("Received malformed packet from server, disconnecting...")
-                break
-
-            self.last_transaction = self.__current_time_millis()
-
 if __name__ == "__main__":
     parser = ArgumentParser(description="node for a raft cluster")
     parser.add_argument(
@@ -135,6 +41,14 @@ if __name__ == "__main__":
         "--keep-alive", "-k", required=False, type=int, default=30000,
         help="The time between keep-alives to the RPC overseer. Measured in milliseconds."
     )
+    parser.add_argument(
+        "--heartbeat", required=False, type=int, default=None,
+        help="The time between heartbeats while leader. Measured in milliseconds; defaults to a quarter of the election timeout."
+    )
+    parser.add_argument(
+        "--window", "-w", required=False, type=int, default=commons.DEFAULT_WINDOW_SIZE,
+        help="How many packets to keep in flight to the RPC overseer (at most %s)." % commons.MAX_WINDOW_SIZE
+    )
     parser.add_argument(
         "--host", "-H", required=True, type=str,
         help="The host address of the RPC overseer."
@@ -143,9 +57,67 @@ if __name__ == "__main__":
         "--port", "-p", required=True, type=int,
         help="The port on which the RPC overseer is listening."
     )
+    parser.add_argument(
+        "--data-dir", "-d", required=False, type=str, default=None,
+        help="Where to keep the node's log and vote. Without one, they are lost on exit."
+    )
+    parser.add_argument(
+        "--snapshot-every", required=False, type=int, default=DEFAULT_SNAPSHOT_THRESHOLD,
+        help="Snapshot the state and compact the log every this many applied entries (0 for never)."
+    )
+    parser.add_argument(
+        "--state-machine", required=False, choices=("null", "kv"), default="null",
+        help="What to apply committed entries to: nothing, or the built-in key-value store."
+    )
+    parser.add_argument(
+        "--lease-reads", required=False, action="store_true",
+        help="Serve reads on a leader lease instead of a heartbeat round each. Assumes clocks run at about the same rate everywhere."
+    )
+    parser.add_argument(
+        "--direct", required=False, type=str, default=None, metavar="HOST",
+        help="Accept connections from other nodes on this IPv4 address and send them Raft traffic directly; the overseer then only introduces nodes."
+    )
+    parser.add_argument(
+        "--backend", "-b", required=False, choices=("gevent", "asyncio"), default="gevent",
+        help="Which I/O framework drives the node."
+    )
+    parser.add_argument(
+        "--uvloop", required=False, action="store_true",
+        help="Run the asyncio backend on uvloop (must be installed)."
+    )
+    parser.add_argument(
+        "--metrics-port", required=False, type=int, default=None,
+        help="Serve metrics over HTTP on this port of the loopback interface."
+    )
+    parser.add_argument(
+        "--packet-log-every", required=False, type=int, default=metrics.DEFAULT_PACKET_LOG_EVERY,
+        help="At log level DEBUG, log one packet in every this many (1 for all, 0 for none)."
+    )
 
     args = vars(parser.parse_args())
+    metrics.log_off_thread(logger)
+    metrics.sample_packets(logger, args["packet_log_every"])
 
-    st = RaftNode(args["election_timeout"], args["keep_alive"])
-    st.connect(args["host"], args["port"])
-    st.serve_forever()
+    log = RaftLog(args["data_dir"]) if args["data_dir"] else None
+    node_args = (
+        args["election_timeout"], args["keep_alive"], args["window"], log, args["heartbeat"]
+    )
+    node_options = {
+        "snapshots": SnapshotStore(args["data_dir"]) if args["data_dir"] else None,
+        "snapshot_threshold": args["snapshot_every"],
+        "state_machine": KVStore() if args["state_machine"] == "kv" else NullStateMachine(),
+        "lease_reads": args["lease_reads"],
+        "direct_host": args["direct"],
+        "metrics_port": args["metrics_port"]
+    }
+    if args["backend"] == "asyncio":
+        import aionode
+        aionode.run(
+            aionode.AsyncioRaftNode(*node_args, **node_options),
+            args["host"], args["port"], args["uvloop"]
+        )
+    else:
+        import geventnode
+        st = geventnode.RaftNode(*node_args, **node_options)
+        st.connect(args["host"], args["port"])
+        st.serve_forever()
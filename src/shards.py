@@ -0,0 +1,89 @@
+from typing import Callable, Dict
+
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import traceback
+
+"""
+Process plumbing for running the Overseer as several worker processes sharing
+one port. The kernel spreads incoming connections across the workers'
+SO_REUSEPORT listeners; each worker runs its own OverseerCore over a disjoint
+range of client ids and forwards relayed packets for clients it does not own
+to the owning worker over a Unix socket in a shared directory.
+
+Workers are forked before any event loop exists, so the same entry point works
+for both the gevent and asyncio backends.
+"""
+
+# How long a worker waits before retrying a link to a shard that is not up yet.
+SHARD_RETRY_MS = 100 # type: int
+SHARD_SOCKET_NAME = "shard-%s.sock" # type: str
+
+def reuseport_socket(host: str, port: int, backlog: int = 128) -> socket.socket:
+    """
+    A listening TCP socket that other processes may bind to the same address.
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise RuntimeError("SO_REUSEPORT is not available on this platform.")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+def shard_socket_path(shard_dir: str, shard: int) -> str:
+    return os.path.join(shard_dir, SHARD_SOCKET_NAME % shard)
+
+def run_workers(workers: int, target: Callable[[int, str], None]) -> None:
+    """
+    Fork workers processes, each calling target(shard index, shard directory),
+    and wait for all of them. SIGINT and SIGTERM sent to this process are
+    passed on to the workers. Should one worker die, the rest are stopped too:
+    the clients it owned are unreachable otherwise.
+    """
+    if workers < 1:
+        raise ValueError("Need at least one worker, got %s." % workers)
+
+    shard_dir = tempfile.mkdtemp(prefix="raftel-shards-")
+    children = {} # type: Dict[int, int]
+    try:
+        for shard in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                status = 0
+                try:
+                    target(shard, shard_dir)
+                except KeyboardInterrupt:
+                    pass
+                except BaseException:
+                    # Nothing above us would get to report it: os._exit
+                    # skips the usual handling, buffered output included.
+                    status = 1
+                    traceback.print_exc()
+                finally:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(status)
+            children[pid] = shard
+
+        def forward(signum, frame):
+            for pid in children:
+                try:
+                    os.kill(pid, signum)
+                except ProcessLookupError:
+                    pass
+
+        signal.signal(signal.SIGINT, forward)
+        signal.signal(signal.SIGTERM, forward)
+        while children:
+            pid, _ = os.wait()
+            children.pop(pid, None)
+            forward(signal.SIGTERM, None)
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
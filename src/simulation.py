@@ -0,0 +1,506 @@
+from collections import Counter, OrderedDict
+from commons import FrameDecoder, OverseerCommands, RPCPacket
+from nodecore import NodeCore, NodeSession, NodeTransport, PeerLink
+from overseercore import ClientSession, ClientTransport, OverseerCore, LIVENESS_TICK_MS
+from raftlog import RaftLog
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import commons
+import heapq
+import random
+
+"""
+A deterministic, in-process network for running many nodes and overseers at
+once. Everything runs on a VirtualClock: timers fire and frames arrive in
+simulated time, as fast as the CPU allows, and the same seed always replays
+the same run.
+
+    clock = VirtualClock()
+    network = SimulatedNetwork(clock, seed=1, latency_ms=(0.5, 2.0), loss=0.01)
+    overseer = SimulatedOverseer(network)
+    nodes = [SimulatedNode(network, 300) for _ in range(1000)]
+    for node in nodes:
+        node.connect(overseer)
+    clock.run_until(lambda: any(node.core.state == NodeStates.LEADER for node in nodes))
+
+Connections behave like TCP ones: frames arrive in the order they were sent,
+and a lost frame is retransmitted after retransmit_ms, holding back everything
+sent after it. A partition holds back frames between its sides until it heals;
+the overseer's liveness check does the rest, as it would with real sockets.
+
+The simulated backends drive the same NodeSession, NodeCore and OverseerCore
+as the gevent and asyncio ones; only the bytes and the clock are fake.
+"""
+
+# Simulated nodes that take direct connections all listen on this port, each
+# on an address of its own.
+DIRECT_PORT = 1 # type: int
+# Where the command byte sits in v2/v3 and v1 frames respectively.
+V2_COMMAND_OFFSET = commons.V2_HEADER.size - 1 # type: int
+V1_COMMAND_OFFSET = 3 # type: int
+
+class SimulatedTimer(object):
+    __slots__ = ("callback", "cancelled")
+
+    def __init__(self, callback: Callable[[], None]) -> None:
+        self.callback = callback # type: Callable[[], None]
+        self.cancelled = False # type: bool
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+class VirtualClock(object):
+    """
+    Simulated time, in (fractional) milliseconds since the clock was made.
+    Time only moves when the clock is run, jumping straight to the next
+    scheduled event.
+    """
+
+    def __init__(self) -> None:
+        self.now = 0.0 # type: float
+        # (due, sequence, timer); the sequence keeps events due at the same
+        # moment in the order they were scheduled.
+        self.events = [] # type: List[Tuple[float, int, SimulatedTimer]]
+        self.sequence = 0 # type: int
+        self.fired = 0 # type: int
+
+    def now_millis(self) -> int:
+        return int(self.now)
+
+    def call_at(self, due: float, callback: Callable[[], None]) -> SimulatedTimer:
+        timer = SimulatedTimer(callback)
+        self.sequence += 1
+        heapq.heappush(self.events, (due if due > self.now else self.now, self.sequence, timer))
+        return timer
+
+    def call_later(self, delay_ms: float, callback: Callable[[], None]) -> SimulatedTimer:
+        return self.call_at(self.now + delay_ms, callback)
+
+    def run_for(self, duration_ms: float) -> None:
+        """
+        Fire every event due within the next duration_ms, then leave the clock
+        at the end of that span.
+        """
+        deadline = self.now + duration_ms
+        events = self.events
+        while events and events[0][0] <= deadline:
+            due, _, timer = heapq.heappop(events)
+            if timer.cancelled:
+                continue
+            self.now = due
+            self.fired += 1
+            timer.callback()
+        self.now = deadline
+
+    def run_until(
+        self,
+        condition: Callable[[], bool],
+        timeout_ms: float = 60000,
+        check_every_ms: float = 1
+    ) -> bool:
+        """
+        Run until condition() holds, checking it every check_every_ms of
+        simulated time, for at most timeout_ms. Returns whether it held.
+        """
+        deadline = self.now + timeout_ms
+        while not condition():
+            if self.now >= deadline:
+                return False
+            self.run_for(min(check_every_ms, deadline - self.now))
+        return True
+
+class SimulatedPipe(object):
+    """
+    One direction of a simulated connection, from endpoint source to target.
+    Closing it is delivered in order too, after everything already sent.
+    """
+
+    def __init__(
+        self,
+        network: "SimulatedNetwork",
+        source: int,
+        target: int,
+        receive: Callable[[bytes], None],
+        closed: Callable[[], None]
+    ) -> None:
+        self.network = network # type: SimulatedNetwork
+        self.source = source # type: int
+        self.target = target # type: int
+        self.receive = receive # type: Callable[[bytes], None]
+        self.closed = closed # type: Callable[[], None]
+        self.open = True # type: bool
+        # When the last frame sent arrives; nothing may overtake it.
+        self.arrives_at = 0.0 # type: float
+        # Sent while a partition stood between source and target, None
+        # standing for the close.
+        self.held = [] # type: List[Optional[bytes]]
+
+    def send(self, frame: bytes) -> bool:
+        if not self.open:
+            return False
+        self.network.transmit(self, frame)
+        return True
+
+    def close(self) -> None:
+        if self.open:
+            self.open = False
+            self.network.transmit(self, None)
+
+    def arrive(self, frame: Optional[bytes]) -> None:
+        if frame is None:
+            self.closed()
+        else:
+            self.receive(frame)
+
+class SimulatedNetwork(object):
+    """
+    Carries frames between simulated endpoints (overseers and nodes), each
+    known by an integer address, with seeded latency, loss and partitions.
+    Counts every frame it carries by command.
+    """
+
+    def __init__(
+        self,
+        clock: VirtualClock,
+        seed: int = 0,
+        latency_ms: Tuple[float, float] = (0.5, 2.0),
+        loss: float = 0.0,
+        retransmit_ms: float = 200
+    ) -> None:
+        """
+        Every frame takes between latency_ms[0] and latency_ms[1] to arrive,
+        uniformly, plus retransmit_ms for each time it is lost, which happens
+        with probability loss.
+        """
+        if not 0 <= loss < 1:
+            raise ValueError("Loss must be a probability below 1, not %s." % loss)
+        self.clock = clock # type: VirtualClock
+        self.random = random.Random(seed) # type: random.Random
+        self.latency_ms = latency_ms # type: Tuple[float, float]
+        self.loss = loss # type: float
+        self.retransmit_ms = retransmit_ms # type: float
+        self.endpoints = 0 # type: int
+        # Which side of the current partition each endpoint is on. Endpoints
+        # not listed share side 0.
+        self.sides = {} # type: Dict[int, int]
+        # Pipes holding frames back, in the order they started to; used as an
+        # ordered set so that runs stay repeatable.
+        self.held_pipes = OrderedDict() # type: OrderedDict
+        # Nodes taking direct connections, by (host, port).
+        self.listeners = {} # type: Dict[Tuple[str, int], SimulatedNode]
+        self.frames = 0 # type: int
+        self.bytes = 0 # type: int
+        self.commands = Counter() # type: Counter
+
+    def add_endpoint(self) -> int:
+        self.endpoints += 1
+        return self.endpoints
+
+    def pipe(
+        self,
+        source: int,
+        target: int,
+        receive: Callable[[bytes], None],
+        closed: Callable[[], None]
+    ) -> SimulatedPipe:
+        return SimulatedPipe(self, source, target, receive, closed)
+
+    def latency(self) -> float:
+        low, high = self.latency_ms
+        delay = low + (high - low) * self.random.random()
+        if self.loss:
+            while self.random.random() < self.loss:
+                delay += self.retransmit_ms
+        return delay
+
+    def cut(self, source: int, target: int) -> bool:
+        return bool(self.sides) and self.sides.get(source, 0) != self.sides.get(target, 0)
+
+    def transmit(self, pipe: SimulatedPipe, frame: Optional[bytes]) -> None:
+        if frame is not None:
+            self.frames += 1
+            self.bytes += len(frame)
+            self.commands[
+                frame[V2_COMMAND_OFFSET] if frame[0] == commons.SOH else frame[V1_COMMAND_OFFSET]
+            ] += 1
+        if pipe.held or (self.sides and self.cut(pipe.source, pipe.target)):
+            pipe.held.append(frame)
+            self.held_pipes[pipe] = None
+            return
+        self.__schedule(pipe, frame)
+
+    def __schedule(self, pipe: SimulatedPipe, frame: Optional[bytes]) -> None:
+        arrival = self.clock.now + self.latency()
+        if arrival < pipe.arrives_at:
+            arrival = pipe.arrives_at
+        pipe.arrives_at = arrival
+        self.clock.call_at(arrival, lambda: pipe.arrive(frame))
+
+    def partition(self, *sides: Iterable[int]) -> None:
+        """
+        Cut every given set of endpoint addresses off from everything outside
+        it, replacing any partition already in place.
+        """
+        self.sides = {}
+        for side, addresses in enumerate(sides, 1):
+            for address in addresses:
+                self.sides[address] = side
+        self.__release()
+
+    def heal(self) -> None:
+        self.sides = {}
+        self.__release()
+
+    def __release(self) -> None:
+        for pipe in list(self.held_pipes):
+            if not self.cut(pipe.source, pipe.target):
+                del self.held_pipes[pipe]
+                held, pipe.held = pipe.held, []
+                for frame in held:
+                    self.__schedule(pipe, frame)
+
+    def message_counts(self) -> Dict[str, int]:
+        """
+        Frames carried so far, by command name.
+        """
+        return {
+            OverseerCommands(command).name: count
+            for command, count in sorted(self.commands.items())
+        }
+
+    def reset_counts(self) -> None:
+        self.frames = 0
+        self.bytes = 0
+        self.commands = Counter()
+
+    def listen(self, node: "SimulatedNode") -> Tuple[str, int]:
+        address = node.address
+        host = "10.%s.%s.%s" % ((address >> 16) & 255, (address >> 8) & 255, address & 255)
+        self.listeners[(host, DIRECT_PORT)] = node
+        return (host, DIRECT_PORT)
+
+    def unlisten(self, address: Tuple[str, int]) -> None:
+        self.listeners.pop(address, None)
+
+    def connect_peer(self, node: "SimulatedNode", peer_id: int, host: str, port: int) -> None:
+        """
+        Dial a direct connection from node to whichever node listens on
+        (host, port), reporting to node's session a round trip later.
+        """
+        target = self.listeners.get((host, port))
+        delay = self.latency() + self.latency()
+        if target is None or self.cut(node.address, target.address):
+            self.clock.call_later(delay, lambda: node.session.peer_lost(peer_id, None))
+            return
+        link = SimulatedPeerLink(node, peer_id, target)
+        target.inbound.append(link)
+        self.clock.call_later(delay, lambda: link.connected())
+
+class SimulatedPeerLink(PeerLink):
+    """
+    A direct connection from one simulated node to another.
+    """
+
+    def __init__(self, node: "SimulatedNode", peer_id: int, target: "SimulatedNode") -> None:
+        self.node = node # type: SimulatedNode
+        self.peer_id = peer_id # type: int
+        self.target = target # type: SimulatedNode
+        self.decoder = FrameDecoder() # type: FrameDecoder
+        network = node.network
+        self.pipe = network.pipe(node.address, target.address, self.__deliver, self.__dropped)
+        # Only ever carries the close, should the target go away first.
+        self.reverse = network.pipe(target.address, node.address, lambda frame: None, self.__lost)
+
+    def connected(self) -> None:
+        if self.pipe.open and not self.node.closed:
+            self.node.session.peer_connected(self.peer_id, self)
+
+    def push(self, frame: bytes) -> None:
+        self.pipe.send(frame)
+
+    def close(self) -> None:
+        self.pipe.close()
+
+    def __deliver(self, frame: bytes) -> None:
+        if not self.target.closed:
+            self.decoder.feed(frame)
+            try:
+                self.target.session.receive_direct(self.decoder)
+            except ConnectionError:
+                # The target hangs up, as a real one would.
+                self.__dropped()
+
+    def __dropped(self) -> None:
+        # Closed by the dialing node.
+        if self in self.target.inbound:
+            self.target.inbound.remove(self)
+        self.reverse.close()
+
+    def __lost(self) -> None:
+        self.pipe.open = False
+        if not self.node.closed:
+            self.node.session.peer_lost(self.peer_id, self)
+
+class SimulatedClient(ClientTransport):
+    """
+    The overseer's end of a simulated node's connection.
+    """
+
+    def __init__(self, overseer: "SimulatedOverseer", pipe: SimulatedPipe) -> None:
+        self.overseer = overseer # type: SimulatedOverseer
+        self.session = None # type: Optional[ClientSession]
+        self.pipe = pipe # type: SimulatedPipe
+        self.lost = False # type: bool
+
+    def receive(self, frame: bytes) -> None:
+        if self.lost:
+            return
+        if self.session is None:
+            session, resp = self.overseer.core.login_frame(frame, self)
+            self.push(resp)
+            if session is None:
+                self.close()
+            self.session = session
+        elif not self.session.closed:
+            self.session.handle_packet(RPCPacket.parse(frame))
+
+    def push(self, frame: bytes, droppable: bool = False) -> bool:
+        return self.pipe.send(frame)
+
+    def close(self) -> None:
+        self.pipe.close()
+        self.connection_lost()
+
+    def connection_lost(self) -> None:
+        if self.lost:
+            return
+        self.lost = True
+        if self.session is not None:
+            self.overseer.core.unregister(self.session)
+            self.session.closed = True
+
+class SimulatedOverseer(object):
+    """
+    An overseer on a simulated network. Options are passed on to
+    OverseerCore.
+    """
+
+    def __init__(self, network: SimulatedNetwork, **options) -> None:
+        self.network = network # type: SimulatedNetwork
+        self.address = network.add_endpoint() # type: int
+        self.core = OverseerCore(clock=network.clock.now_millis, **options) # type: OverseerCore
+        self.reap_timer = network.clock.call_later(LIVENESS_TICK_MS, self.__reap)
+
+    def __reap(self) -> None:
+        self.core.reap()
+        self.reap_timer = self.network.clock.call_later(LIVENESS_TICK_MS, self.__reap)
+
+    def accept(self, node: "SimulatedNode") -> SimulatedPipe:
+        """
+        Open a connection from node; returns the pipe node sends through.
+        """
+        client = SimulatedClient(self, self.network.pipe(
+            self.address, node.address, node.receive, node.connection_lost
+        ))
+        return self.network.pipe(node.address, self.address, client.receive, client.connection_lost)
+
+    def close(self) -> None:
+        self.reap_timer.cancel()
+        for session in list(self.core.clients.values()):
+            session.close()
+
+class SimulatedNode(NodeTransport):
+    """
+    A Raft node on a simulated network. Takes the same arguments as
+    AsyncioRaftNode, except that direct connections only need a yes or no.
+    """
+
+    def __init__(
+        self,
+        network: SimulatedNetwork,
+        election_timeout: int,
+        wait_sleep: int = 100,
+        window_size: int = commons.DEFAULT_WINDOW_SIZE,
+        log: Optional[RaftLog] = None,
+        heartbeat_interval: Optional[int] = None,
+        direct: bool = False,
+        **options
+    ) -> None:
+        self.network = network # type: SimulatedNetwork
+        self.clock = network.clock # type: VirtualClock
+        self.address = network.add_endpoint() # type: int
+        self.session = NodeSession(self, wait_sleep, window_size) # type: NodeSession
+        # Seeded from the network so that the whole run replays exactly.
+        self.session.random.seed(network.random.getrandbits(64))
+        self.core = self.session.add_group(
+            0, election_timeout, log, heartbeat_interval, **options
+        ) # type: NodeCore
+        self.pipe = None # type: Optional[SimulatedPipe]
+        self.closed = False # type: bool
+        # Direct connections other nodes made to this one.
+        self.inbound = [] # type: List[SimulatedPeerLink]
+        if direct:
+            self.session.direct_address = network.listen(self)
+
+    @property
+    def raft_id(self) -> int:
+        return self.session.raft_id
+
+    def add_group(
+        self,
+        group: int,
+        election_timeout: int,
+        log: Optional[RaftLog] = None,
+        heartbeat_interval: Optional[int] = None,
+        **options
+    ) -> NodeCore:
+        return self.session.add_group(group, election_timeout, log, heartbeat_interval, **options)
+
+    def connect(self, overseer: SimulatedOverseer) -> None:
+        """
+        Connect to overseer and log in; the rest happens as the clock runs.
+        """
+        self.pipe = overseer.accept(self)
+        self.send_frame(self.session.login_frame())
+
+    def send_frame(self, frame: bytes) -> None:
+        if self.pipe is not None:
+            self.pipe.send(frame)
+
+    def call_later(self, delay_ms: int, callback: Callable[[], None]) -> SimulatedTimer:
+        return self.clock.call_later(delay_ms, callback)
+
+    def now_millis(self) -> int:
+        return self.clock.now_millis()
+
+    def connect_peer(self, peer_id: int, host: str, port: int) -> None:
+        self.network.connect_peer(self, peer_id, host, port)
+
+    def receive(self, frame: bytes) -> None:
+        if self.closed:
+            return
+        try:
+            self.session.handle_packet(RPCPacket.parse(frame))
+        except ConnectionError:
+            self.close()
+
+    def connection_lost(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.session.connection_lost()
+
+    def close(self) -> None:
+        """
+        Stop the node, as if its process died: both the overseer and the
+        nodes connected to it find out once the closes reach them.
+        """
+        if self.closed:
+            return
+        if self.pipe is not None:
+            self.pipe.close()
+        self.connection_lost()
+        if self.session.direct_address is not None:
+            self.network.unlisten(self.session.direct_address)
+        for link in self.inbound:
+            link.reverse.close()
+        self.inbound = []
@@ -0,0 +1,164 @@
+from raftlog import fsync_directory
+from typing import Optional, Union
+
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+
+"""
+State machine snapshots. A node keeps one snapshot at a time, in a single file
+laid out as <last included index:u64><last included term:u64><length:u64>
+<crc32:u32> followed by the state machine's serialized state.
+
+Snapshots are written to a temporary file and renamed into place once synced,
+so a crash leaves either the old snapshot or the new one. Reading one back maps
+the file, so sending it to a lagging follower never needs it all in memory.
+"""
+
+SNAPSHOT_HEADER = struct.Struct("!QQQI")
+SNAPSHOT_FILE = "snapshot" # type: str
+TEMP_SUFFIX = ".tmp" # type: str
+
+SnapshotData = Union[bytes, memoryview]
+
+class Snapshot(object):
+    """
+    A complete snapshot: the state as of last_index, which had last_term.
+    """
+
+    def __init__(self, last_index: int, last_term: int, data: SnapshotData) -> None:
+        self.last_index = last_index # type: int
+        self.last_term = last_term # type: int
+        # Either the bytes themselves or a view into a mapping of the file.
+        self.data = data # type: SnapshotData
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    def chunk(self, offset: int, size: int) -> SnapshotData:
+        return self.data[offset:offset + size]
+
+class SnapshotWriter(object):
+    """
+    Receives a snapshot piece by piece, in order, and hands the finished
+    snapshot to its SnapshotStore.
+    """
+
+    def __init__(self, store: "SnapshotStore", last_index: int, last_term: int, size: int) -> None:
+        self.store = store # type: SnapshotStore
+        self.last_index = last_index # type: int
+        self.last_term = last_term # type: int
+        self.size = size # type: int
+        self.received = 0 # type: int
+        self.crc = 0 # type: int
+        self.file = None
+        self.buffer = None # type: Optional[bytearray]
+        if store.directory is None:
+            self.buffer = bytearray()
+        else:
+            # Unique, since a node may take a snapshot of its own while it
+            # receives one from its leader.
+            fd, temp_path = tempfile.mkstemp(
+                dir=store.directory, prefix=SNAPSHOT_FILE + "-", suffix=TEMP_SUFFIX
+            )
+            self.file = os.fdopen(fd, "wb")
+            self.temp_path = temp_path # type: str
+            # Header last, once the CRC is known.
+            self.file.seek(SNAPSHOT_HEADER.size)
+
+    @property
+    def done(self) -> bool:
+        return self.received == self.size
+
+    def write(self, data: SnapshotData) -> None:
+        if self.received + len(data) > self.size:
+            raise ValueError("Snapshot chunk runs past its declared size of %s." % self.size)
+        self.crc = zlib.crc32(data, self.crc)
+        if self.buffer is not None:
+            self.buffer.extend(data)
+        elif self.file is not None:
+            self.file.write(data)
+        else:
+            raise ValueError("Snapshot write was aborted.")
+        self.received += len(data)
+
+    def abort(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            os.remove(self.temp_path)
+            self.file = None
+
+    def finish(self) -> Snapshot:
+        if not self.done:
+            raise ValueError("Snapshot incomplete: %s of %s bytes." % (self.received, self.size))
+        if self.buffer is not None:
+            snapshot = Snapshot(self.last_index, self.last_term, bytes(self.buffer))
+            self.store.current = snapshot
+            return snapshot
+        if self.file is None:
+            raise ValueError("Snapshot write was aborted.")
+
+        self.file.seek(0)
+        self.file.write(SNAPSHOT_HEADER.pack(self.last_index, self.last_term, self.size, self.crc))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.temp_path, self.store.path)
+        fsync_directory(self.store.directory)
+        written = self.store.load()
+        if written is None:
+            raise ValueError("Snapshot cannot be read back once written.")
+        return written
+
+class SnapshotStore(object):
+    """
+    Where a node keeps its latest snapshot. Without a directory, snapshots
+    only live in memory.
+    """
+
+    def __init__(self, directory: Optional[str] = None) -> None:
+        self.directory = directory # type: Optional[str]
+        self.current = None # type: Optional[Snapshot]
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            # Left behind by writes that never finished.
+            for name in os.listdir(directory):
+                if name.startswith(SNAPSHOT_FILE + "-") and name.endswith(TEMP_SUFFIX):
+                    os.remove(os.path.join(directory, name))
+
+    @property
+    def path(self) -> str:
+        if self.directory is None:
+            raise ValueError("Snapshots kept in memory have no path.")
+        return os.path.join(self.directory, SNAPSHOT_FILE)
+
+    def load(self) -> Optional[Snapshot]:
+        """
+        The latest snapshot, or None if there is none (or it is corrupt).
+        """
+        if self.directory is None:
+            return self.current
+        try:
+            with open(self.path, "rb") as snapshot_file:
+                mapping = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            # ValueError: an empty file cannot be mapped.
+            return None
+
+        last_index, last_term, size, crc = SNAPSHOT_HEADER.unpack_from(mapping)
+        data = memoryview(mapping)[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + size]
+        if len(data) != size or zlib.crc32(data) != crc:
+            return None
+        self.current = Snapshot(last_index, last_term, data)
+        return self.current
+
+    def writer(self, last_index: int, last_term: int, size: int) -> SnapshotWriter:
+        return SnapshotWriter(self, last_index, last_term, size)
+
+    def save(self, last_index: int, last_term: int, data: SnapshotData) -> Snapshot:
+        writer = self.writer(last_index, last_term, len(data))
+        writer.write(data)
+        return writer.finish()
@@ -0,0 +1,61 @@
+from typing import Any
+
+"""
+What a Raft cluster replicates its log into. Every node applies committed
+entries, in log order, to its own StateMachine.
+"""
+
+class CommandError(ValueError):
+    """
+    A command the state machine cannot make sense of. Since every node
+    rejects it alike, it leaves the state as it was.
+    """
+
+class StateMachine(object):
+    """
+    Interface for replicated state machines. Implementations must be
+    deterministic: the same entries applied in the same order must always
+    produce the same state.
+    """
+
+    def check(self, command: bytes) -> None:
+        """
+        Raise CommandError if command could never be applied, before it goes
+        into the log.
+        """
+        pass
+
+    def apply(self, index: int, command: bytes) -> Any:
+        """
+        Apply the committed entry at index. The result is handed back to
+        whoever proposed the entry, if it was proposed on this node. Raises
+        CommandError, which goes to the proposer instead, for a command that
+        cannot be applied.
+        """
+        raise NotImplementedError()
+
+    def snapshot(self) -> bytes:
+        """
+        Serialize the state as it stands after the last applied entry.
+        """
+        raise NotImplementedError()
+
+    def restore(self, data: bytes) -> None:
+        """
+        Replace the state with one serialized by snapshot().
+        """
+        raise NotImplementedError()
+
+class NullStateMachine(StateMachine):
+    """
+    Keeps no state at all, for clusters that only exercise the log.
+    """
+
+    def apply(self, index: int, command: bytes) -> Any:
+        return None
+
+    def snapshot(self) -> bytes:
+        return b""
+
+    def restore(self, data: bytes) -> None:
+        pass
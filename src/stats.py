@@ -0,0 +1,38 @@
+from argparse import ArgumentParser
+from commons import FrameDecoder, OverseerCommands, RPCPacket
+
+import commons
+import socket
+import sys
+
+"""
+Ask a running overseer for its metrics. Sends STATS in place of a LOGIN, so
+the overseer answers and hangs up without counting us as a node:
+
+    python src/stats.py -H 127.0.0.1 -p 16981
+
+A sharded overseer answers for whichever worker the connection lands on; give
+the workers a --metrics-port to see each of them.
+"""
+
+def fetch_stats(host: str, port: int, timeout: float = 5.0) -> str:
+    with socket.create_connection((host, port), timeout) as sock:
+        stats = RPCPacket(0, OverseerCommands.STATS, [commons.PROTOCOL_VERSION])
+        # Offering v3 or later takes a v2 frame; see the overseer's docs.
+        sock.sendall(stats.make_sendable_stream(commons.PROTOCOL_V2))
+        decoder = FrameDecoder()
+        while True:
+            for frame in decoder.frames():
+                resp = RPCPacket.parse(frame)
+                if resp.command != OverseerCommands.ACK:
+                    raise ConnectionError("Overseer refused STATS: %s" % resp)
+                return bytes(resp.data).decode()
+            if not decoder.recv_from(sock):
+                raise ConnectionError("Overseer closed the connection before answering.")
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Print the metrics of a raftel overseer.")
+    parser.add_argument("--host", "-H", required=False, type=str, default="127.0.0.1")
+    parser.add_argument("--port", "-p", required=True, type=int)
+    args = parser.parse_args()
+    sys.stdout.write(fetch_stats(args.host, args.port))
@@ -0,0 +1,114 @@
+from typing import Dict, Hashable, List, Set, Tuple
+
+class TimerWheel(object):
+    """
+    Hierarchical hashed timer wheel, after Varghese and Lauck.
+
+    Keys are scheduled to expire at a deadline (in milliseconds, on whatever
+    clock the caller uses) and handed back by advance() once the wheel has been
+    driven past that deadline. Scheduling, rescheduling and cancelling are
+    O(1), and so is advancing by one tick apart from the keys that actually
+    expire or cascade down a level. This is what lets thousands of idle keys
+    cost next to nothing.
+
+    The wheel does not read any clock itself; callers pass the current time to
+    advance().
+    """
+
+    def __init__(self, tick_ms: int = 100, wheel_size: int = 256, levels: int = 3, now: int = 0) -> None:
+        """
+        tick_ms is the resolution of the wheel: deadlines are rounded up to a
+        whole tick. The first level covers wheel_size ticks, and every further
+        level covers wheel_size times the span of the one below it. Deadlines
+        beyond the top level are re-examined once per revolution of it.
+        """
+        if tick_ms <= 0 or wheel_size < 2 or levels < 1:
+            raise ValueError("Invalid timer wheel geometry.")
+        self.tick_ms = tick_ms # type: int
+        self.wheel_size = wheel_size # type: int
+        self.levels = levels # type: int
+        self.current_tick = now // tick_ms # type: int
+        self.slots = [
+            [set() for _ in range(wheel_size)] for _ in range(levels)
+        ] # type: List[List[Set[Hashable]]]
+        # key -> (expiry tick, level, slot index)
+        self.entries = {} # type: Dict[Hashable, Tuple[int, int, int]]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.entries
+
+    def __place(self, key: Hashable, expiry_tick: int, earliest_tick: int) -> None:
+        """
+        File key under the slot covering expiry_tick. Keys already due go in
+        the slot for earliest_tick, the soonest slot still to be checked.
+        """
+        delta = expiry_tick - self.current_tick
+        level = 0
+        span = 1
+        while level < self.levels - 1 and delta >= span * self.wheel_size:
+            level += 1
+            span *= self.wheel_size
+
+        # Keys beyond the top level's span land in the slot they would occupy
+        # anyway; it comes around (and cascades or is checked again) once per
+        # revolution until they are due.
+        slot = (max(expiry_tick, earliest_tick) // span) % self.wheel_size
+
+        self.slots[level][slot].add(key)
+        self.entries[key] = (expiry_tick, level, slot)
+
+    def schedule(self, key: Hashable, deadline: int) -> None:
+        """
+        Expire key at deadline, replacing any deadline it already had.
+        """
+        self.cancel(key)
+        # Round up, so a key never expires before its deadline.
+        # The current tick's slot has already been checked.
+        self.__place(key, -(-deadline // self.tick_ms), self.current_tick + 1)
+
+    def cancel(self, key: Hashable) -> bool:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        _, level, slot = entry
+        self.slots[level][slot].discard(key)
+        return True
+
+    def __cascade(self, level: int) -> None:
+        span = self.wheel_size ** level
+        slot = self.slots[level][(self.current_tick // span) % self.wheel_size]
+        moving = list(slot)
+        slot.clear()
+        for key in moving:
+            expiry_tick = self.entries[key][0]
+            # Cascades run before the current tick's slot is checked.
+            self.__place(key, expiry_tick, self.current_tick)
+
+    def advance(self, now: int) -> List[Hashable]:
+        """
+        Drive the wheel up to now and return every key whose deadline has
+        passed, in no particular order. Expired keys are forgotten.
+        """
+        expired = [] # type: List[Hashable]
+        target_tick = now // self.tick_ms
+        while self.current_tick < target_tick:
+            self.current_tick += 1
+
+            # Higher levels first, so keys can fall through several levels in
+            # one tick.
+            for level in range(self.levels - 1, 0, -1):
+                if self.current_tick % (self.wheel_size ** level) == 0:
+                    self.__cascade(level)
+
+            slot = self.slots[0][self.current_tick % self.wheel_size]
+            if slot:
+                for key in list(slot):
+                    if self.entries[key][0] <= self.current_tick:
+                        slot.discard(key)
+                        del self.entries[key]
+                        expired.append(key)
+
+        return expired
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The modules under src import each other by their plain names, as when run
+# from there.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
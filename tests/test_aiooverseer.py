@@ -0,0 +1,97 @@
+from aiooverseer import OverseerProtocol
+from overseercore import BackpressurePolicies, OverseerCore
+from typing import List, Tuple
+
+import asyncio
+import pytest
+
+OUTBOX_SIZE = 2
+
+class Transport(asyncio.Transport):
+    """
+    A connection whose writing and reading the test pauses and resumes.
+    """
+
+    def __init__(self) -> None:
+        super(Transport, self).__init__()
+        self.written = [] # type: List[bytes]
+        self.reading = True
+        self.aborted = False
+        self.closed = False
+
+    def is_closing(self) -> bool:
+        return self.aborted or self.closed
+
+    def pause_reading(self) -> None:
+        self.reading = False
+
+    def resume_reading(self) -> None:
+        self.reading = True
+
+    def writelines(self, frames: List[bytes]) -> None:
+        self.written.extend(frames)
+
+    def abort(self) -> None:
+        self.aborted = True
+
+    def close(self) -> None:
+        self.closed = True
+
+def slow_client(backpressure: BackpressurePolicies) -> Tuple[asyncio.AbstractEventLoop, OverseerProtocol, Transport]:
+    loop = asyncio.new_event_loop()
+    protocol = OverseerProtocol(OverseerCore(), OUTBOX_SIZE, backpressure)
+    transport = Transport()
+    protocol.transport = transport
+    protocol.loop = loop
+    protocol.pause_writing()
+    for n in range(OUTBOX_SIZE):
+        assert protocol.push(bytes([n]))
+    return loop, protocol, transport
+
+def flush(loop: asyncio.AbstractEventLoop) -> None:
+    loop.run_until_complete(asyncio.sleep(0))
+
+def test_block_stops_reading_and_caps_the_outbox() -> None:
+    loop, protocol, transport = slow_client(BackpressurePolicies.BLOCK)
+    assert not transport.reading
+    flush(loop)
+    assert transport.written == []
+
+    protocol.resume_writing()
+    flush(loop)
+    assert transport.reading and transport.written == [b"\x00", b"\x01"]
+
+    # Relays from other clients cannot be held off, so they must not pile up.
+    protocol.pause_writing()
+    for n in range(OUTBOX_SIZE):
+        assert protocol.push(bytes([n]))
+    assert not protocol.push(b"\x02") and transport.aborted
+    assert len(protocol.pending) == OUTBOX_SIZE
+    loop.close()
+
+def test_drop_keep_alive() -> None:
+    loop, protocol, transport = slow_client(BackpressurePolicies.DROP_KEEP_ALIVE)
+    assert transport.reading
+    assert not protocol.push(b"\x02", droppable=True) and not transport.aborted
+    assert not protocol.push(b"\x03") and transport.aborted
+    assert protocol.pending == [b"\x00", b"\x01"]
+    loop.close()
+
+def test_disconnect() -> None:
+    loop, protocol, transport = slow_client(BackpressurePolicies.DISCONNECT)
+    assert transport.reading
+    assert not protocol.push(b"\x02", droppable=True) and transport.aborted
+    # Nothing more is queued for a client on its way out.
+    assert not protocol.push(b"\x03")
+    assert protocol.pending == [b"\x00", b"\x01"]
+    loop.close()
+
+@pytest.mark.parametrize("backpressure", list(BackpressurePolicies))
+def test_room_left_while_writing(backpressure: BackpressurePolicies) -> None:
+    loop, protocol, transport = slow_client(backpressure)
+    protocol.resume_writing()
+    for n in range(OUTBOX_SIZE * 2):
+        assert protocol.push(bytes([n]))
+    flush(loop)
+    assert len(transport.written) == OUTBOX_SIZE * 3 and not transport.aborted
+    loop.close()
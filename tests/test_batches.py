@@ -0,0 +1,123 @@
+from commons import OverseerCommands, RPCPacket
+from nodecore import NodeSession, NodeTransport
+from overseercore import ClientSession, ClientTransport, OverseerCore
+
+import commons
+import pytest
+
+VERSION = commons.PROTOCOL_V3
+
+class Client(ClientTransport):
+    """
+    The overseer's end of a connection, keeping whatever it is sent.
+    """
+
+    def __init__(self) -> None:
+        self.frames = []
+        self.closed = False
+
+    def push(self, frame: bytes, droppable: bool = False) -> bool:
+        self.frames.append(frame)
+        return True
+
+    def close(self) -> None:
+        self.closed = True
+
+class Node(NodeTransport):
+    """
+    A node's end of a connection, with timers that only run when told to.
+    """
+
+    def __init__(self) -> None:
+        self.frames = []
+        self.timers = []
+
+    def send_frame(self, frame: bytes) -> None:
+        self.frames.append(frame)
+
+    def call_later(self, delay_ms: int, callback):
+        self.timers.append(callback)
+        return self
+
+    def cancel(self) -> None:
+        pass
+
+    def run_timers(self) -> None:
+        timers, self.timers = self.timers, []
+        for callback in timers:
+            callback()
+
+def logged_in() -> ClientSession:
+    session, _ = OverseerCore().login(RPCPacket(0, OverseerCommands.LOGIN, [VERSION]), Client())
+    return session
+
+def frame(packet_number: int, command: OverseerCommands = OverseerCommands.KEEP_ALIVE) -> bytes:
+    return RPCPacket(packet_number, command).make_sendable_stream(VERSION)
+
+def answer(session: ClientSession, batch: bytes) -> RPCPacket:
+    session.transport.frames = []
+    session.handle_packet(RPCPacket.parse(batch))
+    assert len(session.transport.frames) == 1
+    return RPCPacket.parse(session.transport.frames[0])
+
+def test_split_frames() -> None:
+    frames = [frame(1), RPCPacket(2, OverseerCommands.HEARTBEAT, [7, 8, 9], group=12).make_sendable_stream(VERSION)]
+    batch = RPCPacket.parse(commons.batch_frame(frames, VERSION))
+    assert (batch.packet_number, batch.command) == (0, OverseerCommands.BATCH)
+    assert [bytes(split) for split in commons.split_frames(batch.data)] == frames
+
+    with pytest.raises(ValueError):
+        list(commons.split_frames(batch.data[:-1]))
+    with pytest.raises(ValueError):
+        list(commons.split_frames(RPCPacket(1, OverseerCommands.KEEP_ALIVE).make_sendable_stream(commons.PROTOCOL_V1)))
+
+def test_batch_answered_in_one_frame() -> None:
+    session = logged_in()
+    reply = answer(session, commons.batch_frame(
+        [frame(1), frame(2, OverseerCommands.PEER_UPDATE), frame(3)], VERSION
+    ))
+    assert (reply.packet_number, reply.command, reply.additional_info) == (0, OverseerCommands.BATCH, [1, 3])
+    nacks = [RPCPacket.parse(nack) for nack in commons.split_frames(reply.data)]
+    assert [(nack.packet_number, nack.additional_info) for nack in nacks] == [
+        (2, [OverseerCommands.INVALID_CMD.value])
+    ]
+
+def test_unparsable_frame_in_a_batch() -> None:
+    session = logged_in()
+    unknown = commons.V2_HEADER.pack(commons.SOH, VERSION, 6, 2, ord("q")) + bytes(6)
+    truncated = frame(3)[:-2]
+    truncated = truncated[:2] + (len(truncated) - commons.V2_HEADER.size).to_bytes(4, "big") + truncated[6:]
+    reply = answer(session, commons.batch_frame([frame(1), unknown, truncated, frame(4)], VERSION))
+    # Every packet after the bad ones is still handled.
+    assert reply.additional_info == [1, 4]
+    nacks = [RPCPacket.parse(nack) for nack in commons.split_frames(reply.data)]
+    assert [(nack.packet_number, nack.additional_info) for nack in nacks] == [
+        (2, [OverseerCommands.INVALID_CMD.value]), (3, [OverseerCommands.MALFORMED_PKT.value])
+    ]
+
+def test_batch_that_cannot_be_taken_apart() -> None:
+    session = logged_in()
+    batch = RPCPacket(0, OverseerCommands.BATCH, data=frame(1) + b"\x02 not a frame" + frame(2))
+    reply = answer(session, batch.make_sendable_stream(VERSION))
+    # Nothing is ever answered as packet 0; what is left out counts as NACKed.
+    assert (reply.command, reply.additional_info, reply.data) == (OverseerCommands.BATCH, [1], b"")
+
+def test_node_settles_a_batch_the_overseer_could_not_read() -> None:
+    transport = Node()
+    node = NodeSession(transport)
+    node.handle_packet(RPCPacket(0, OverseerCommands.ACK, [1, VERSION]))
+    for term in range(3):
+        node.send(OverseerCommands.REQUEST_VOTE, [term, 0, 0])
+    transport.run_timers()
+    # The keep-alive timer went off too.
+    assert len(transport.frames) == 1 and len(node.in_flight) == 4
+
+    # Garble everything after the first packet of the batch on its way.
+    frames = [bytes(sent) for sent in commons.split_frames(RPCPacket.parse(transport.frames[0]).data)]
+    garbled = RPCPacket(0, OverseerCommands.BATCH, data=frames[0] + b"\x02" + b"".join(frames[1:]))
+    reply = answer(logged_in(), garbled.make_sendable_stream(VERSION))
+    assert reply.additional_info == []
+
+    node.handle_packet(reply)
+    assert not node.in_flight
+    assert node.nacks_received.values == {OverseerCommands.MALFORMED_PKT.name: 3}
@@ -0,0 +1,104 @@
+from capture import PacketCapture, TraceRecords, merge_traces, read_trace
+from commons import FrameDecoder, OverseerCommands, RPCPacket
+from overseercore import ClientTransport, OverseerCore
+from typing import Iterator, List
+
+import capture
+import commons
+import pytest
+
+VERSION = commons.PROTOCOL_V3
+
+class Client(ClientTransport):
+    """
+    The overseer's end of a connection, keeping whatever it is sent.
+    """
+
+    def __init__(self) -> None:
+        self.frames = [] # type: List[bytes]
+
+    def push(self, frame: bytes, droppable: bool = False) -> bool:
+        self.frames.append(frame)
+        return True
+
+    def close(self) -> None:
+        pass
+
+def ticks(*nanoseconds: int) -> Iterator[int]:
+    return iter(nanoseconds)
+
+def test_round_trip(tmp_path) -> None:
+    path = str(tmp_path / "trace.bin")
+    clock = ticks(0, 1500, 3000, 3000 + (capture.MAX_DELTA_US + 5) * 1000)
+    trace = PacketCapture(path, clock=lambda: next(clock))
+    trace.frame(1, b"\x01\x02")
+    trace.frame(2, b"")
+    trace.closed(1)
+    trace.close()
+
+    records = list(read_trace(path))
+    assert [(record.client_id, record.kind, record.frame) for record in records] == [
+        (1, TraceRecords.FRAME, b"\x01\x02"), (2, TraceRecords.FRAME, b""), (1, TraceRecords.CLOSED, b"")
+    ]
+    # Sub-microsecond remainders carry over; long silences are cut short.
+    first = records[0].at_us
+    assert [record.at_us - first for record in records] == [0, 2, 2 + capture.MAX_DELTA_US]
+
+def test_truncated_and_foreign_traces(tmp_path) -> None:
+    path = str(tmp_path / "trace.bin")
+    trace = PacketCapture(path)
+    trace.frame(1, b"complete")
+    trace.frame(1, b"cut short")
+    trace.close()
+    with open(path, "rb") as whole:
+        data = whole.read()
+    with open(path, "wb") as cut:
+        cut.write(data[:-3])
+    assert [record.frame for record in read_trace(path)] == [b"complete"]
+
+    with open(path, "wb") as foreign:
+        foreign.write(b"NOTATRACE" + data[9:])
+    with pytest.raises(ValueError):
+        list(read_trace(path))
+
+def test_merge_traces(tmp_path) -> None:
+    paths = [str(tmp_path / capture.shard_capture_path("trace.bin", shard, 2)) for shard in range(2)]
+    assert paths[0].endswith("trace.bin.0")
+    traces = [PacketCapture(path) for path in paths]
+    for n in range(4):
+        traces[n % 2].frame(n % 2, bytes([n]))
+    for trace in traces:
+        trace.close()
+    records = list(merge_traces(paths))
+    assert [record.at_us for record in records] == sorted(record.at_us for record in records)
+    assert sorted(record.frame for record in records) == [bytes([n]) for n in range(4)]
+
+def test_overseer_traffic_replays_the_same(tmp_path) -> None:
+    path = str(tmp_path / "trace.bin")
+    frames = [
+        RPCPacket(0, OverseerCommands.LOGIN, [VERSION]).make_sendable_stream(VERSION),
+        RPCPacket(1, OverseerCommands.KEEP_ALIVE).make_sendable_stream(VERSION),
+        RPCPacket(2, OverseerCommands.PEER_UPDATE).make_sendable_stream(VERSION),
+        RPCPacket(3, OverseerCommands.REQUEST_VOTE, [1, 0, 0]).make_sendable_stream(VERSION),
+    ]
+
+    def serve(core: OverseerCore, frames: List[bytes]) -> List[bytes]:
+        client = Client()
+        decoder = FrameDecoder()
+        decoder.feed(b"".join(frames))
+        login = core.login_frames(decoder, client)
+        assert login is not None
+        session, resp = login
+        assert session is not None
+        session.receive(decoder)
+        core.unregister(session)
+        return [resp] + client.frames
+
+    recorded = PacketCapture(path)
+    answers = serve(OverseerCore(capture=recorded), frames)
+    recorded.close()
+
+    records = list(read_trace(path))
+    assert [record.kind for record in records] == [TraceRecords.FRAME] * len(frames) + [TraceRecords.CLOSED]
+    assert [record.frame for record in records[:-1]] == frames
+    assert serve(OverseerCore(), [record.frame for record in records[:-1]]) == answers
@@ -0,0 +1,124 @@
+from commons import FrameDecoder, FramingError, OverseerCommands, PacketError, RPCPacket
+
+import commons
+import pytest
+import socket
+
+def sample_frames():
+    return [
+        RPCPacket(1, OverseerCommands.KEEP_ALIVE).make_sendable_stream(commons.PROTOCOL_V1),
+        # v1 arguments are single bytes, and cannot be any of the framing bytes.
+        RPCPacket(2, OverseerCommands.REQUEST_VOTE, [4, 5, 6]).make_sendable_stream(commons.PROTOCOL_V1),
+        RPCPacket(3, OverseerCommands.APPEND_ENTRIES, [2, -1, 2 ** 40], data=b"\x03\x02\x01").make_sendable_stream(
+            commons.PROTOCOL_V2
+        ),
+        RPCPacket(4, OverseerCommands.HEARTBEAT, [7, 8, 9], group=12).make_sendable_stream(commons.PROTOCOL_V3),
+        RPCPacket(5, OverseerCommands.ACK).make_sendable_stream(commons.PROTOCOL_V3),
+        # A v2 frame with ETX bytes in it, which must not end it.
+        RPCPacket(6, OverseerCommands.INSTALL_SNAPSHOT, [3], data=b"\x03" * 50).make_sendable_stream(
+            commons.PROTOCOL_V2
+        ),
+    ]
+
+def decode(decoder: FrameDecoder):
+    return [bytes(frame) for frame in decoder.frames()]
+
+def test_mixed_versions_in_one_read() -> None:
+    frames = sample_frames()
+    decoder = FrameDecoder()
+    decoder.feed(b"".join(frames))
+    assert decode(decoder) == frames
+    assert decode(decoder) == []
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64])
+def test_frames_split_across_reads(chunk_size: int) -> None:
+    frames = sample_frames() * 20
+    stream = b"".join(frames)
+    # Small enough that it has to compact and grow along the way.
+    decoder = FrameDecoder(buffer_size=16)
+    decoded = []
+    for start in range(0, len(stream), chunk_size):
+        decoder.feed(stream[start:start + chunk_size])
+        decoded.extend(decode(decoder))
+    assert decoded == frames
+
+def test_frame_larger_than_the_buffer() -> None:
+    frame = RPCPacket(1, OverseerCommands.APPEND_ENTRIES, data=bytes(10000)).make_sendable_stream(
+        commons.PROTOCOL_V2
+    )
+    decoder = FrameDecoder(buffer_size=64)
+    decoder.feed(frame[:5000])
+    assert decode(decoder) == []
+    decoder.feed(frame[5000:])
+    assert decode(decoder) == [frame]
+
+def test_frames_stay_valid_until_the_next_read() -> None:
+    frames = sample_frames()
+    decoder = FrameDecoder(buffer_size=16)
+    decoder.feed(b"".join(frames[:3]))
+    held = list(decoder.frames())
+    assert [bytes(frame) for frame in held] == frames[:3]
+
+def test_recv_from_socket() -> None:
+    frames = sample_frames()
+    left, right = socket.socketpair()
+    try:
+        left.sendall(b"".join(frames))
+        left.close()
+        decoder = FrameDecoder(buffer_size=8)
+        decoded = []
+        while decoder.recv_from(right):
+            decoded.extend(decode(decoder))
+        assert decoded == frames
+    finally:
+        right.close()
+
+def test_unsupported_version() -> None:
+    decoder = FrameDecoder()
+    decoder.feed(commons.V2_HEADER.pack(commons.SOH, 9, 0, 7, OverseerCommands.ACK.value))
+    with pytest.raises(FramingError) as error:
+        decode(decoder)
+    assert (error.value.packet_number, error.value.reason) == (7, OverseerCommands.MALFORMED_PKT)
+    assert error.value.version == commons.PROTOCOL_V2
+
+def test_frames_over_the_limit() -> None:
+    frame = RPCPacket(4, OverseerCommands.APPEND_ENTRIES, data=bytes(1000)).make_sendable_stream(
+        commons.PROTOCOL_V3
+    )
+    decoder = FrameDecoder(buffer_size=64, max_frame_size=len(frame))
+    decoder.feed(frame)
+    assert decode(decoder) == [frame]
+
+    # Refused on the header alone, however little of the rest arrived.
+    decoder = FrameDecoder(buffer_size=64, max_frame_size=len(frame) - 1)
+    decoder.feed(frame[:commons.V2_HEADER.size])
+    with pytest.raises(FramingError) as error:
+        decode(decoder)
+    assert (error.value.packet_number, error.value.version) == (4, commons.PROTOCOL_V3)
+    assert len(decoder.buffer) == 64
+
+    decoder = FrameDecoder(buffer_size=64, max_frame_size=100)
+    decoder.feed(bytes([commons.STX, 5, commons.RS]) + b"x" * 100)
+    with pytest.raises(FramingError) as error:
+        decode(decoder)
+    assert (error.value.packet_number, error.value.version) == (5, commons.PROTOCOL_V1)
+
+def test_parse_round_trip() -> None:
+    for frame in sample_frames():
+        if frame[0] != commons.SOH:
+            # v1 writes arguments back to back, so they do not read back.
+            continue
+        assert RPCPacket.parse(frame).make_sendable_stream(frame[1]) == frame
+    keep_alive = RPCPacket.parse(sample_frames()[0])
+    assert (keep_alive.packet_number, keep_alive.command) == (1, OverseerCommands.KEEP_ALIVE)
+
+def test_parse_errors() -> None:
+    with pytest.raises(PacketError) as error:
+        RPCPacket.parse(bytes([commons.STX, 7, commons.RS, ord("q"), commons.ETX]))
+    assert (error.value.packet_number, error.value.reason) == (7, OverseerCommands.INVALID_CMD)
+
+    frame = RPCPacket(9, OverseerCommands.HEARTBEAT, [1, 2]).make_sendable_stream(commons.PROTOCOL_V3)
+    with pytest.raises(PacketError) as error:
+        RPCPacket.parse(frame[:-3])
+    assert (error.value.packet_number, error.value.reason) == (9, OverseerCommands.MALFORMED_PKT)
+    assert error.value.command == OverseerCommands.HEARTBEAT.value
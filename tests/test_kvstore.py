@@ -0,0 +1,160 @@
+from kvstore import KVOps, KVStore, delete_command, parse_command, put_command
+from nodecore import NodeStates, NotLeaderError
+from simulation import SimulatedNetwork, SimulatedNode, SimulatedOverseer, VirtualClock
+from statemachine import CommandError
+from typing import List, Optional, Tuple
+
+import pytest
+
+ELECTION_TIMEOUT = 300
+# The command the cluster once choked on: an unknown op with a key.
+BAD_COMMAND = b"\x09\x00\x00\x00\x01k"
+
+Cluster = Tuple[VirtualClock, SimulatedNetwork, SimulatedOverseer, List[SimulatedNode]]
+
+def kv_cluster(size: int = 3, **options) -> Cluster:
+    clock = VirtualClock()
+    network = SimulatedNetwork(clock, seed=1)
+    overseer = SimulatedOverseer(network)
+    nodes = [
+        SimulatedNode(network, ELECTION_TIMEOUT, state_machine=KVStore(), **options) for _ in range(size)
+    ]
+    for node in nodes:
+        node.connect(overseer)
+    assert clock.run_until(lambda: leader_of(nodes) is not None)
+    return clock, network, overseer, nodes
+
+def leader_of(nodes: List[SimulatedNode]) -> Optional[SimulatedNode]:
+    leaders = [node for node in nodes if node.core.state == NodeStates.LEADER and not node.closed]
+    return leaders[0] if len(leaders) == 1 else None
+
+def submit(clock: VirtualClock, node: SimulatedNode, command: bytes) -> Tuple[object, Optional[Exception]]:
+    results = []
+    node.core.propose(command, lambda value, error: results.append((value, error)))
+    assert clock.run_until(lambda: bool(results), 5000)
+    return results[0]
+
+def read(clock: VirtualClock, node: SimulatedNode) -> List[Optional[Exception]]:
+    results = [] # type: List[Optional[Exception]]
+    node.core.read(results.append)
+    return results
+
+def test_commands() -> None:
+    store = KVStore()
+    assert store.apply(1, put_command(b"k", b"v1")) is None
+    assert store.apply(2, put_command(b"k", b"v2")) == b"v1"
+    assert store.get(b"k") == b"v2"
+    assert store.apply(3, delete_command(b"k")) == b"v2"
+    assert store.get(b"k") is None
+    assert parse_command(put_command(b"k", b"v")) == (KVOps.PUT, b"k", b"v")
+    assert parse_command(delete_command(b"k")) == (KVOps.DELETE, b"k", b"")
+
+    restored = KVStore()
+    store.apply(4, put_command(b"a", b""))
+    store.apply(5, put_command(b"b", b"\x00" * 10))
+    restored.restore(store.snapshot())
+    assert restored.data == store.data
+
+@pytest.mark.parametrize("command", [BAD_COMMAND, b"\x01\x00", b"\x01\x00\x00\x00\x05key"])
+def test_bad_commands(command: bytes) -> None:
+    store = KVStore()
+    store.apply(1, put_command(b"k", b"v"))
+    with pytest.raises(CommandError):
+        store.check(command)
+    with pytest.raises(CommandError):
+        store.apply(2, command)
+    assert store.data == {b"k": b"v"}
+
+def test_bad_command_is_rejected_before_the_log() -> None:
+    clock, _, _, nodes = kv_cluster()
+    leader = leader_of(nodes)
+    last_index = leader.core.log.last_index
+    with pytest.raises(CommandError):
+        leader.core.propose(BAD_COMMAND)
+    assert leader.core.log.last_index == last_index
+
+def test_bad_command_in_the_log_is_skipped() -> None:
+    clock, _, overseer, nodes = kv_cluster()
+    leader = leader_of(nodes)
+    # As if written by a leader that did not check its commands.
+    leader.core.state_machine.check = lambda command: None
+    value, error = submit(clock, leader, BAD_COMMAND)
+    assert value is None and isinstance(error, CommandError)
+
+    # The cluster carries on, with every replica past the bad entry.
+    assert submit(clock, leader, put_command(b"k", b"v")) == (None, None)
+    assert clock.run_until(lambda: all(node.core.state_machine.get(b"k") == b"v" for node in nodes))
+    assert leader_of(nodes) is leader and not any(node.closed for node in nodes)
+
+    # A node catching up from scratch gets past it too.
+    late = SimulatedNode(overseer.network, ELECTION_TIMEOUT, state_machine=KVStore())
+    late.connect(overseer)
+    assert clock.run_until(lambda: late.core.last_applied == leader.core.last_applied, 5000)
+    assert late.core.state_machine.data == {b"k": b"v"}
+
+def test_read_index() -> None:
+    clock, _, _, nodes = kv_cluster()
+    leader = leader_of(nodes)
+    submit(clock, leader, put_command(b"k", b"v"))
+    rounds = leader.core.heartbeat_round
+
+    reads = [read(clock, leader) for _ in range(3)]
+    # Not before a heartbeat round confirms nobody else leads; the reads
+    # share that round.
+    assert reads == [[], [], []]
+    assert clock.run_until(lambda: all(reads), 1000)
+    assert reads == [[None], [None], [None]]
+    assert leader.core.heartbeat_round == rounds + 1
+
+    follower = next(node for node in nodes if node is not leader)
+    error = read(clock, follower)[0]
+    assert isinstance(error, NotLeaderError) and error.leader_id == leader.raft_id
+
+def test_read_index_waits_for_the_quorum() -> None:
+    clock, network, _, nodes = kv_cluster()
+    leader = leader_of(nodes)
+    submit(clock, leader, put_command(b"k", b"v"))
+    network.partition([leader.address], [node.address for node in nodes if node is not leader])
+    results = read(clock, leader)
+    clock.run_for(ELECTION_TIMEOUT / 2)
+    assert results == []
+    network.heal()
+    assert clock.run_until(lambda: bool(results), 5000)
+    # Either confirmed once healed, or failed because it was deposed.
+    assert results[0] is None or isinstance(results[0], NotLeaderError)
+
+def test_lease_reads() -> None:
+    clock, _, _, nodes = kv_cluster(lease_reads=True)
+    leader = leader_of(nodes)
+    submit(clock, leader, put_command(b"k", b"v"))
+    clock.run_for(leader.core.heartbeat_interval * 2)
+    rounds = leader.core.heartbeat_round
+
+    # Within the lease, reads are served at once.
+    assert read(clock, leader) == [None]
+    assert leader.core.heartbeat_round == rounds
+
+def test_lease_expires_without_a_quorum() -> None:
+    clock, network, _, nodes = kv_cluster(lease_reads=True)
+    leader = leader_of(nodes)
+    submit(clock, leader, put_command(b"k", b"v"))
+    network.partition([leader.address], [node.address for node in nodes if node is not leader])
+    clock.run_for(ELECTION_TIMEOUT)
+    # Not served from the lease any more; the others may even have elected
+    # a leader of their own by now.
+    results = read(clock, leader)
+    assert results == [] or isinstance(results[0], NotLeaderError)
+
+def test_leader_steps_down_when_cut_off_from_the_overseer() -> None:
+    clock, _, _, nodes = kv_cluster()
+    leader = leader_of(nodes)
+    proposals = [] # type: List[Optional[Exception]]
+    leader.core.propose(put_command(b"k", b"v"), lambda value, error: proposals.append(error))
+    reads = read(clock, leader)
+    leader.connection_lost()
+
+    assert leader.core.state == NodeStates.FOLLOWER
+    assert isinstance(proposals[0], NotLeaderError) and isinstance(reads[0], NotLeaderError)
+    assert leader.core.propose(put_command(b"k", b"v")) is None
+    error = read(clock, leader)[0]
+    assert isinstance(error, NotLeaderError) and error.leader_id is None
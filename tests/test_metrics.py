@@ -0,0 +1,131 @@
+from commons import OverseerCommands, RPCPacket
+from metrics import MetricsRegistry, MetricsServer, PacketLog
+from overseercore import ClientTransport, OverseerCore
+from typing import List
+from urllib.request import urlopen
+
+import commons
+import logging
+import pytest
+
+VERSION = commons.PROTOCOL_V3
+
+class Client(ClientTransport):
+    """
+    The overseer's end of a connection, keeping whatever it is sent.
+    """
+
+    def __init__(self) -> None:
+        self.frames = [] # type: List[bytes]
+
+    def push(self, frame: bytes, droppable: bool = False) -> bool:
+        self.frames.append(frame)
+        return True
+
+    def close(self) -> None:
+        pass
+
+class Records(logging.Handler):
+    """
+    Keeps every record it handles.
+    """
+
+    def __init__(self) -> None:
+        super(Records, self).__init__()
+        self.records = [] # type: List[logging.LogRecord]
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.records.append(record)
+
+def test_render() -> None:
+    registry = MetricsRegistry("test")
+    sent = registry.counter("sent_total", "Packets sent.", "command")
+    sent.inc("VOTE")
+    sent.inc("ACK", 3)
+    registry.counter("lost_total", "Packets lost.")
+    rtt = registry.histogram("rtt", "Round trips.")
+    for value in (0, 1, 5, 6):
+        rtt.observe(value)
+    registry.gauge("clients", "Clients.", lambda: 2)
+
+    assert registry.render() == "\n".join([
+        "# HELP test_clients Clients.",
+        "# TYPE test_clients gauge",
+        "test_clients 2",
+        "# HELP test_lost_total Packets lost.",
+        "# TYPE test_lost_total counter",
+        "test_lost_total 0",
+        "# HELP test_rtt Round trips.",
+        "# TYPE test_rtt histogram",
+        'test_rtt_bucket{le="0"} 1',
+        'test_rtt_bucket{le="1"} 2',
+        'test_rtt_bucket{le="3"} 2',
+        'test_rtt_bucket{le="7"} 4',
+        'test_rtt_bucket{le="+Inf"} 4',
+        "test_rtt_sum 12",
+        "test_rtt_count 4",
+        "# HELP test_sent_total Packets sent.",
+        "# TYPE test_sent_total counter",
+        'test_sent_total{command="ACK"} 3',
+        'test_sent_total{command="VOTE"} 1',
+    ]) + "\n"
+    assert sent.total == 4
+    assert (rtt.percentile(0.5), rtt.percentile(0.99)) == (1, 6)
+
+def test_register_twice() -> None:
+    registry = MetricsRegistry("test")
+    counter = registry.counter("sent_total", "Packets sent.")
+    assert registry.counter("sent_total", "Packets sent.") is counter
+    with pytest.raises(ValueError):
+        registry.histogram("sent_total", "Packets sent.")
+
+def test_packet_log_samples() -> None:
+    log = PacketLog("raftel-test", every=3)
+    handler = Records()
+    log.logger.addHandler(handler)
+    try:
+        for packet in range(7):
+            log.log("packet %s", packet)
+        # Nothing below DEBUG is even counted.
+        assert handler.records == [] and log.seen == 0
+        log.logger.setLevel(logging.DEBUG)
+        for packet in range(7):
+            log.log("packet %s", packet)
+        assert [record.getMessage() for record in handler.records] == ["packet 2", "packet 5"]
+    finally:
+        log.logger.removeHandler(handler)
+        log.logger.setLevel(logging.NOTSET)
+
+def test_stats() -> None:
+    core = OverseerCore()
+    session, _ = core.login(RPCPacket(0, OverseerCommands.LOGIN, [VERSION]), Client())
+    session.handle_packet(RPCPacket(1, OverseerCommands.KEEP_ALIVE))
+    session.handle_packet(RPCPacket(2, OverseerCommands.STATS))
+    stats = RPCPacket.parse(session.transport.frames[-1])
+    assert (stats.packet_number, stats.command) == (2, OverseerCommands.ACK)
+    lines = stats.data.decode().splitlines()
+    assert "raftel_overseer_clients 1" in lines
+    assert 'raftel_overseer_packets_received_total{command="KEEP_ALIVE"} 1' in lines
+
+    # Asked for in place of a LOGIN, by monitoring that is no node.
+    client = Client()
+    unlogged, resp = core.login(RPCPacket(0, OverseerCommands.STATS, [VERSION]), client)
+    assert unlogged is None and len(core.clients) == 1
+    assert RPCPacket.parse(resp).data.decode() == core.metrics.render()
+
+    # v1 has no room for it.
+    old, _ = OverseerCore().login(RPCPacket(0, OverseerCommands.LOGIN), Client())
+    old.handle_packet(RPCPacket(1, OverseerCommands.STATS))
+    nack = RPCPacket.parse(old.transport.frames[-1])
+    assert (nack.command, nack.additional_info) == (OverseerCommands.NACK, [OverseerCommands.INVALID_CMD.value])
+
+def test_metrics_server() -> None:
+    registry = MetricsRegistry("test")
+    registry.counter("sent_total", "Packets sent.").inc()
+    server = MetricsServer(registry, 0)
+    server.start()
+    try:
+        with urlopen("http://127.0.0.1:%s/metrics" % server.port) as response:
+            assert response.read().decode() == registry.render()
+    finally:
+        server.close()
@@ -0,0 +1,135 @@
+from commons import OverseerCommands, RPCPacket
+from nodecore import NodeSession, NodeTransport, PeerLink
+from typing import Any, Callable, List, Optional, Tuple
+
+import commons
+
+VERSION = commons.PROTOCOL_V3
+
+class Node(NodeTransport):
+    """
+    A node's end of a connection, with timers that only run when told to.
+    """
+
+    def __init__(self) -> None:
+        self.frames = [] # type: List[bytes]
+        self.timers = [] # type: List[Callable[[], None]]
+        self.dialled = [] # type: List[Tuple[int, str, int]]
+
+    def send_frame(self, frame: bytes) -> None:
+        self.frames.append(frame)
+
+    def call_later(self, delay_ms: int, callback: Callable[[], None]) -> Any:
+        self.timers.append(callback)
+        return self
+
+    def cancel(self) -> None:
+        pass
+
+    def connect_peer(self, peer_id: int, host: str, port: int) -> None:
+        self.dialled.append((peer_id, host, port))
+
+class Link(PeerLink):
+    """
+    A direct connection to another node, keeping whatever it is sent.
+    """
+
+    def __init__(self) -> None:
+        self.frames = [] # type: List[bytes]
+        self.closed = False
+
+    def push(self, frame: bytes) -> None:
+        self.frames.append(frame)
+
+    def close(self) -> None:
+        self.closed = True
+
+    def packets(self) -> List[RPCPacket]:
+        packets = [RPCPacket.parse(frame) for frame in self.frames]
+        self.frames = []
+        return packets
+
+def log_in(
+    raft_id: int = 1,
+    members: Optional[List[int]] = None,
+    direct_address: Optional[Tuple[str, int]] = None,
+    **options
+) -> Tuple[NodeSession, Node]:
+    transport = Node()
+    session = NodeSession(transport, **options)
+    session.direct_address = direct_address
+    session.handle_packet(RPCPacket(0, OverseerCommands.ACK, [raft_id, VERSION] + (members or [])))
+    assert session.connected
+    transport.frames = []
+    return session, transport
+
+def test_window_holds_packets_back() -> None:
+    session, _ = log_in(window_size=2)
+    for term in range(4):
+        session.send(OverseerCommands.REQUEST_VOTE, [term, 0, 0])
+    assert list(session.in_flight) == [1, 2] and len(session.backlog) == 2
+
+    session.handle_packet(RPCPacket(1, OverseerCommands.ACK))
+    assert list(session.in_flight) == [2, 3] and len(session.backlog) == 1
+    # The window starts at the oldest packet in flight, however many
+    # answers came in after it.
+    session.handle_packet(RPCPacket(3, OverseerCommands.NACK, [OverseerCommands.GENERAL_FAILURE.value]))
+    assert list(session.in_flight) == [2] and len(session.backlog) == 1
+    session.handle_packet(RPCPacket(2, OverseerCommands.ACK))
+    assert list(session.in_flight) == [4] and not session.backlog
+    assert session.in_flight[4].additional_info == [3, 0, 0]
+
+def test_direct_mode() -> None:
+    host = commons.host_to_int("10.0.0.2")
+    # Peer 2 takes direct connections, peer 3 only talks through the overseer.
+    session, transport = log_in(1, [2, host, 7000, 3, 0, 0], ("10.0.0.1", 7000))
+    assert transport.dialled == [(2, "10.0.0.2", 7000)]
+    assert session.peers == {2: ("10.0.0.2", 7000), 3: ("0.0.0.0", 0)}
+
+    link = Link()
+    session.peer_connected(2, link)
+    session.send(OverseerCommands.VOTE, [2, 5, 1])
+    relayed, = link.packets()
+    assert (relayed.command, relayed.additional_info) == (OverseerCommands.VOTE, [1, 5, 1])
+    assert not session.in_flight
+    # Not every peer can be reached directly, so broadcasts still go through
+    # the overseer, as does anything for peer 3.
+    session.send(OverseerCommands.REQUEST_VOTE, [5, 0, 0])
+    session.send(OverseerCommands.VOTE, [3, 5, 1])
+    assert link.packets() == [] and len(session.in_flight) == 2
+
+    # A peer joining is dialled, one leaving is hung up on.
+    session.handle_packet(RPCPacket(0, OverseerCommands.PEER_UPDATE, [4, host, 7001, 1]))
+    assert transport.dialled[-1] == (4, "10.0.0.2", 7001)
+    session.handle_packet(RPCPacket(0, OverseerCommands.PEER_UPDATE, [2, 0, 0, 0]))
+    assert link.closed and 2 not in session.peers and not session.peer_links
+
+    # Until a lost connection is back, traffic goes through the overseer.
+    other = Link()
+    session.peer_connected(4, other)
+    session.peer_lost(4, other)
+    session.send(OverseerCommands.VOTE, [4, 5, 1])
+    assert other.packets() == [] and len(session.in_flight) == 3
+
+def test_heartbeats_of_many_groups() -> None:
+    session, transport = log_in()
+    session.send_heartbeat(1, [3, 10, 1])
+    session.send_heartbeat(2, [4, 20, 1])
+    transport.timers.pop()()
+    # One packet for every group we lead.
+    coalesced, = session.in_flight.values()
+    assert (coalesced.command, coalesced.additional_info) == (
+        OverseerCommands.HEARTBEATS, [1, 3, 10, 1, 2, 4, 20, 1]
+    )
+
+    follower, _ = log_in(raft_id=2)
+    for group in (1, 2):
+        follower.add_group(group, 300).current_term = group
+    follower.in_flight.clear()
+    # Group 9 is not ours; group 2's leader is behind our term.
+    follower.handle_packet(RPCPacket(0, OverseerCommands.HEARTBEATS, [1, 1, 3, 0, 7, 2, 1, 0, 7, 9, 5, 0, 7]))
+    replies, = follower.in_flight.values()
+    assert (replies.command, replies.additional_info) == (
+        OverseerCommands.HEARTBEAT_REPLIES, [1, 1, 3, 0, 7, 2, 2, 0, 7]
+    )
+    assert follower.groups[1].leader_id == 1 and follower.groups[2].leader_id is None
@@ -0,0 +1,246 @@
+from commons import FrameDecoder, OverseerCommands, RPCPacket
+from overseercore import ClientSession, ClientTransport, OverseerCore
+from typing import List, Tuple
+
+import commons
+
+VERSION = commons.PROTOCOL_V3
+
+class Client(ClientTransport):
+    """
+    The overseer's end of a connection, keeping whatever it is sent.
+    """
+
+    def __init__(self) -> None:
+        self.frames = [] # type: List[bytes]
+        self.closed = False
+
+    def push(self, frame: bytes, droppable: bool = False) -> bool:
+        self.frames.append(frame)
+        return True
+
+    def close(self) -> None:
+        self.closed = True
+
+    def packets(self) -> List[RPCPacket]:
+        packets = [RPCPacket.parse(frame) for frame in self.frames]
+        self.frames = []
+        return packets
+
+def log_in(core: OverseerCore, version: int = VERSION) -> Tuple[ClientSession, Client]:
+    client = Client()
+    session, _ = core.login(RPCPacket(0, OverseerCommands.LOGIN, [version]), client)
+    assert session is not None
+    client.frames = []
+    return session, client
+
+def receive(session: ClientSession, *frames: bytes) -> bool:
+    decoder = FrameDecoder()
+    decoder.feed(b"".join(frames))
+    return session.receive(decoder)
+
+def nacked(packet: RPCPacket, packet_number: int, reason: OverseerCommands) -> bool:
+    return (packet.packet_number, packet.command, packet.additional_info) == (
+        packet_number, OverseerCommands.NACK, [reason.value]
+    )
+
+def test_unsupported_version_is_nacked_and_closed() -> None:
+    session, client = log_in(OverseerCore())
+    keep_alive = RPCPacket(1, OverseerCommands.KEEP_ALIVE).make_sendable_stream(VERSION)
+    unsupported = commons.V2_HEADER.pack(commons.SOH, 9, 0, 2, OverseerCommands.KEEP_ALIVE.value)
+    assert not receive(session, keep_alive, unsupported, keep_alive)
+    ack, nack = client.packets()
+    assert (ack.packet_number, ack.command) == (1, OverseerCommands.ACK)
+    assert nacked(nack, 2, OverseerCommands.MALFORMED_PKT)
+    assert client.closed and session.closed
+
+def test_frame_over_the_limit_is_nacked_and_closed() -> None:
+    session, client = log_in(OverseerCore())
+    huge = commons.V2_HEADER.pack(commons.SOH, VERSION, commons.MAX_FRAME_SIZE, 1, OverseerCommands.KEEP_ALIVE.value)
+    assert not receive(session, huge)
+    assert nacked(client.packets()[0], 1, OverseerCommands.MALFORMED_PKT)
+    assert client.closed
+
+def test_login_that_cannot_be_framed() -> None:
+    core = OverseerCore()
+    decoder = FrameDecoder()
+    client = Client()
+    assert core.login_frames(decoder, client) is None
+    decoder.feed(commons.V2_HEADER.pack(commons.SOH, 9, 0, 0, OverseerCommands.LOGIN.value))
+    session, resp = core.login_frames(decoder, client)
+    assert session is None and not core.clients
+    assert nacked(RPCPacket.parse(resp), 0, OverseerCommands.MALFORMED_PKT)
+
+    decoder = FrameDecoder()
+    decoder.feed(RPCPacket(0, OverseerCommands.LOGIN, [VERSION]).make_sendable_stream(VERSION))
+    session, resp = core.login_frames(decoder, client)
+    assert session is not None and RPCPacket.parse(resp).command == OverseerCommands.ACK
+
+def test_mixed_versions() -> None:
+    core = OverseerCore()
+    old, old_client = log_in(core, commons.PROTOCOL_V1)
+    sessions = [log_in(core) for _ in range(3)]
+    new, new_client = sessions[-1]
+    assert (old.clientid, new.clientid) == (1, 4)
+
+    def send(session: ClientSession, client: Client, packet: RPCPacket) -> RPCPacket:
+        assert receive(session, packet.make_sendable_stream(session.version))
+        resp, = client.packets()
+        return resp
+
+    # Terms and indices past a byte do not fit v1, so the old node is left out.
+    for packet in (
+        RPCPacket(1, OverseerCommands.REQUEST_VOTE, [300, 0, 0]),
+        RPCPacket(2, OverseerCommands.HEARTBEAT, [1, 256, 1]),
+        RPCPacket(3, OverseerCommands.HEARTBEATS, [0, 1, 300, 1, 0, 1, 2, 3]),
+    ):
+        resp = send(new, new_client, packet)
+        assert resp.command == OverseerCommands.ACK and set(resp.additional_info) == {2}
+        assert old_client.packets() == []
+    resp = send(new, new_client, RPCPacket(4, OverseerCommands.VOTE, [old.clientid, 300, 1]))
+    assert nacked(resp, 4, OverseerCommands.GENERAL_FAILURE)
+    assert core.v1_relays_skipped.total == 4
+
+    # Whatever fits still reaches it.
+    resp = send(new, new_client, RPCPacket(5, OverseerCommands.REQUEST_VOTE, [5, 0, 0]))
+    assert resp.additional_info == [3]
+    # v1 arguments do not parse back one by one; compare the bytes.
+    assert old_client.frames == [bytes([
+        commons.STX, 0, commons.RS, OverseerCommands.REQUEST_VOTE.value, commons.RS, 4, 5, 0, 0, commons.ETX
+    ])]
+    old_client.frames = []
+
+    # The old node gets no count of nodes reached, which may not fit either.
+    for _, client in sessions:
+        client.frames = []
+    resp = send(old, old_client, RPCPacket(1, OverseerCommands.REQUEST_VOTE, [5]))
+    assert (resp.command, resp.additional_info) == (OverseerCommands.ACK, [])
+    for session, client in sessions:
+        relayed, = client.packets()
+        assert relayed.additional_info == [1, 5]
+    assert not any(session.closed for session, _ in sessions) and not old.closed
+
+def test_packet_numbers_wrap_through_zero() -> None:
+    session, client = log_in(OverseerCore())
+    numbers = [(n + 1) % 256 for n in range(300)]
+    assert receive(session, *(
+        RPCPacket(n, OverseerCommands.KEEP_ALIVE).make_sendable_stream(VERSION) for n in numbers
+    ))
+    assert [(ack.packet_number, ack.command) for ack in client.packets()] == [
+        (n, OverseerCommands.ACK) for n in numbers
+    ]
+
+def test_window_takes_packets_out_of_order() -> None:
+    session, client = log_in(OverseerCore(window_size=4))
+
+    def send(packet_number: int) -> RPCPacket:
+        assert receive(session, RPCPacket(packet_number, OverseerCommands.KEEP_ALIVE).make_sendable_stream(VERSION))
+        resp, = client.packets()
+        return resp
+
+    for packet_number in (2, 1, 4, 3):
+        assert send(packet_number).command == OverseerCommands.ACK
+    # Seen already, and past the window of 5 to 8.
+    assert nacked(send(3), 3, OverseerCommands.GENERAL_FAILURE)
+    assert nacked(send(9), 9, OverseerCommands.GENERAL_FAILURE)
+    assert send(8).command == OverseerCommands.ACK
+    assert send(5).command == OverseerCommands.ACK
+
+def test_routing() -> None:
+    core = OverseerCore()
+    (voter, voter_client), (first, first_client), (second, second_client) = [log_in(core) for _ in range(3)]
+
+    def send(session: ClientSession, client: Client, packet: RPCPacket) -> RPCPacket:
+        assert receive(session, packet.make_sendable_stream(VERSION))
+        resp, = client.packets()
+        return resp
+
+    # Broadcasts reach every other node, from the sender's id; the ACK
+    # counts them.
+    resp = send(voter, voter_client, RPCPacket(1, OverseerCommands.REQUEST_VOTE, [7, 3, 2]))
+    assert (resp.command, resp.additional_info) == (OverseerCommands.ACK, [2])
+    for client in (first_client, second_client):
+        relayed, = client.packets()
+        assert (relayed.packet_number, relayed.command, relayed.additional_info) == (
+            0, OverseerCommands.REQUEST_VOTE, [voter.clientid, 7, 3, 2]
+        )
+
+    # Unicasts reach their target only, with the target's id swapped for the
+    # sender's.
+    resp = send(first, first_client, RPCPacket(1, OverseerCommands.VOTE, [voter.clientid, 7, 1]))
+    assert resp.command == OverseerCommands.ACK
+    relayed, = voter_client.packets()
+    assert (relayed.command, relayed.additional_info) == (OverseerCommands.VOTE, [first.clientid, 7, 1])
+    assert second_client.packets() == []
+
+    # Nodes that are gone are neither counted nor reachable.
+    core.unregister(second)
+    resp = send(voter, voter_client, RPCPacket(2, OverseerCommands.REQUEST_VOTE, [8, 3, 2]))
+    assert resp.additional_info == [1] and second_client.packets() == []
+    first_client.packets()
+    resp = send(first, first_client, RPCPacket(2, OverseerCommands.VOTE, [second.clientid, 8, 1]))
+    assert nacked(resp, 2, OverseerCommands.GENERAL_FAILURE)
+
+def test_peer_updates() -> None:
+    core = OverseerCore()
+    host = commons.host_to_int("10.0.0.1")
+
+    def log_in_direct(port: int) -> Tuple[ClientSession, Client, RPCPacket]:
+        client = Client()
+        session, ack = core.login(RPCPacket(0, OverseerCommands.LOGIN, [VERSION, host, port]), client)
+        assert session is not None
+        return session, client, RPCPacket.parse(ack)
+
+    first, first_client, ack = log_in_direct(7000)
+    assert ack.additional_info == [first.clientid, VERSION]
+    overseen, overseen_client = log_in(core)
+    assert first_client.packets()[0].additional_info == [overseen.clientid, 0, 0, 1]
+
+    # Nodes taking direct connections learn of everyone on log-in, and of
+    # everyone coming and going after; the others hear nothing of it.
+    second, second_client, ack = log_in_direct(7001)
+    assert ack.additional_info == [second.clientid, VERSION, first.clientid, host, 7000, overseen.clientid, 0, 0]
+    update, = first_client.packets()
+    assert (update.command, update.additional_info) == (
+        OverseerCommands.PEER_UPDATE, [second.clientid, host, 7001, 1]
+    )
+    assert overseen_client.packets() == []
+
+    core.unregister(overseen)
+    for client in (first_client, second_client):
+        assert [update.additional_info for update in client.packets()] == [[overseen.clientid, 0, 0, 0]]
+
+def test_heartbeats_reach_each_group_in_one_frame() -> None:
+    core = OverseerCore()
+    (leader, leader_client), (both, both_client), (one, one_client), (none, none_client) = [
+        log_in(core) for _ in range(4)
+    ]
+    for session, groups in ((leader, (1, 2)), (both, (1, 2)), (one, (1,))):
+        for packet_number, group in enumerate(groups, 1):
+            assert receive(session, RPCPacket(
+                packet_number, OverseerCommands.JOIN_GROUP, [1], group=group
+            ).make_sendable_stream(VERSION))
+    for client in (leader_client, both_client, one_client):
+        client.packets()
+
+    assert receive(leader, RPCPacket(3, OverseerCommands.HEARTBEATS, [1, 5, 9, 2, 2, 6, 8, 3]).make_sendable_stream(VERSION))
+    ack, = leader_client.packets()
+    # Nodes reached in each group.
+    assert (ack.command, ack.additional_info) == (OverseerCommands.ACK, [2, 1])
+    relayed, = both_client.packets()
+    assert (relayed.command, relayed.additional_info) == (
+        OverseerCommands.HEARTBEATS, [leader.clientid, 1, 5, 9, 2, 2, 6, 8, 3]
+    )
+    relayed, = one_client.packets()
+    assert relayed.additional_info == [leader.clientid, 1, 5, 9, 2]
+    assert none_client.packets() == []
+
+    # The replies go back to the leader alone, in one frame too.
+    assert receive(both, RPCPacket(
+        3, OverseerCommands.HEARTBEAT_REPLIES, [leader.clientid, 1, 5, 4, 2, 2, 6, 4, 3]
+    ).make_sendable_stream(VERSION))
+    replies, = leader_client.packets()
+    assert (replies.command, replies.additional_info) == (
+        OverseerCommands.HEARTBEAT_REPLIES, [both.clientid, 1, 5, 4, 2, 2, 6, 4, 3]
+    )
+    assert one_client.packets() == [] and none_client.packets() == []
@@ -0,0 +1,167 @@
+from raftlog import ENTRY_HEADER, RaftLog
+
+import os
+import pytest
+
+# Small enough that a handful of entries spans several segments.
+SEGMENT_SIZE = 256
+
+def entry_data(index: int) -> bytes:
+    return b"entry %d " % index * (index % 7 + 1)
+
+def fill(log: RaftLog, count: int, term: int = 1) -> None:
+    for _ in range(count):
+        log.append(term, entry_data(log.last_index + 1))
+
+def check_log(log: RaftLog, first: int, last: int, term: int = 1) -> None:
+    """
+    Check that log holds exactly the entries fill() appended from first to
+    last.
+    """
+    assert (log.first_index, log.last_index) == (first, last)
+    for index in range(first, last + 1):
+        entry = log.entry(index)
+        assert (entry.index, entry.term, bytes(entry.data)) == (index, term, entry_data(index))
+
+def test_empty_log() -> None:
+    log = RaftLog()
+    assert (log.first_index, log.last_index, log.last_term) == (1, 0, 0)
+    assert log.term_at(0) == 0
+    with pytest.raises(IndexError):
+        log.entry(1)
+
+def test_reopen_keeps_entries(tmp_path) -> None:
+    log = RaftLog(str(tmp_path), SEGMENT_SIZE)
+    fill(log, 40)
+    assert len(log.segments) > 1
+    log.sync()
+    log.close()
+
+    log = RaftLog(str(tmp_path), SEGMENT_SIZE)
+    check_log(log, 1, 40)
+    assert (log.last_term, log.durable_index) == (1, 40)
+    assert log.append(2, b"") == 41
+    assert log.last_term == 2
+
+def test_entry_larger_than_a_segment(tmp_path) -> None:
+    log = RaftLog(str(tmp_path), SEGMENT_SIZE)
+    fill(log, 3)
+    big = bytes(range(256)) * 4
+    index = log.append(1, big)
+    fill(log, 3)
+    log.close()
+
+    log = RaftLog(str(tmp_path), SEGMENT_SIZE)
+    assert bytes(log.entry(index).data) == big
+    assert log.last_index == index + 3
+
+def test_torn_write_is_dropped_on_reopen(tmp_path) -> None:
+    log = RaftLog(str(tmp_path), SEGMENT_SIZE)
+    fill(log, 20)
+    segment = log.segments[-1]
+    path, offset = segment.path, segment.offsets[-1]
+    log.close()
+
+    # A crash halfway through writing the last entry leaves its data garbled.
+    with open(path, "r+b") as segment_file:
+        segment_file.seek(offset + ENTRY_HEADER.size)
+        segment_file.write(b"\xff\xff")
+
+    log = RaftLog(str(tmp_path), SEGMENT_SIZE)
+    check_log(log, 1, 19)
+    # The remains are cleared, so they do not come back after new appends.
+    fill(log, 1)
+    log.close()
+    log = RaftLog(str(tmp_path), SEGMENT_SIZE)
+    check_log(log, 1, 20)
+
+def test_missing_segment_drops_the_rest(tmp_path) -> None:
+    log = RaftLog(str(tmp_path), SEGMENT_SIZE)
+    fill(log, 40)
+    assert len(log.segments) >= 3
+    lost = log.segments[1]
+    kept_last = log.segments[0].last_index
+    log.close()
+    os.remove(lost.path)
+
+    log = RaftLog(str(tmp_path), SEGMENT_SIZE)
+    check_log(log, 1, kept_last)
+
+def test_truncate_after(tmp_path) -> None:
+    log = RaftLog(str(tmp_path), SEGMENT_SIZE)
+    fill(log, 40)
+    log.sync()
+    cut = log.segments[1].first_index + 1
+    log.truncate_after(cut)
+    check_log(log, 1, cut)
+    assert log.durable_index == cut
+    log.append(3, b"after the cut")
+    log.close()
+
+    log = RaftLog(str(tmp_path), SEGMENT_SIZE)
+    assert (log.last_index, log.last_term) == (cut + 1, 3)
+    assert bytes(log.entry(cut + 1).data) == b"after the cut"
+    log.truncate_after(cut)
+    check_log(log, 1, cut)
+
+def test_truncate_everything(tmp_path) -> None:
+    log = RaftLog(str(tmp_path), SEGMENT_SIZE)
+    fill(log, 10)
+    log.truncate_after(0)
+    assert (log.first_index, log.last_index, log.last_term) == (1, 0, 0)
+    assert log.append(2, b"first") == 1
+    log.close()
+    log = RaftLog(str(tmp_path), SEGMENT_SIZE)
+    assert (log.last_index, log.last_term) == (1, 2)
+
+def test_append_rejects_older_term() -> None:
+    log = RaftLog()
+    log.append(3, b"")
+    with pytest.raises(ValueError):
+        log.append(2, b"")
+
+def test_compact_drops_whole_segments(tmp_path) -> None:
+    log = RaftLog(str(tmp_path), SEGMENT_SIZE)
+    fill(log, 40)
+    compact_to = log.segments[1].first_index + 1
+    log.compact(compact_to, 1)
+    # The segment holding compact_to stays, as it holds later entries too.
+    check_log(log, log.segments[0].first_index, 40)
+    assert log.first_index <= compact_to
+    assert (log.snapshot_index, log.term_at(compact_to)) == (compact_to, 1)
+    assert log.has_term(compact_to)
+    log.close()
+
+    log = RaftLog(str(tmp_path), SEGMENT_SIZE)
+    assert log.first_index <= compact_to
+    check_log(log, log.first_index, 40)
+
+def test_compact_to_a_foreign_snapshot(tmp_path) -> None:
+    log = RaftLog(str(tmp_path), SEGMENT_SIZE)
+    fill(log, 10)
+    # A snapshot from the leader that our log does not match.
+    log.compact(15, 4)
+    assert (log.first_index, log.last_index, log.last_term) == (16, 15, 4)
+    assert log.durable_index == 15
+    assert log.has_term(15) and not log.has_term(10)
+    assert log.append(4, b"next") == 16
+    assert log.term_at(15) == 4
+    assert os.listdir(str(tmp_path)) == ["%020d.seg" % 16]
+
+def test_entries_respects_limits() -> None:
+    log = RaftLog()
+    for index in range(1, 11):
+        log.append(1, b"x" * 10)
+    assert [entry.index for entry in log.entries(3, 4, 1000)] == [3, 4, 5, 6]
+    assert [entry.index for entry in log.entries(3, 100, 25)] == [3, 4]
+    # Always at least one, however large.
+    assert [entry.index for entry in log.entries(9, 100, 1)] == [9]
+    assert log.entries(11, 100, 1000) == []
+
+def test_hard_state(tmp_path) -> None:
+    log = RaftLog(str(tmp_path))
+    assert log.load_hard_state() == (0, None)
+    log.save_hard_state(5, 3)
+    assert RaftLog(str(tmp_path)).load_hard_state() == (5, 3)
+    log.save_hard_state(6, None)
+    assert RaftLog(str(tmp_path)).load_hard_state() == (6, None)
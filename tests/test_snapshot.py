@@ -0,0 +1,68 @@
+from snapshot import SNAPSHOT_FILE, TEMP_SUFFIX, SnapshotStore
+
+import os
+import pytest
+
+STATE = bytes(range(256)) * 40
+
+def test_in_memory() -> None:
+    store = SnapshotStore()
+    assert store.load() is None
+    snapshot = store.save(10, 2, STATE)
+    assert (snapshot.last_index, snapshot.last_term, snapshot.size) == (10, 2, len(STATE))
+    assert store.load() is snapshot
+
+def test_save_and_reload(tmp_path) -> None:
+    store = SnapshotStore(str(tmp_path))
+    assert store.load() is None
+    store.save(10, 2, STATE)
+    snapshot = SnapshotStore(str(tmp_path)).load()
+    assert (snapshot.last_index, snapshot.last_term) == (10, 2)
+    assert bytes(snapshot.data) == STATE
+    assert bytes(snapshot.chunk(1000, 100)) == STATE[1000:1100]
+
+def test_received_in_chunks(tmp_path) -> None:
+    store = SnapshotStore(str(tmp_path))
+    writer = store.writer(20, 3, len(STATE))
+    for offset in range(0, len(STATE), 1000):
+        assert not writer.done
+        writer.write(STATE[offset:offset + 1000])
+    assert writer.done
+    snapshot = writer.finish()
+    assert (snapshot.last_index, bytes(snapshot.data)) == (20, STATE)
+    assert os.listdir(str(tmp_path)) == [SNAPSHOT_FILE]
+
+def test_chunks_must_add_up(tmp_path) -> None:
+    store = SnapshotStore(str(tmp_path))
+    writer = store.writer(20, 3, 10)
+    writer.write(b"12345")
+    with pytest.raises(ValueError):
+        writer.finish()
+    with pytest.raises(ValueError):
+        writer.write(b"123456")
+    writer.abort()
+    assert os.listdir(str(tmp_path)) == []
+
+def test_interrupted_write_keeps_the_old_snapshot(tmp_path) -> None:
+    store = SnapshotStore(str(tmp_path))
+    store.save(10, 2, STATE)
+    writer = store.writer(20, 3, len(STATE))
+    writer.write(STATE[:100])
+    writer.file.flush()
+
+    # As after a crash: the temporary file is cleaned up on the next start.
+    store = SnapshotStore(str(tmp_path))
+    assert not any(name.endswith(TEMP_SUFFIX) for name in os.listdir(str(tmp_path)))
+    assert store.load().last_index == 10
+
+def test_corrupt_snapshot_is_ignored(tmp_path) -> None:
+    store = SnapshotStore(str(tmp_path))
+    store.save(10, 2, STATE)
+    store.current = None
+    with open(store.path, "r+b") as snapshot_file:
+        snapshot_file.seek(-1, os.SEEK_END)
+        snapshot_file.write(b"\x00")
+    assert store.load() is None
+
+    open(store.path, "wb").close()
+    assert store.load() is None
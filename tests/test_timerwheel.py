@@ -0,0 +1,75 @@
+from timerwheel import TimerWheel
+
+import pytest
+import random
+
+TICK_MS = 10
+
+def test_expires_on_the_tick_after_the_deadline() -> None:
+    wheel = TimerWheel(TICK_MS, wheel_size=8, levels=2)
+    wheel.schedule("a", 25)
+    assert wheel.advance(20) == []
+    assert "a" in wheel
+    assert wheel.advance(29) == []
+    assert wheel.advance(30) == ["a"]
+    assert "a" not in wheel and len(wheel) == 0
+
+def test_reschedule_and_cancel() -> None:
+    wheel = TimerWheel(TICK_MS, wheel_size=8, levels=2)
+    wheel.schedule("a", 50)
+    wheel.schedule("b", 50)
+    wheel.schedule("a", 500)
+    assert wheel.cancel("b")
+    assert not wheel.cancel("b")
+    assert wheel.advance(490) == []
+    assert wheel.advance(500) == ["a"]
+
+def test_deadlines_in_the_past_expire_on_the_next_tick() -> None:
+    wheel = TimerWheel(TICK_MS, now=1000)
+    wheel.schedule("late", 0)
+    assert wheel.advance(1010) == ["late"]
+
+def test_deadlines_beyond_the_top_level() -> None:
+    # Covers 4 * 4 ticks; later deadlines go round more than once.
+    wheel = TimerWheel(TICK_MS, wheel_size=4, levels=2)
+    wheel.schedule("far", 1234)
+    for now in range(0, 1230, 10):
+        assert wheel.advance(now) == []
+    assert wheel.advance(1240) == ["far"]
+
+def test_invalid_geometry() -> None:
+    with pytest.raises(ValueError):
+        TimerWheel(0)
+    with pytest.raises(ValueError):
+        TimerWheel(TICK_MS, wheel_size=1)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_matches_a_sorted_model(seed: int) -> None:
+    """
+    Random schedules, cancels and uneven advances, checked against the
+    obvious implementation: every key expires on the first advance at or
+    past its deadline rounded up to a tick.
+    """
+    rng = random.Random(seed)
+    now = rng.randrange(0, 10000)
+    wheel = TimerWheel(TICK_MS, wheel_size=8, levels=3, now=now)
+    deadlines = {}
+    for _ in range(2000):
+        action = rng.random()
+        key = rng.randrange(50)
+        if action < 0.5:
+            deadline = now + rng.choice((rng.randrange(0, 100), rng.randrange(0, 10000)))
+            wheel.schedule(key, deadline)
+            # The current tick has been checked already, so even keys due
+            # now wait for the next one.
+            deadlines[key] = max(-(-deadline // TICK_MS), now // TICK_MS + 1) * TICK_MS
+        elif action < 0.6:
+            assert wheel.cancel(key) == (key in deadlines)
+            deadlines.pop(key, None)
+        else:
+            now += rng.choice((1, 7, TICK_MS, rng.randrange(0, 3000)))
+            expected = {key for key, deadline in deadlines.items() if deadline <= now // TICK_MS * TICK_MS}
+            assert set(wheel.advance(now)) == expected
+            for key in expected:
+                del deadlines[key]
+        assert len(wheel) == len(deadlines)